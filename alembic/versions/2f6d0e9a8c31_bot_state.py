@@ -0,0 +1,42 @@
+"""bot state persistence
+
+Revision ID: 2f6d0e9a8c31
+Revises: e7a93b0c4f12
+Create Date: 2026-10-17 16:40:52.208815
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2f6d0e9a8c31'
+down_revision: Union[str, Sequence[str], None] = 'e7a93b0c4f12'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'bot_state',
+        sa.Column('scope', sa.Text(), nullable=False),
+        sa.Column('id', sa.BigInteger(), nullable=False),
+        sa.Column('data', postgresql.JSONB(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('scope', 'id'),
+    )
+    op.create_table(
+        'conversation_state',
+        sa.Column('name', sa.Text(), nullable=False),
+        sa.Column('key', sa.Text(), nullable=False),
+        sa.Column('state', postgresql.JSONB(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'key'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('conversation_state')
+    op.drop_table('bot_state')
@@ -0,0 +1,43 @@
+"""denormalized task tags array
+
+Revision ID: 4a7e0b9d6c18
+Revises: c3f9a1d5b2e7
+Create Date: 2026-10-17 20:03:18.227514
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4a7e0b9d6c18'
+down_revision: Union[str, Sequence[str], None] = 'c3f9a1d5b2e7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('tasks', sa.Column(
+        'tags', postgresql.ARRAY(sa.Text()), server_default=sa.text("'{}'"), nullable=False,
+    ))
+    op.execute(
+        "UPDATE tasks SET tags = t.tags "
+        "FROM (SELECT task_id, array_agg(tag ORDER BY tag) AS tags FROM task_tags GROUP BY task_id) AS t "
+        "WHERE tasks.id = t.task_id"
+    )
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tasks_tags', 'tasks', ['tags'],
+            postgresql_using='gin',
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tasks_tags', table_name='tasks', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('tasks', 'tags')
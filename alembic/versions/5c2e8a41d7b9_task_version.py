@@ -0,0 +1,27 @@
+"""task version
+
+Revision ID: 5c2e8a41d7b9
+Revises: bd3f1671ff03
+Create Date: 2026-10-17 14:03:27.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c2e8a41d7b9'
+down_revision: Union[str, Sequence[str], None] = 'bd3f1671ff03'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # константный DEFAULT в Postgres 11+ не переписывает таблицу
+    op.add_column('tasks', sa.Column('version', sa.Integer(), server_default=sa.text('1'), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('tasks', 'version')
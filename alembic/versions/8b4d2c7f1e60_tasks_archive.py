@@ -0,0 +1,72 @@
+"""completed_at and tasks archive
+
+Revision ID: 8b4d2c7f1e60
+Revises: 2f6d0e9a8c31
+Create Date: 2026-10-17 18:05:37.410286
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8b4d2c7f1e60'
+down_revision: Union[str, Sequence[str], None] = '2f6d0e9a8c31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('tasks', sa.Column('completed_at', sa.DateTime(timezone=True), nullable=True))
+    # время выполнения старых задач неизвестно: считаем от момента миграции,
+    # чтобы они не ушли в архив сразу
+    op.execute("UPDATE tasks SET completed_at = now() WHERE done")
+    op.create_table(
+        'tasks_archive',
+        sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('title', sa.Text(), nullable=False),
+        sa.Column('category', sa.Text(), nullable=True),
+        sa.Column('priority', sa.Text(), nullable=True),
+        sa.Column('comment', sa.Text(), nullable=False),
+        sa.Column('tags', postgresql.ARRAY(sa.Text()), server_default=sa.text("'{}'"), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.Column('completed_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('archived_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_tasks_archive_user_completed', 'tasks_archive', ['user_id', 'completed_at', 'id'])
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tasks_done_user_completed', 'tasks', ['user_id', 'completed_at', 'id'],
+            postgresql_where=sa.text('done'),
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+        op.create_index(
+            'ix_tasks_done_completed_at', 'tasks', ['completed_at'],
+            postgresql_where=sa.text('done'),
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tasks_done_completed_at', table_name='tasks', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_tasks_done_user_completed', table_name='tasks', postgresql_concurrently=True, if_exists=True)
+    # архивные задачи возвращаются в tasks, иначе они пропадут вместе с таблицей
+    op.execute(
+        "INSERT INTO tasks (id, user_id, title, category, priority, done, comment, version) "
+        "SELECT id, user_id, title, category, priority, true, comment, version FROM tasks_archive"
+    )
+    op.execute(
+        "INSERT INTO task_tags (task_id, tag) "
+        "SELECT id, unnest(tags) FROM tasks_archive ON CONFLICT DO NOTHING"
+    )
+    op.drop_index('ix_tasks_archive_user_completed', table_name='tasks_archive')
+    op.drop_table('tasks_archive')
+    op.drop_column('tasks', 'completed_at')
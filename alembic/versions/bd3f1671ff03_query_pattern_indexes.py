@@ -0,0 +1,40 @@
+"""query pattern indexes
+
+Revision ID: bd3f1671ff03
+Revises: 93a20f832251
+Create Date: 2026-10-17 10:12:41.502113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bd3f1671ff03'
+down_revision: Union[str, Sequence[str], None] = '93a20f832251'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        # активные задачи пользователя по id: /tasks, дайджест, load_active_tags
+        op.create_index(
+            'ix_tasks_active_user_id', 'tasks', ['user_id', 'id'],
+            postgresql_where=sa.text('NOT done'),
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+        # тег -> задачи (первичный ключ task_tags начинается с task_id)
+        op.create_index(
+            'ix_task_tags_tag_task_id', 'task_tags', ['tag', 'task_id'],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_task_tags_tag_task_id', table_name='task_tags', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_tasks_active_user_id', table_name='tasks', postgresql_concurrently=True, if_exists=True)
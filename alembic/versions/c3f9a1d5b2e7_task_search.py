@@ -0,0 +1,46 @@
+"""task full-text search
+
+Revision ID: c3f9a1d5b2e7
+Revises: 8b4d2c7f1e60
+Create Date: 2026-10-17 19:12:44.905113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f9a1d5b2e7'
+down_revision: Union[str, Sequence[str], None] = '8b4d2c7f1e60'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # STORED-колонка заполняется для всех строк сразу (таблица переписывается)
+    op.add_column('tasks', sa.Column(
+        'search_vector',
+        postgresql.TSVECTOR(),
+        sa.Computed(
+            "setweight(to_tsvector('russian', coalesce(title, '')), 'A') || "
+            "setweight(to_tsvector('russian', coalesce(comment, '')), 'B')",
+            persisted=True,
+        ),
+        nullable=True,
+    ))
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_tasks_search_vector', 'tasks', ['search_vector'],
+            postgresql_using='gin',
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_tasks_search_vector', table_name='tasks', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('tasks', 'search_vector')
@@ -0,0 +1,48 @@
+"""per-user task counters
+
+Revision ID: d8e2f4a6b1c9
+Revises: 4a7e0b9d6c18
+Create Date: 2026-10-17 21:14:52.603118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd8e2f4a6b1c9'
+down_revision: Union[str, Sequence[str], None] = '4a7e0b9d6c18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'user_task_stats',
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('active', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('done', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('active_low', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('active_medium', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.Column('active_high', sa.Integer(), server_default=sa.text('0'), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+    # начальные значения; расхождения с записями во время миграции исправит repair_task_stats
+    op.execute(
+        "INSERT INTO user_task_stats (user_id, active, done, active_low, active_medium, active_high) "
+        "SELECT u.user_id, "
+        "count(t.id) FILTER (WHERE NOT t.done), "
+        "count(t.id) FILTER (WHERE t.done) + (SELECT count(*) FROM tasks_archive a WHERE a.user_id = u.user_id), "
+        "count(t.id) FILTER (WHERE NOT t.done AND t.priority = 'низкий'), "
+        "count(t.id) FILTER (WHERE NOT t.done AND t.priority = 'средний'), "
+        "count(t.id) FILTER (WHERE NOT t.done AND t.priority = 'высокий') "
+        "FROM users u LEFT JOIN tasks t ON t.user_id = u.user_id "
+        "GROUP BY u.user_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('user_task_stats')
@@ -0,0 +1,32 @@
+"""bot messages
+
+Revision ID: e7a93b0c4f12
+Revises: 5c2e8a41d7b9
+Create Date: 2026-10-17 15:21:09.642731
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e7a93b0c4f12'
+down_revision: Union[str, Sequence[str], None] = '5c2e8a41d7b9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'bot_messages',
+        sa.Column('chat_id', sa.BigInteger(), nullable=False),
+        sa.Column('message_id', sa.BigInteger(), nullable=False),
+        sa.Column('sent_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('chat_id', 'message_id'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('bot_messages')
@@ -0,0 +1,4 @@
+"""Бенчмарки бота. Сценарии с данными работают с локальным Postgres из DATABASE_URL:
+
+    DATABASE_URL=postgresql+psycopg://... python -m bench.<модуль> --help
+"""
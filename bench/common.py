@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+from sqlalchemy import delete, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from bot.db import repair_task_stats
+from bot.db_orm.models import Setting, Tag, Task, TaskTag, User
+from bot.db_orm.session import AsyncSessionLocal
+
+# Синтетические пользователи живут в отдельном диапазоне id, чтобы не задеть реальных.
+BENCH_USER_BASE = 9_000_000_000
+CATEGORIES = ["Работа", "Дом", "Учёба", "Спорт"]
+PRIORITIES = ["низкий", "средний", "высокий"]
+TAGS = [f"tag{i}" for i in range(20)]
+CHUNK = 5_000
+
+
+def bench_user_ids(count: int) -> list[int]:
+    return [BENCH_USER_BASE + i for i in range(count)]
+
+
+async def seed(user_count: int, tasks_per_user: int, done_ratio: float = 0.0, tags_per_task: int = 2) -> list[int]:
+    """Создаёт пользователей с задачами и тегами пачками, минуя bot.db."""
+    user_ids = bench_user_ids(user_count)
+    await cleanup()
+    async with AsyncSessionLocal() as s:
+        await s.execute(pg_insert(User).values([{"user_id": uid, "name": f"bench {uid}"} for uid in user_ids]))
+        await s.execute(pg_insert(Setting).values(
+            [{"user_id": uid, "key": "reminder_time", "value": "09:00"} for uid in user_ids]
+            + [{"user_id": uid, "key": "notify_weekends", "value": "0"} for uid in user_ids]
+        ))
+        await s.execute(pg_insert(Tag).values(
+            [{"user_id": uid, "name": tag} for uid in user_ids for tag in TAGS]
+        ))
+        done_count = int(tasks_per_user * done_ratio)
+        now = datetime.now(timezone.utc)
+        for uid in user_ids:
+            for start in range(0, tasks_per_user, CHUNK):
+                rows = [
+                    {
+                        "user_id": uid,
+                        "title": f"Задача {n}",
+                        "category": CATEGORIES[n % len(CATEGORIES)],
+                        "priority": PRIORITIES[n % len(PRIORITIES)],
+                        "done": n < done_count,
+                        "completed_at": now if n < done_count else None,
+                        "comment": "",
+                        "tags": [TAGS[(n + k) % len(TAGS)] for k in range(tags_per_task)],
+                    }
+                    for n in range(start, min(start + CHUNK, tasks_per_user))
+                ]
+                ids = (await s.execute(insert(Task).returning(Task.id), rows)).scalars().all()
+                tag_rows = [
+                    {"task_id": task_id, "tag": tag}
+                    for row, task_id in zip(rows, ids)
+                    for tag in row["tags"]
+                ]
+                if tag_rows:
+                    await s.execute(insert(TaskTag), tag_rows)
+        await s.commit()
+    # задачи вставлены мимо bot.db: счётчики пересчитываются целиком
+    await repair_task_stats(user_ids)
+    return user_ids
+
+
+async def cleanup():
+    async with AsyncSessionLocal() as s:
+        await s.execute(delete(User).where(User.user_id >= BENCH_USER_BASE))
+        await s.commit()
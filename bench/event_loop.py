@@ -0,0 +1,80 @@
+"""Сколько апдейтов в секунду бот обслуживает при N одновременных чатах.
+
+Каждый «апдейт» повторяет горячий путь /tasks: чтение задач пользователя из БД
+и ответ в Telegram (эмулируется задержкой --api-ms). Режим ``sync`` выполняет
+запросы синхронной сессией прямо в event loop, как было до перехода на asyncio;
+режим ``async`` ходит через bot.db.
+
+    python -m bench.event_loop --chats 1 10 50 --updates 20 --tasks 50
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import select
+
+from bot import db
+from bot.cache import user_cache
+from bot.db_orm.models import Task, TaskTag
+from bot.db_orm.session import SessionLocal
+
+from .common import cleanup, seed
+from .stats import percentiles, stopwatch
+
+
+def load_tasks_blocking(user_id: int):
+    with SessionLocal() as s:
+        tasks = s.execute(select(Task).where(Task.user_id == user_id).order_by(Task.id)).scalars().all()
+        task_ids = [t.id for t in tasks]
+        if task_ids:
+            s.execute(select(TaskTag.task_id, TaskTag.tag).where(TaskTag.task_id.in_(task_ids))).all()
+    return tasks
+
+
+async def handle_update(mode: str, user_id: int, api_latency: float):
+    if mode == "sync":
+        load_tasks_blocking(user_id)
+    else:
+        # меряем обращение к БД, а не кэш чтений
+        user_cache.invalidate(user_id, "tasks")
+        await db.load_tasks(user_id)
+    await asyncio.sleep(api_latency)
+
+
+async def run(mode: str, user_ids: list[int], updates: int, api_latency: float):
+    samples: list[float] = []
+
+    async def chat(user_id: int):
+        for _ in range(updates):
+            with stopwatch(samples):
+                await handle_update(mode, user_id, api_latency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(chat(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - started
+    return len(samples) / elapsed, percentiles(samples)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--updates", type=int, default=20, help="апдейтов на чат")
+    parser.add_argument("--tasks", type=int, default=50, help="задач на пользователя")
+    parser.add_argument("--api-ms", type=float, default=30.0, help="эмулируемая задержка Bot API")
+    args = parser.parse_args()
+
+    user_ids = await seed(max(args.chats), args.tasks)
+    try:
+        print(f"{'chats':>6} {'mode':>6} {'upd/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for chats in args.chats:
+            for mode in ("sync", "async"):
+                rate, pct = await run(mode, user_ids[:chats], args.updates, args.api_ms / 1000)
+                print(f"{chats:>6} {mode:>6} {rate:>9.1f} {pct['p50']:>8.1f} {pct['p95']:>8.1f} {pct['p99']:>8.1f}")
+    finally:
+        await cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""EXPLAIN ANALYZE для каждого запроса bot/db.py на большом синтетическом наборе.
+
+Скрипт заполняет базу (--users x --tasks, половина задач выполнена), прогоняет
+функции bot.db, перехватывает выполненные SQL-запросы и повторяет каждый под
+EXPLAIN (ANALYZE, FORMAT JSON) в откатываемой транзакции. Запросы, в плане
+которых есть Seq Scan, помечаются; код возврата 1, если такие нашлись.
+
+    python -m bench.explain --users 2000 --tasks 500
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import sys
+from datetime import timedelta
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+
+from bot import db
+from bot.db_orm.session import async_engine
+
+from .common import CATEGORIES, PRIORITIES, TAGS, cleanup, seed
+
+
+async def exercise(user_id: int):
+    """Вызывает все функции bot.db, чтобы собрать их SQL."""
+    tasks, _ = await db.load_tasks_page(user_id)
+    await db.load_tasks_page(user_id, after_id=tasks[-1]["id"])
+    await db.load_tasks_page(user_id, before_id=tasks[-1]["id"])
+    await db.load_tasks_page(user_id, from_end=True)
+    await db.load_tasks_page(user_id, {"category": CATEGORIES[0], "priority": PRIORITIES[0], "tags": [TAGS[0]]})
+    await db.load_tasks_page(user_id, {"tags": TAGS[:2], "tag_mode": "all"})
+    await db.load_tasks_page(user_id, {"tags": TAGS[:3], "tag_mode": "any"})
+    await db.load_tasks(user_id)
+    await db.search_tasks(user_id, "задача")
+    await db.load_completed_page(user_id)
+    await db.load_digest_pages([user_id, user_id + 1, user_id + 2])
+    await db.get_task(user_id, tasks[0]["id"])
+    await db.load_categories(user_id)
+    await db.load_tags(user_id)
+    await db.load_active_tags(user_id)
+    await db.load_settings(user_id)
+    await db.get_all_users()
+    await db.register_user(user_id)
+    await db.save_setting(user_id, "reminder_time", "09:00")
+    await db.save_categories(user_id, CATEGORIES)
+    task_id = await db.create_task(user_id, "explain", CATEGORIES[0], PRIORITIES[0], [TAGS[0]])
+    await db.update_task_fields(user_id, task_id, title="explain 2")
+    await db.add_task_tags(user_id, task_id, [TAGS[1]])
+    await db.complete_task(user_id, task_id, "ok")
+    await db.restore_task(user_id, task_id)
+    await db.delete_task(user_id, task_id)
+    await db.load_facet_counts(user_id)
+    await db.load_facet_counts(user_id, {"category": CATEGORIES[0], "tags": TAGS[:2], "tag_mode": "any"})
+    await db.load_task_stats(user_id)
+    tasks = await db.load_tasks(user_id)
+    tasks[0]["title"] += " (explain)"
+    tasks[1]["tags"] = [TAGS[2]]
+    del tasks[2]
+    tasks.append({"title": "explain", "category": CATEGORIES[0], "priority": PRIORITIES[0], "tags": [TAGS[0]]})
+    await db.save_tasks(user_id, tasks)
+    await db.archive_completed_tasks(timedelta(days=30), 100)
+    await db.unarchive_task(user_id, tasks[0]["id"])
+    await db.repair_task_stats([user_id, user_id + 1])
+    await db.load_all_reminder_settings()
+    await db.save_bot_messages({user_id: [1, 2, 3]}, per_chat=2)
+    await db.pop_bot_messages(user_id)
+    await db.save_persistence(
+        {("user", user_id): {"filters": {}}, ("chat", user_id): None},
+        {("filter", json.dumps([user_id, user_id])): 1, ("settings", json.dumps([user_id, user_id])): None},
+    )
+    await db.load_state("user", user_id)
+    await db.load_conversations("filter")
+
+
+def seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan":
+        found.append(plan.get("Relation Name", "?"))
+    for child in plan.get("Plans", []):
+        found.extend(seq_scans(child))
+    return found
+
+
+async def explain(statement: str, parameters, analyze: bool) -> dict | None:
+    """План запроса в откатываемой транзакции; None, если ANALYZE упал на ограничениях."""
+    options = "ANALYZE, FORMAT JSON" if analyze else "FORMAT JSON"
+    async with async_engine.connect() as conn:
+        trans = await conn.begin()
+        try:
+            result = await conn.exec_driver_sql(f"EXPLAIN ({options}) {statement}", parameters)
+        except IntegrityError:
+            if not analyze:
+                raise
+            return None
+        finally:
+            await trans.rollback()
+        return result.scalar_one()[0]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--tasks", type=int, default=500, help="задач на пользователя")
+    parser.add_argument("--keep", action="store_true", help="не удалять сгенерированные данные")
+    args = parser.parse_args()
+
+    user_ids = await seed(args.users, args.tasks, done_ratio=0.5)
+    async with async_engine.connect() as conn:
+        await conn.execute(text("ANALYZE"))
+        await conn.commit()
+
+    captured: dict[str, object] = {}
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            captured.setdefault(statement, parameters)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        await exercise(user_ids[len(user_ids) // 2])
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", on_execute)
+
+    flagged = 0
+    try:
+        for statement, parameters in captured.items():
+            report = await explain(statement, parameters, analyze=True)
+            if report is None:
+                # запись, зависящая от строк, которых уже нет (например, теги удалённой
+                # задачи), при повторе нарушит ограничения: план смотрим без выполнения
+                report = await explain(statement, parameters, analyze=False)
+            scans = seq_scans(report["Plan"])
+            flagged += bool(scans)
+            mark = f"SEQ SCAN on {', '.join(scans)}" if scans else "ok"
+            summary = " ".join(statement.split())[:100]
+            elapsed = f"{report['Execution Time']:>9.2f} ms" if "Execution Time" in report else f"{'plan only':>12}"
+            print(f"{elapsed}  {mark:<30} {summary}")
+    finally:
+        if not args.keep:
+            await cleanup()
+    print(f"\n{len(captured)} queries, {flagged} with sequential scans")
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,267 @@
+"""Пропускная способность обработчиков на синтетических потоках апдейтов.
+
+Собирает настоящее приложение через ``bot.handlers.build_application`` (без
+``run_polling``), подменяет HTTP-клиент Bot API фейковым и прогоняет через
+``Application.process_update`` типовые сценарии пользователя: /start, листание
+/tasks, диалог добавления задачи, выполнение с комментарием, фильтр и
+настройки. Для каждого сценария печатает апдейты в секунду и p50/p95/p99, а
+результаты пишет в JSON, чтобы прогоны можно было сравнивать.
+
+Нужен Postgres из ``DATABASE_URL``: запросы bot.db используют диалект
+PostgreSQL, SQLite их не выполнит.
+
+    python -m bench.handlers --users 10 100 --tasks 10 1000 --output bench_handlers.json
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from bot.cache import user_cache
+from bot.handlers import build_application
+from bot.keyboards import task_list_cache
+
+from .common import cleanup, seed
+from .stats import percentiles, stopwatch
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+class FakeBotAPI(BaseRequest):
+    """Отвечает на вызовы Bot API без сети и запоминает последнюю клавиатуру в каждом чате."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self.markups: dict[int, dict] = {}
+        self.last_message: dict[int, int] = {}
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        message_id = int(params.get("message_id") or next(self._message_ids))
+        markup = params.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        self.markups[chat_id] = markup or {}
+        self.last_message[chat_id] = message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def button(self, chat_id: int, pattern: re.Pattern) -> str | None:
+        """callback_data первой кнопки последней клавиатуры чата, подходящей под ``pattern``."""
+        for row in self.markups.get(chat_id, {}).get("inline_keyboard", []):
+            for button in row:
+                data = button.get("callback_data") or ""
+                if pattern.match(data):
+                    return data
+        return None
+
+
+@dataclass
+class Step:
+    kind: str  # "text" или "callback"
+    data: str | re.Pattern
+    # если в последней клавиатуре нет подходящей кнопки; None — шаг пропускается
+    fallback: str | None = None
+
+
+NEXT_PAGE = re.compile(r"^tasks_page_\d+_a\d+$")
+TASK_BUTTON = re.compile(r"^task_\d+$")
+
+FLOWS: dict[str, list[Step]] = {
+    "start": [Step("text", "/start")],
+    "tasks_paging": [
+        Step("text", "/tasks"),
+        Step("callback", NEXT_PAGE, "show_tasks"),
+        Step("callback", NEXT_PAGE, "show_tasks"),
+    ],
+    "add_task": [
+        Step("text", "/add"),
+        Step("text", "Новая задача"),
+        Step("callback", "new_category"),
+        Step("text", "Работа"),
+        Step("callback", "priority_высокий"),
+        Step("text", "tag1, tag2"),
+    ],
+    "complete": [
+        Step("text", "/tasks"),
+        Step("callback", TASK_BUTTON),
+        Step("text", "готово"),
+    ],
+    "filter": [
+        Step("text", "/filter"),
+        Step("callback", "filter_priority"),
+        Step("callback", "fprio_высокий"),
+        Step("callback", "filter_reset"),
+        Step("callback", "cancel"),
+    ],
+    "settings": [
+        Step("text", "/settings"),
+        Step("callback", "toggle_weekends"),
+        Step("callback", "set_time"),
+        Step("text", "08:30"),
+        Step("callback", "cancel"),
+    ],
+}
+
+
+class UpdateFactory:
+    def __init__(self, bot, api: FakeBotAPI):
+        self.bot = bot
+        self.api = api
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000_000)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Bench"}
+
+    def text(self, user_id: int, text: str) -> Update:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return Update.de_json({"update_id": next(self._update_ids), "message": message}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        update_id = next(self._update_ids)
+        message = {
+            "message_id": self.api.last_message.get(user_id, 1),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": BOT_USER,
+            "text": "",
+        }
+        query = {
+            "id": str(update_id),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message,
+        }
+        return Update.de_json({"update_id": update_id, "callback_query": query}, self.bot)
+
+    def build(self, user_id: int, step: Step) -> Update | None:
+        data = step.data
+        if isinstance(data, re.Pattern):
+            data = self.api.button(user_id, data) or step.fallback
+            if data is None:
+                return None
+        if step.kind == "text":
+            return self.text(user_id, data)
+        return self.callback(user_id, data)
+
+
+async def run_flow(application, factory: UpdateFactory, steps: list[Step], user_ids: list[int], rounds: int):
+    samples: list[float] = []
+
+    async def user_session(user_id: int):
+        for _ in range(rounds):
+            for step in steps:
+                update = factory.build(user_id, step)
+                if update is None:
+                    continue
+                with stopwatch(samples):
+                    await application.process_update(update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_session(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - started
+    return len(samples), len(samples) / elapsed if elapsed else 0.0, percentiles(samples)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 100], help="одновременных пользователей")
+    parser.add_argument("--tasks", type=int, nargs="+", default=[10, 1000], help="задач на пользователя")
+    parser.add_argument("--rounds", type=int, default=3, help="повторов сценария на пользователя")
+    parser.add_argument("--flows", nargs="+", choices=sorted(FLOWS), default=list(FLOWS))
+    parser.add_argument("--api-ms", type=float, default=0.0, help="эмулируемая задержка Bot API")
+    parser.add_argument("--output", default="bench_handlers.json", help="куда записать результаты в JSON")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.api_ms / 1000)
+    application = build_application(token="123456:BENCH", request=api)
+    await application.initialize()
+    factory = UpdateFactory(application.bot, api)
+    results = []
+    try:
+        print(f"{'users':>6} {'tasks':>6} {'flow':>13} {'updates':>8} {'upd/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for users, tasks in itertools.product(args.users, args.tasks):
+            user_ids = await seed(users, tasks)
+            user_cache.clear()
+            task_list_cache.clear()
+            for flow in args.flows:
+                count, rate, pct = await run_flow(application, factory, FLOWS[flow], user_ids, args.rounds)
+                print(
+                    f"{users:>6} {tasks:>6} {flow:>13} {count:>8} {rate:>9.1f}"
+                    f" {pct['p50']:>8.1f} {pct['p95']:>8.1f} {pct['p99']:>8.1f}"
+                )
+                results.append({"users": users, "tasks": tasks, "flow": flow, "updates": count, "upd_s": rate, **pct})
+    finally:
+        await application.shutdown()
+        await cleanup()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "params": {"rounds": args.rounds, "api_ms": args.api_ms},
+                "api_calls": dict(api.calls),
+                "results": results,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
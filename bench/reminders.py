@@ -0,0 +1,104 @@
+"""Рассылка напоминаний на N пользователей с фейковым ботом, без БД и сети.
+
+Строит индекс диспетчера для --users пользователей (--hot-share из них с
+напоминанием на 09:00, остальные размазаны по 07:00–11:00), затем отправляет
+корзину понедельника 09:00 через ReminderDispatcher.dispatch. Фейковый бот
+отвечает через --api-ms и считает одновременные запросы.
+
+    python -m bench.reminders --users 50000 --rate 2000 --concurrency 100
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+from bot.reminders import ReminderDispatcher
+
+from .stats import percentiles
+
+
+class FakeBot:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sent_at: list[float] = []
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        self.sent_at.append(time.perf_counter())
+        return SimpleNamespace(chat_id=chat_id, message_id=len(self.sent_at))
+
+
+async def fake_send_daily_tasks(context, user_id: int, digest=None):
+    await context.bot.send_message(chat_id=user_id, text="Задачи на сегодня:")
+
+
+def make_settings(users: int, hot_share: float) -> dict[int, dict]:
+    rng = random.Random(42)
+    settings = {}
+    for user_id in range(1, users + 1):
+        if rng.random() < hot_share:
+            reminder_time = "09:00"
+        else:
+            minutes = rng.randrange(7 * 60, 11 * 60)
+            reminder_time = f"{minutes // 60:02d}:{minutes % 60:02d}"
+        settings[user_id] = {"reminder_time": reminder_time, "notify_weekends": "0"}
+    return settings
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--hot-share", type=float, default=0.6, help="доля пользователей с напоминанием на 09:00")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=2000, help="сообщений в секунду")
+    parser.add_argument("--spread", type=float, default=10, help="на сколько секунд растягивать большую корзину")
+    parser.add_argument("--api-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    bot = FakeBot(args.api_ms / 1000)
+    dispatcher = ReminderDispatcher(
+        concurrency=args.concurrency,
+        rate=args.rate,
+        spread_threshold=100,
+        spread_seconds=args.spread,
+        send=fake_send_daily_tasks,
+    )
+    all_settings = make_settings(args.users, args.hot_share)
+
+    started = time.perf_counter()
+    dispatcher.load(all_settings)
+    load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for user_id in range(1, 1001):
+        dispatcher.set_user(user_id, {"reminder_time": "09:00", "notify_weekends": "1"})
+    update_us = (time.perf_counter() - started) / 1000 * 1e6
+
+    bucket = dispatcher.due(0, "09:00")
+    started = time.perf_counter()
+    await dispatcher.dispatch(SimpleNamespace(bot=bot), bucket)
+    elapsed = time.perf_counter() - started
+    delays = [sent - started for sent in bot.sent_at]
+    per_second: dict[int, int] = {}
+    for delay in delays:
+        per_second[int(delay)] = per_second.get(int(delay), 0) + 1
+    pct = percentiles(delays)
+
+    print(f"index: {len(dispatcher)} users loaded in {load_seconds:.3f}s, set_user {update_us:.1f} us")
+    print(f"bucket Mon 09:00: {len(bucket)} users, sent {len(bot.sent_at)} in {elapsed:.2f}s "
+          f"({len(bot.sent_at) / elapsed:.0f} msg/s, peak {max(per_second.values(), default=0)} msg/s)")
+    print(f"max in-flight API calls: {bot.max_in_flight}")
+    print(f"delivery delay from tick: p50 {pct['p50'] / 1000:.2f}s, p95 {pct['p95'] / 1000:.2f}s, p99 {pct['p99'] / 1000:.2f}s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
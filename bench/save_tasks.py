@@ -0,0 +1,96 @@
+"""Стоимость полной синхронизации save_tasks: число SQL-запросов и время.
+
+Для каждого размера прогоняются три сценария: первичная загрузка списка,
+повторное сохранение без изменений и сохранение с правками ~10% задач
+(заголовок, теги) и удалением ~1%.
+
+    python -m bench.save_tasks --sizes 100 10000 100000
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from bot import db
+from bot.db_orm.session import async_engine
+
+from .common import CATEGORIES, PRIORITIES, TAGS, bench_user_ids, cleanup, seed
+
+
+@contextmanager
+def count_queries():
+    counter = {"queries": 0}
+
+    def on_execute(*_args):
+        counter["queries"] += 1
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        yield counter
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", on_execute)
+
+
+def make_tasks(size: int) -> list[dict]:
+    return [
+        {
+            "id": None,
+            "title": f"Задача {n}",
+            "category": CATEGORIES[n % len(CATEGORIES)],
+            "priority": PRIORITIES[n % len(PRIORITIES)],
+            "done": False,
+            "comment": "",
+            "tags": [TAGS[n % len(TAGS)], TAGS[(n + 1) % len(TAGS)]],
+        }
+        for n in range(size)
+    ]
+
+
+def modify(tasks: list[dict]) -> list[dict]:
+    out = []
+    for n, task in enumerate(tasks):
+        if n % 100 == 0:
+            continue  # удалить
+        task = dict(task)
+        if n % 10 == 0:
+            task["title"] += " (изменено)"
+            task["tags"] = [TAGS[(n + 2) % len(TAGS)]]
+        out.append(task)
+    return out
+
+
+async def measure(user_id: int, tasks: list[dict]) -> tuple[int, float]:
+    with count_queries() as counter:
+        started = time.perf_counter()
+        await db.save_tasks(user_id, tasks)
+        elapsed = time.perf_counter() - started
+    return counter["queries"], elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10_000, 100_000])
+    args = parser.parse_args()
+
+    await seed(1, 0)
+    (user_id,) = bench_user_ids(1)
+    try:
+        print(f"{'tasks':>8} {'scenario':>10} {'queries':>8} {'seconds':>9}")
+        for size in args.sizes:
+            await db.save_tasks(user_id, [])
+            tasks = make_tasks(size)
+            for name, payload in (("insert", tasks), ("noop", tasks), ("modify", None)):
+                if payload is None:
+                    payload = modify(tasks)
+                queries, elapsed = await measure(user_id, payload)
+                print(f"{size:>8} {name:>10} {queries:>8} {elapsed:>9.3f}")
+    finally:
+        await cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+"""Задержка /search (bot.db.search_tasks) на большом числе задач.
+
+Заполняет базу --users x --tasks задачами (по умолчанию 1000 x 1000 = 1M),
+раздаёт им названия и комментарии из словаря, делает ANALYZE и для каждого
+вида запроса меряет p50/p95/p99 по случайным пользователям. Для сравнения
+тот же запрос прогоняется через ILIKE по названию и комментарию, а план
+показывает, каким индексом Postgres нашёл задачи.
+
+    python -m bench.search --users 1000 --tasks 1000 --samples 200
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from sqlalchemy import event, func, or_, select, text, update
+
+from bot import db
+from bot.db_orm.models import Task
+from bot.db_orm.session import AsyncSessionLocal, async_engine
+
+from .common import BENCH_USER_BASE, cleanup, seed
+from .stats import percentiles, stopwatch
+
+WORDS = [
+    "купить", "молоко", "хлеб", "отчёт", "встреча", "позвонить", "маме", "врач", "записаться", "оплатить",
+    "счёт", "интернет", "квартира", "ремонт", "кран", "машина", "шины", "заменить", "подарок", "день",
+    "рождения", "билеты", "поезд", "отпуск", "документы", "паспорт", "налоги", "декларация", "проект",
+    "презентация", "клиент", "договор", "подписать", "отправить", "письмо", "почта", "курс", "английский",
+    "тренировка", "бассейн", "книга", "прочитать", "статья", "код", "ревью", "релиз", "сервер", "база",
+    "данных", "бэкап",
+]
+# слова встречаются с разной частотой: первые — почти у всех, последние — редко
+WEIGHTS = [1 / (rank + 1) for rank in range(len(WORDS))]
+
+QUERIES = {
+    "frequent word": "купить",
+    "two words": "оплатить счёт",
+    "phrase": '"записаться к врачу"',
+    "rare word": "бэкап",
+    "or": "паспорт or декларация",
+    "no match": "зебра",
+}
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choices(WORDS, WEIGHTS, k=words))
+
+
+async def fill_text(seed_value: int):
+    """Названия и комментарии из словаря для всех синтетических задач, пачками по 10 000."""
+    rng = random.Random(seed_value)
+    async with AsyncSessionLocal() as s:
+        task_ids = (await s.execute(
+            select(Task.id).where(Task.user_id >= BENCH_USER_BASE).order_by(Task.id)
+        )).scalars().all()
+    for start in range(0, len(task_ids), 10_000):
+        chunk = task_ids[start:start + 10_000]
+        async with AsyncSessionLocal() as s:
+            await s.execute(
+                update(Task),
+                [{"id": task_id, "title": _text(rng, 3), "comment": _text(rng, 6)} for task_id in chunk],
+            )
+            await s.commit()
+
+
+async def ilike_search(user_id: int, query: str):
+    pattern = f"%{query.strip(chr(34)).split()[0]}%"
+    async with AsyncSessionLocal() as s:
+        return (await s.execute(
+            select(Task.id, func.count().over())
+            .where(Task.user_id == user_id, or_(Task.title.ilike(pattern), Task.comment.ilike(pattern)))
+            .order_by(Task.id)
+            .limit(10)
+        )).all()
+
+
+def index_names(plan: dict) -> list[str]:
+    found = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        found.extend(index_names(child))
+    return found
+
+
+async def plan_indexes(user_id: int, query: str) -> list[str]:
+    captured: list[tuple[str, object]] = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", on_execute)
+    try:
+        await db.search_tasks(user_id, query)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", on_execute)
+    statement, parameters = captured[0]
+    async with async_engine.connect() as conn:
+        result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+        return sorted(set(index_names(result.scalar_one()[0]["Plan"])))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tasks", type=int, default=1000, help="задач на пользователя")
+    parser.add_argument("--samples", type=int, default=200, help="запросов на вид")
+    parser.add_argument("--keep", action="store_true", help="не удалять сгенерированные данные")
+    parser.add_argument("--output", default="bench_search.json", help="куда записать результаты в JSON")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    user_ids = await seed(args.users, args.tasks, done_ratio=0.2)
+    await fill_text(args.users)
+    async with async_engine.connect() as conn:
+        await conn.execute(text("ANALYZE tasks"))
+        await conn.commit()
+    print(f"seeded {args.users * args.tasks} tasks in {time.perf_counter() - started:.1f}s")
+
+    rng = random.Random(0)
+    results = []
+    try:
+        print(f"{'query':>14} {'found':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'ilike p50':>10}  index")
+        for name, query in QUERIES.items():
+            samples: list[float] = []
+            baseline: list[float] = []
+            found = 0
+            for _ in range(args.samples):
+                user_id = rng.choice(user_ids)
+                with stopwatch(samples):
+                    _, total = await db.search_tasks(user_id, query)
+                found += total
+                with stopwatch(baseline):
+                    await ilike_search(user_id, query)
+            pct = percentiles(samples)
+            base = percentiles(baseline)
+            indexes = await plan_indexes(user_ids[0], query)
+            print(
+                f"{name:>14} {found / args.samples:>6.0f} {pct['p50']:>8.2f} {pct['p95']:>8.2f} {pct['p99']:>8.2f}"
+                f" {base['p50']:>10.2f}  {', '.join(indexes) or '-'}"
+            )
+            results.append({
+                "query": name, "text": query, "found_avg": found / args.samples, **pct,
+                "ilike": base, "indexes": indexes,
+            })
+    finally:
+        if not args.keep:
+            await cleanup()
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(
+            {"params": {"users": args.users, "tasks": args.tasks, "samples": args.samples}, "results": results},
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    print(f"results written to {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import statistics
+import time
+from contextlib import contextmanager
+
+
+@contextmanager
+def stopwatch(samples: list[float]):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        samples.append(time.perf_counter() - started)
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    """p50/p95/p99 в миллисекундах."""
+    if len(samples) < 2:
+        value = samples[0] * 1000 if samples else 0.0
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49] * 1000, "p95": cuts[94] * 1000, "p99": cuts[98] * 1000}
@@ -0,0 +1,165 @@
+"""Кэш чтений bot.db в памяти процесса.
+
+Значения хранятся по ключу (user_id, вид данных) в LRU с TTL. Функции чтения
+оборачиваются ``@cached``, функции записи — ``@invalidates``: после любой записи
+соответствующие записи кэша сбрасываются. Наружу отдаются копии, поэтому
+обработчики могут свободно менять полученные списки и словари.
+"""
+from __future__ import annotations
+
+import contextvars
+import copy
+import functools
+import itertools
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from .config import CACHE_MAXSIZE, CACHE_TTL
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Ограниченный по размеру словарь с вытеснением LRU, TTL и счётчиками."""
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key, _MISSING)
+        if item is not _MISSING:
+            expires_at, value = item
+            if expires_at > self._clock():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (self._clock() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._data),
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class UserCache:
+    """Кэш данных пользователя по видам: tasks, categories, tags, active_tags, settings.
+
+    Кроме того, у каждой пары (пользователь, вид) есть номер поколения: он
+    меняется при каждом сбросе. Чтение запоминает номер до запроса к базе и не
+    кладёт ответ в кэш, если за это время прошёл сброс. Номер вида ``tasks`` —
+    версия задач пользователя, часть ключа производных кэшей (например, готовых
+    клавиатур). Номера берутся из одного счётчика процесса и хранятся в LRU
+    того же размера, что и данные: вытесненная пара получит новый номер, а не
+    вернётся к уже использованному.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._lru = LRUCache(maxsize, ttl)
+        self._generations = LRUCache(maxsize, float("inf"))
+        self._counter = itertools.count(1)
+
+    def generation(self, user_id: int, kind: str) -> int:
+        generation = self._generations.get((user_id, kind))
+        if generation is None:
+            generation = next(self._counter)
+            self._generations.set((user_id, kind), generation)
+        return generation
+
+    def version(self, user_id: int) -> int:
+        return self.generation(user_id, "tasks")
+
+    def get(self, user_id: int, kind: str) -> Any:
+        value = self._lru.get((user_id, kind), _MISSING)
+        return _MISSING if value is _MISSING else copy.deepcopy(value)
+
+    def set(self, user_id: int, kind: str, value: Any):
+        self._lru.set((user_id, kind), copy.deepcopy(value))
+
+    def invalidate(self, user_id: int, *kinds: str):
+        for kind in kinds:
+            self._lru.pop((user_id, kind))
+            self._generations.set((user_id, kind), next(self._counter))
+
+    def clear(self):
+        self._lru.clear()
+        self._generations.clear()
+
+    def stats(self) -> dict[str, float]:
+        return self._lru.stats()
+
+
+user_cache = UserCache(CACHE_MAXSIZE, CACHE_TTL)
+
+
+# сбросы кэша внутри транзакции единицы работы: при её откате их нужно повторить,
+# иначе кэш сохранит прочитанное внутри откаченной транзакции
+invalidation_log: contextvars.ContextVar[list[tuple[int, tuple[str, ...]]] | None] = contextvars.ContextVar(
+    "invalidation_log", default=None
+)
+
+
+def cached(kind: str):
+    """Декоратор для ``async def load_*(user_id)``: ответ берётся из кэша, если он там есть."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(user_id: int):
+            value = user_cache.get(user_id, kind)
+            if value is not _MISSING:
+                return value
+            generation = user_cache.generation(user_id, kind)
+            value = await func(user_id)
+            # запись, закончившаяся во время чтения, уже сбросила кэш: старый ответ не сохраняем
+            if user_cache.generation(user_id, kind) == generation:
+                user_cache.set(user_id, kind, value)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def invalidates(*kinds: str):
+    """Декоратор для функций записи ``async def f(user_id, ...)``: сбрасывает ``kinds`` пользователя."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(user_id: int, *args, **kwargs):
+            try:
+                return await func(user_id, *args, **kwargs)
+            finally:
+                user_cache.invalidate(user_id, *kinds)
+                log = invalidation_log.get()
+                if log is not None:
+                    log.append((user_id, kinds))
+
+        return wrapper
+
+    return decorator
@@ -6,3 +6,60 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 DATABASE_URL = os.getenv("DATABASE_URL", "")
 OWNER_CHAT_ID = int(os.getenv("OWNER_CHAT_ID", "0") or 0)
+
+# Кэш чтений bot.db: максимум записей (пользователь x вид данных) и время жизни, сек
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+
+# Рассылка напоминаний: одновременных отправок, сообщений в секунду всего,
+# и размер минутной корзины, начиная с которого отправки растягиваются на
+# REMINDER_SPREAD_SECONDS секунд
+REMINDER_CONCURRENCY = int(os.getenv("REMINDER_CONCURRENCY", "20"))
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", "25"))
+REMINDER_SPREAD_THRESHOLD = int(os.getenv("REMINDER_SPREAD_THRESHOLD", "100"))
+REMINDER_SPREAD_SECONDS = float(os.getenv("REMINDER_SPREAD_SECONDS", "50"))
+
+# Очередь исходящих вызовов Bot API: сообщений в секунду на бота и на чат,
+# запас токенов чата, размер очереди, число воркеров и повторов при ошибках
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "28"))
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = float(os.getenv("OUTBOX_CHAT_BURST", "5"))
+OUTBOX_MAXSIZE = int(os.getenv("OUTBOX_MAXSIZE", "5000"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "8"))
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))
+
+# Кэш готовых клавиатур списков задач: максимум записей и время жизни, сек
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "5000"))
+KEYBOARD_CACHE_TTL = float(os.getenv("KEYBOARD_CACHE_TTL", "600"))
+
+# Уровень логирования и адрес, на котором отдаются метрики Prometheus (порт 0 — не отдавать).
+# По умолчанию только localhost: метрики без авторизации, наружу их открывают явно
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100") or 0)
+
+# Одновременно обрабатываемых апдейтов (апдейты одного чата всё равно идут по очереди)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+# Webhook: если задан WEBHOOK_URL (публичный https-адрес), бот принимает апдейты
+# на WEBHOOK_LISTEN:WEBHOOK_PORT по пути WEBHOOK_PATH вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Сообщения бота, которые /start удаляет: сколько последних помнить в чате и
+# как часто, сек, дописывать новые в таблицу bot_messages
+TRACKED_MESSAGES_PER_CHAT = int(os.getenv("TRACKED_MESSAGES_PER_CHAT", "100"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "5"))
+
+# Хранение user_data/chat_data/диалогов в Postgres: как часто, сек, записывать
+# изменения и через сколько секунд без апдейтов выгружать данные из памяти
+PERSISTENCE_FLUSH_INTERVAL = float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", "5"))
+PERSISTENCE_IDLE_TTL = float(os.getenv("PERSISTENCE_IDLE_TTL", "3600"))
+
+# Архив выполненных задач: через сколько дней после выполнения задача уходит
+# из tasks в tasks_archive и сколько задач переносится одной транзакцией
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
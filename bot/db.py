@@ -1,232 +1,1335 @@
 from __future__ import annotations
 
-from typing import Any
+import asyncio
+import contextvars
+import logging
+import random
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Awaitable, Callable, TypeVar
 
-from sqlalchemy import delete, func, select
-from sqlalchemy.orm import Session
+from sqlalchemy import (
+    BigInteger, Select, Text, all_, and_, case, column, delete, false, func, literal, literal_column, or_, select,
+    text, true, tuple_, union_all, update, values,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from .cache import cached, invalidates, invalidation_log, user_cache
 from .config import OWNER_CHAT_ID
-from .db_orm.session import SessionLocal
-from .db_orm.models import Category, Setting, Tag, Task, TaskTag, User
+from .constants import TASKS_PER_PAGE
+from .db_orm.session import AsyncSessionLocal
+from .db_orm.models import (
+    SEARCH_CONFIG, BotMessage, BotState, Category, ConversationState, Setting, Tag, Task, TaskArchive, TaskTag, User,
+    UserTaskStats,
+)
 
+logger = logging.getLogger(__name__)
 
-def init_db():
+T = TypeVar("T")
+
+
+class TaskConflict(Exception):
+    """Задачи изменились с момента чтения: версия в базе не совпала с ожидаемой."""
+
+    def __init__(self, task_ids: list[int]):
+        super().__init__(f"Tasks changed concurrently: {task_ids}")
+        self.task_ids = task_ids
+
+
+async def init_db():
     """
     С миграциями Alembic эта функция больше не создает таблицы.
     Оставлена для совместимости: можно зарегистрировать OWNER, если задан.
     """
-    print("DEBUG: init_db (orm)")
+    logger.debug("init_db (orm)")
     if OWNER_CHAT_ID:
-        register_user(OWNER_CHAT_ID)
+        await register_user(OWNER_CHAT_ID)
+
+
+class _UnitOfWork:
+    __slots__ = ("owner", "session", "failed", "invalidated")
+
+    def __init__(self, owner: asyncio.Task | None):
+        self.owner = owner
+        self.session: AsyncSession | None = None
+        self.failed = False
+        self.invalidated: list[tuple[int, tuple[str, ...]]] = []
+
+
+_unit_of_work: contextvars.ContextVar[_UnitOfWork | None] = contextvars.ContextVar("unit_of_work", default=None)
+
+# итоги единиц работы для метрик
+uow_stats = {"committed": 0, "rolled_back": 0}
+
+
+class _SharedSession:
+    """Сессия единицы работы внутри ``async with _session()``.
+
+    ``commit()`` только отправляет изменения в базу: фиксируется транзакция
+    целиком в конце апдейта. Откатить можно лишь свою точку сохранения
+    (``savepoint=True``); без неё ``rollback()`` помечает апдейт неудавшимся.
+    """
+
+    def __init__(self, unit: _UnitOfWork, savepoint=None):
+        self._unit = unit
+        self._savepoint = savepoint
+
+    def __getattr__(self, name):
+        return getattr(self._unit.session, name)
+
+    async def commit(self):
+        if self._savepoint is not None and self._savepoint.is_active:
+            await self._savepoint.commit()
+        else:
+            await self._unit.session.flush()
+
+    async def rollback(self):
+        if self._savepoint is not None and self._savepoint.is_active:
+            await self._savepoint.rollback()
+        else:
+            self._unit.failed = True
+
+
+@asynccontextmanager
+async def _session(savepoint: bool = False) -> AsyncIterator[AsyncSession]:
+    """Сессия для одной функции bot.db.
+
+    Вне ``unit_of_work()`` — своя сессия и транзакция, как раньше. Внутри —
+    общая сессия апдейта; ``savepoint=True`` оборачивает блок в SAVEPOINT,
+    чтобы функция могла откатить свои изменения, не трогая остальные.
+    """
+    unit = _unit_of_work.get()
+    if unit is None or unit.owner is not asyncio.current_task():
+        # задачи, запущенные из апдейта, наследуют контекст, но делить с ними
+        # AsyncSession нельзя: она не рассчитана на параллельное использование
+        async with AsyncSessionLocal() as s:
+            yield s
+        return
+    if unit.session is None:
+        unit.session = AsyncSessionLocal()
+    nested = await unit.session.begin_nested() if savepoint else None
+    try:
+        yield _SharedSession(unit, nested)
+    except BaseException as exc:
+        if nested is not None and nested.is_active:
+            await nested.rollback()
+        elif isinstance(exc, DBAPIError):
+            # ошибка базы ломает транзакцию целиком: остаётся только откатить апдейт
+            unit.failed = True
+        raise
+    if nested is not None and nested.is_active:
+        await nested.commit()
+    await unit.session.flush()
+    # следующая функция должна читать строки заново, как из новой сессии
+    unit.session.expunge_all()
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[None]:
+    """Одна сессия и одна транзакция на все вызовы bot.db внутри блока.
+
+    Соединение берётся из пула при первом запросе и возвращается в конце
+    блока: транзакция фиксируется, если блок завершился без ошибки и не был
+    помечен ``mark_unit_of_work_failed()``, иначе откатывается. Сбросы кэша,
+    сделанные внутри, повторяются в конце: пока транзакция не зафиксирована,
+    в кэш могли попасть данные, которых в базе не будет или ещё нет.
+    Перед обращением к Bot API транзакцию закрывает ``commit_unit_of_work()``.
+    Вложенный вызов в той же задаче ничего не делает.
+    """
+    current = _unit_of_work.get()
+    task = asyncio.current_task()
+    if current is not None and current.owner is task:
+        yield
+        return
+    unit = _UnitOfWork(task)
+    token = _unit_of_work.set(unit)
+    log_token = invalidation_log.set(unit.invalidated)
+    try:
+        yield
+    except BaseException:
+        unit.failed = True
+        raise
+    finally:
+        _unit_of_work.reset(token)
+        invalidation_log.reset(log_token)
+        await _end_transaction(unit)
+
+
+async def _end_transaction(unit: _UnitOfWork):
+    """Фиксирует или откатывает транзакцию единицы работы, возвращает соединение и повторяет сбросы кэша."""
+    session, unit.session = unit.session, None
+    try:
+        if session is not None:
+            try:
+                if unit.failed:
+                    await session.rollback()
+                    uow_stats["rolled_back"] += 1
+                else:
+                    await session.commit()
+                    uow_stats["committed"] += 1
+            finally:
+                await session.close()
+    finally:
+        for user_id, kinds in unit.invalidated:
+            user_cache.invalidate(user_id, *kinds)
+        unit.invalidated.clear()
+
+
+async def commit_unit_of_work():
+    """Закрывает транзакцию текущего апдейта до обращения к Bot API.
+
+    Отправка может ждать лимитов Telegram и повторов десятки секунд; всё это
+    время открытая транзакция держала бы блокировки строк и соединение из
+    пула. Сделанное до отправки фиксируется (или откатывается, если апдейт
+    помечен неудавшимся), следующие запросы апдейта идут в новой транзакции.
+    Так и пользователь не получит «сохранено» раньше, чем запись зафиксирована.
+    Вне единицы работы и до первого запроса ничего не делает.
+    """
+    unit = _unit_of_work.get()
+    if unit is None or unit.owner is not asyncio.current_task() or unit.session is None:
+        return
+    await _end_transaction(unit)
 
 
-def _session() -> Session:
-    return SessionLocal()
+def mark_unit_of_work_failed():
+    """Откатить транзакцию текущего апдейта в конце ``unit_of_work()``."""
+    unit = _unit_of_work.get()
+    if unit is not None:
+        unit.failed = True
 
 
-def register_user(user_id: int, name: str | None = None):
+@invalidates("settings")
+async def register_user(user_id: int, name: str | None = None):
     """Ensure user exists and has default settings (no seed tasks/categories)."""
-    with _session() as s:
-        user = s.get(User, user_id)
+    async with _session() as s:
+        user = await s.get(User, user_id)
         if not user:
             s.add(User(user_id=user_id, name=name))
         elif name and not user.name:
             user.name = name
 
-        s.flush()  # важно: гарантирует, что user уже вставлен до settings
+        await s.flush()  # важно: гарантирует, что user уже вставлен до settings
 
         # default settings if missing
         existing = {
-            row.key for row in s.execute(
+            row.key for row in (await s.execute(
                 select(Setting.key).where(Setting.user_id == user_id)
-            ).all()
+            )).all()
         }
         if "reminder_time" not in existing:
             s.add(Setting(user_id=user_id, key="reminder_time", value="09:00"))
         if "notify_weekends" not in existing:
             s.add(Setting(user_id=user_id, key="notify_weekends", value="0"))
 
-        s.commit()
+        await s.commit()
 
 
-def get_all_users():
-    with _session() as s:
-        rows = s.execute(select(User.user_id)).all()
+async def get_all_users():
+    async with _session() as s:
+        rows = (await s.execute(select(User.user_id))).all()
         return [int(r[0]) for r in rows]
 
 
-def get_next_task_id(user_id: int) -> int:
-    with _session() as s:
-        return int(s.execute(text("SELECT nextval('tasks_id_seq')")).scalar_one())
+async def get_next_task_id(user_id: int) -> int:
+    async with _session() as s:
+        return int((await s.execute(text("SELECT nextval('tasks_id_seq')"))).scalar_one())
 
 
-def load_tasks(user_id: int):
-    print("DEBUG: load_tasks (orm)")
-    with _session() as s:
-        tasks = s.execute(
-            select(Task).where(Task.user_id == user_id).order_by(Task.id)
-        ).scalars().all()
-
-        # preload tags for each task
-        task_ids = [t.id for t in tasks]
-        tags_by_task: dict[int, list[str]] = {tid: [] for tid in task_ids}
-        if task_ids:
-            rows = s.execute(
-                select(TaskTag.task_id, TaskTag.tag).where(TaskTag.task_id.in_(task_ids))
-            ).all()
-            for task_id, tag in rows:
-                tags_by_task[int(task_id)].append(str(tag))
-
-        out: list[dict[str, Any]] = []
-        for t in tasks:
-            out.append(
-                {
-                    "id": int(t.id),
-                    "title": t.title,
-                    "category": t.category,
-                    "priority": t.priority,
-                    "done": bool(t.done),
-                    "comment": t.comment or "",
-                    "tags": tags_by_task.get(int(t.id), []),
-                }
+# виды кэша, которые зависят от задач и их тегов
+_TASK_CACHE_KINDS = ("tasks", "active_tags", "tags", "task_stats")
+# столбцы user_task_stats со счётчиками активных задач по приоритетам
+_PRIORITY_STATS = {"низкий": "active_low", "средний": "active_medium", "высокий": "active_high"}
+_STATS_COLUMNS = ("active", "done", *_PRIORITY_STATS.values())
+# 10 параметров на строку задачи: 5000 строк укладываются в лимит 65535 параметров Postgres
+_BULK_CHUNK = 5000
+# пользователей на один запрос при пакетной выборке дайджестов
+_COHORT_CHUNK = 1000
+_TASK_FIELDS = {"title", "category", "priority", "done", "comment"}
+# попыток retry_on_conflict, включая первую
+_CONFLICT_ATTEMPTS = 3
+
+
+def _task_to_dict(t: Task) -> dict[str, Any]:
+    return {
+        "id": int(t.id),
+        "title": t.title,
+        "category": t.category,
+        "priority": t.priority,
+        "done": bool(t.done),
+        "comment": t.comment or "",
+        "tags": list(t.tags or []),
+        "version": int(t.version),
+    }
+
+
+def _chunks(items: list, size: int | None = None):
+    size = size or _BULK_CHUNK
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _clean_tags(tags) -> list[str]:
+    out: list[str] = []
+    for tag in tags or []:
+        tag = str(tag).strip()
+        if tag and tag not in out:
+            out.append(tag)
+    return out
+
+
+# режимы фильтра по нескольким тегам: задача со всеми выбранными тегами или хотя бы с одним
+TAG_MODES = ("all", "any")
+
+
+def filter_tags(filters: dict[str, Any] | None) -> tuple[list[str], str]:
+    """Выбранные в фильтре теги и режим из ``TAG_MODES``.
+
+    Сохранённые до мультивыбора фильтры ``{"tag": ...}`` читаются как один тег.
+    """
+    filters = filters or {}
+    tags = list(filters.get("tags") or ([filters["tag"]] if filters.get("tag") else []))
+    mode = filters.get("tag_mode")
+    return tags, mode if mode in TAG_MODES else TAG_MODES[0]
+
+
+def _stats_change(user_id, done, priority, sign) -> Select:
+    """Задачи (до или после изменения), которые входят в счётчики со знаком ``sign``."""
+    return select(
+        user_id.label("user_id"), done.label("done"), priority.label("priority"), literal(sign).label("sign")
+    )
+
+
+def _update_task_stats(*changes: Select):
+    """INSERT ... ON CONFLICT, прибавляющий к user_task_stats разницу от ``changes``.
+
+    Изменения — строки ``_stats_change`` (обычно из RETURNING соседнего CTE).
+    Пользователи с нулевой разницей не затрагиваются: правка названия или
+    комментария не пишет и не блокирует строку счётчиков.
+    """
+    rows = (union_all(*changes) if len(changes) > 1 else changes[0]).subquery("changes")
+
+    def total(*conditions):
+        return func.sum(case((and_(*conditions), rows.c.sign), else_=0))
+
+    deltas = {
+        "active": total(~rows.c.done),
+        "done": total(rows.c.done),
+        **{
+            column_name: total(~rows.c.done, rows.c.priority == priority)
+            for priority, column_name in _PRIORITY_STATS.items()
+        },
+    }
+    stmt = pg_insert(UserTaskStats).from_select(
+        ["user_id", *deltas],
+        select(rows.c.user_id, *deltas.values())
+        .group_by(rows.c.user_id)
+        .having(or_(*(delta != 0 for delta in deltas.values()))),
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[UserTaskStats.user_id],
+        set_={name: getattr(UserTaskStats, name) + stmt.excluded[name] for name in deltas},
+    )
+
+
+def _stats_counter(filters: dict[str, Any] | None) -> str | None:
+    """Столбец user_task_stats с числом задач под ``filters`` или None, если счётчика нет."""
+    filters = filters or {}
+    if filters.get("category") or filter_tags(filters)[0]:
+        return None
+    if not filters.get("priority"):
+        return "active"
+    return _PRIORITY_STATS.get(filters["priority"])
+
+
+@cached("task_stats")
+async def load_task_stats(user_id: int) -> dict[str, int]:
+    """Счётчики задач пользователя: ``active``, ``done`` (вместе с архивом) и ``active_<приоритет>``."""
+    logger.debug("load_task_stats (orm)")
+    async with _session() as s:
+        row = (await s.execute(
+            select(*(getattr(UserTaskStats, name) for name in _STATS_COLUMNS))
+            .where(UserTaskStats.user_id == user_id)
+        )).one_or_none()
+    if row is None:
+        return dict.fromkeys(_STATS_COLUMNS, 0)
+    return {name: int(value) for name, value in row._mapping.items()}
+
+
+def _actual_task_stats(user_ids: list[int]) -> Select:
+    """Счётчики, пересчитанные по tasks и tasks_archive, для всех ``user_ids`` из users."""
+    active = Task.done.is_(False)
+    counts = (
+        select(
+            Task.user_id,
+            func.count().filter(active).label("active"),
+            func.count().filter(Task.done.is_(True)).label("done"),
+            *(
+                func.count().filter(active, Task.priority == priority).label(column_name)
+                for priority, column_name in _PRIORITY_STATS.items()
+            ),
+        )
+        .where(Task.user_id.in_(user_ids))
+        .group_by(Task.user_id)
+        .subquery("counts")
+    )
+    archived = (
+        select(TaskArchive.user_id, func.count().label("archived"))
+        .where(TaskArchive.user_id.in_(user_ids))
+        .group_by(TaskArchive.user_id)
+        .subquery("archived")
+    )
+    return (
+        select(
+            User.user_id,
+            func.coalesce(counts.c.active, 0),
+            func.coalesce(counts.c.done, 0) + func.coalesce(archived.c.archived, 0),
+            *(func.coalesce(counts.c[column_name], 0) for column_name in _PRIORITY_STATS.values()),
+        )
+        .outerjoin(counts, counts.c.user_id == User.user_id)
+        .outerjoin(archived, archived.c.user_id == User.user_id)
+        .where(User.user_id.in_(user_ids))
+    )
+
+
+async def repair_task_stats(user_ids: list[int] | None = None) -> int:
+    """Пересчитывает user_task_stats для ``user_ids`` (по умолчанию — всех) и чинит разошедшиеся строки.
+
+    Пользователи обходятся пачками по ``_COHORT_CHUNK``, каждая — в своей
+    транзакции. Строки счётчиков блокируются до пересчёта: запись задач,
+    начатая раньше, успевает закончиться, а начатая позже прибавит свою
+    разницу уже к исправленному значению. Возвращает число исправленных строк.
+    """
+    repaired = 0
+    last_id = None
+    while True:
+        async with _session() as s:
+            if user_ids is None:
+                query = select(User.user_id).order_by(User.user_id).limit(_COHORT_CHUNK)
+                if last_id is not None:
+                    query = query.where(User.user_id > last_id)
+                chunk = list((await s.execute(query)).scalars().all())
+            else:
+                chunk = list(user_ids[:_COHORT_CHUNK])
+                user_ids = user_ids[_COHORT_CHUNK:]
+            if not chunk:
+                break
+            last_id = chunk[-1]
+            await s.execute(
+                pg_insert(UserTaskStats)
+                .from_select(["user_id"], select(User.user_id).where(User.user_id.in_(chunk)))
+                .on_conflict_do_nothing()
+            )
+            await s.execute(
+                select(UserTaskStats.user_id).where(UserTaskStats.user_id.in_(chunk)).with_for_update()
             )
+            stmt = pg_insert(UserTaskStats).from_select(["user_id", *_STATS_COLUMNS], _actual_task_stats(chunk))
+            stored = tuple_(*(getattr(UserTaskStats, name) for name in _STATS_COLUMNS))
+            actual = tuple_(*(stmt.excluded[name] for name in _STATS_COLUMNS))
+            fixed = (await s.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[UserTaskStats.user_id],
+                    set_={name: stmt.excluded[name] for name in _STATS_COLUMNS},
+                    where=stored.is_distinct_from(actual),
+                ).returning(UserTaskStats.user_id)
+            )).scalars().all()
+            await s.commit()
+        for user_id in fixed:
+            # "tasks" меняет версию пользователя: готовые списки в task_list_cache
+            # несут итоги из счётчиков и тоже устарели
+            user_cache.invalidate(int(user_id), "tasks", "task_stats")
+        repaired += len(fixed)
+    logger.debug("repair_task_stats -> %s rows", repaired)
+    return repaired
+
+
+@cached("tasks")
+async def load_tasks(user_id: int):
+    logger.debug("load_tasks (orm)")
+    async with _session() as s:
+        tasks = (await s.execute(
+            select(Task).where(Task.user_id == user_id).order_by(Task.id)
+        )).scalars().all()
+        out = [_task_to_dict(t) for t in tasks]
 
-    print(f"DEBUG: load_tasks -> {len(out)} tasks")
+    logger.debug("load_tasks -> %s tasks", len(out))
     if not out:
-        print("WARNING: load_tasks returned empty list")
+        logger.debug("load_tasks returned empty list")
     return out
 
 
-def save_tasks(user_id: int, tasks: list[dict[str, Any]]):
-    print("DEBUG: save_tasks (orm, sync)")
-    with _session() as s:
-        # 1) какие задачи уже есть у пользователя
-        existing_ids = set(
-            s.execute(select(Task.id).where(Task.user_id == user_id)).scalars().all()
-        )
+def _filter_conditions(filters: dict[str, Any] | None) -> dict[str, list]:
+    """Условия фильтров по видам: {"category": [...], "priority": [...], "tags": [...]}."""
+    filters = filters or {}
+    conditions: dict[str, list] = {"category": [], "priority": [], "tags": []}
+    if filters.get("category"):
+        conditions["category"].append(Task.category == filters["category"])
+    if filters.get("priority"):
+        conditions["priority"].append(Task.priority == filters["priority"])
+    tags, mode = filter_tags(filters)
+    if tags:
+        # один предикат по GIN-индексу tasks.tags: @> для "all", && для "any"
+        conditions["tags"].append(Task.tags.overlap(tags) if mode == "any" else Task.tags.contains(tags))
+    return conditions
+
+
+def _active_task_conditions(user_id: int, filters: dict[str, Any] | None) -> list:
+    conditions = [Task.user_id == user_id, Task.done.is_(False)]
+    for group in _filter_conditions(filters).values():
+        conditions.extend(group)
+    return conditions
+
+
+async def load_tasks_page(
+    user_id: int,
+    filters: dict[str, Any] | None = None,
+    after_id: int | None = None,
+    before_id: int | None = None,
+    limit: int = TASKS_PER_PAGE,
+    from_end: bool = False,
+) -> tuple[list[dict[str, Any]], int]:
+    """Страница активных задач по keyset-курсору и общее число подходящих задач.
+
+    ``after_id`` — задачи с id больше курсора (вперёд), ``before_id`` — ``limit``
+    задач перед курсором (назад), ``from_end`` — последние ``limit`` задач.
+    Фильтры ``category``/``priority``/``tags`` (см. ``filter_tags``) применяются в SQL.
+    Без фильтров и с одним приоритетом общее число берётся из user_task_stats.
+    """
+    logger.debug("load_tasks_page (orm) after=%s before=%s from_end=%s", after_id, before_id, from_end)
+    conditions = _active_task_conditions(user_id, filters)
+    descending = before_id is not None or from_end
+    page_query = select(Task).where(*conditions)
+    if after_id is not None:
+        page_query = page_query.where(Task.id > after_id)
+    if before_id is not None:
+        page_query = page_query.where(Task.id < before_id)
+    page_query = page_query.order_by(Task.id.desc() if descending else Task.id).limit(limit)
+    counter = _stats_counter(filters)
+    async with _session() as s:
+        tasks = list((await s.execute(page_query)).scalars().all())
+        if descending:
+            tasks.reverse()
+        if counter is None:
+            total = int((await s.execute(
+                select(func.count()).select_from(Task).where(*conditions)
+            )).scalar_one())
+        out = [_task_to_dict(t) for t in tasks]
+    if counter is not None:
+        total = (await load_task_stats(user_id))[counter]
+    logger.debug("load_tasks_page -> %s of %s tasks", len(out), total)
+    return out, total
+
+
+async def search_tasks(
+    user_id: int, query: str, limit: int = TASKS_PER_PAGE, offset: int = 0
+) -> tuple[list[dict[str, Any]], int]:
+    """Страница задач, найденных по названию и комментарию, и общее число найденных.
+
+    ``query`` разбирается ``websearch_to_tsquery``: слова, "фразы", ``or`` и
+    ``-исключение``. Ищутся и выполненные задачи: комментарий пишется при
+    выполнении, так что иначе он был бы в поиске бесполезен. Активные идут
+    первыми, дальше по релевантности (совпадения в названии важнее) и id.
+    Один запрос вместе с общим числом. Архив (tasks_archive) не ищется: там
+    задачи, выполненные давно, а индекс пришлось бы держать на таблице,
+    которая только растёт.
+    """
+    logger.debug("search_tasks (orm) %r offset=%s", query, offset)
+    ts_query = func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'::regconfig"), query)
+    rank = func.ts_rank_cd(Task.search_vector, ts_query)
+    stmt = (
+        select(Task, func.count().over().label("total"))
+        .where(Task.user_id == user_id, Task.search_vector.op("@@")(ts_query))
+        .order_by(Task.done, rank.desc(), Task.id)
+        .limit(limit)
+        .offset(offset)
+    )
+    async with _session() as s:
+        rows = (await s.execute(stmt)).all()
+        out = [_task_to_dict(row.Task) for row in rows]
+    total = int(rows[0].total) if rows else 0
+    logger.debug("search_tasks -> %s of %s tasks", len(out), total)
+    return out, total
+
+
+async def load_digest_pages(
+    user_ids: list[int], limit: int = TASKS_PER_PAGE
+) -> dict[int, tuple[list[dict[str, Any]], int]]:
+    """Первые ``limit`` активных задач и их общее число для группы пользователей.
+
+    Возвращает ``{user_id: (tasks, total)}`` только для зарегистрированных
+    пользователей. На каждые ``_COHORT_CHUNK`` пользователей — два запроса:
+    пользователи и страницы задач (оконная функция); общее число — из user_task_stats.
+    """
+    logger.debug("load_digest_pages (orm) %s users", len(user_ids))
+    out: dict[int, tuple[list[dict[str, Any]], int]] = {}
+    async with _session() as s:
+        for chunk in _chunks(list(user_ids), _COHORT_CHUNK):
+            registered = (await s.execute(
+                select(User.user_id).where(User.user_id.in_(chunk))
+            )).scalars().all()
+            for user_id in registered:
+                out[int(user_id)] = ([], 0)
+            if not registered:
+                continue
+            ranked = select(
+                Task.id, Task.user_id, Task.title, Task.category, Task.priority, Task.done, Task.comment, Task.version,
+                Task.tags,
+                func.row_number().over(partition_by=Task.user_id, order_by=Task.id).label("rn"),
+            ).where(Task.user_id.in_(registered), Task.done.is_(False)).subquery()
+            rows = (await s.execute(
+                select(ranked, UserTaskStats.active.label("total"))
+                .outerjoin(UserTaskStats, UserTaskStats.user_id == ranked.c.user_id)
+                .where(ranked.c.rn <= limit)
+                .order_by(ranked.c.user_id, ranked.c.id)
+            )).all()
+            for row in rows:
+                tasks, _ = out[int(row.user_id)]
+                tasks.append(_task_to_dict(row))
+                out[int(row.user_id)] = (tasks, int(row.total or 0))
+    return out
+
 
-        incoming_ids: set[int] = set()
+@invalidates(*_TASK_CACHE_KINDS)
+async def save_tasks(user_id: int, tasks: list[dict[str, Any]]):
+    """Полная синхронизация списка задач пользователя набором операций.
 
-        # 2) upsert задач
+    Задачи upsert-ятся многострочными INSERT ... ON CONFLICT (id) DO UPDATE,
+    для task_tags вставляются и удаляются только изменившиеся пары, а задачи,
+    которых нет в ``tasks``, удаляются; user_task_stats получает разницу одним
+    запросом. Число запросов не зависит от числа задач (с точностью до пачек
+    по ``_BULK_CHUNK`` строк).
+
+    Задача с ключом ``version`` перезаписывается, только если её версия в базе
+    не изменилась; иначе транзакция откатывается с ``TaskConflict``. После
+    сохранения ``id`` и ``version`` в словарях ``tasks`` обновляются.
+    """
+    logger.debug("save_tasks (orm)")
+    async with _session(savepoint=True) as s:
+        # 1) id для задач без id — одним запросом к sequence
+        missing = [t for t in tasks if t.get("id") is None]
+        if missing:
+            new_ids = (await s.execute(
+                text("SELECT nextval('tasks_id_seq') FROM generate_series(1, :n)"), {"n": len(missing)}
+            )).scalars().all()
+            for t, task_id in zip(missing, new_ids):
+                t["id"] = int(task_id)
+
+        # 2) текущее состояние: задачи пользователя, их версии, теги и то, что входит в счётчики, одним запросом
+        existing_versions: dict[int, int] = {}
+        existing_pairs: set[tuple[int, str]] = set()
+        existing_counted: dict[int, tuple[bool, str | None]] = {}
+        for task_id, version, tags, done, priority in (await s.execute(
+            select(Task.id, Task.version, Task.tags, Task.done, Task.priority).where(Task.user_id == user_id)
+        )).all():
+            existing_versions[int(task_id)] = int(version)
+            existing_pairs.update((int(task_id), str(tag)) for tag in tags or [])
+            existing_counted[int(task_id)] = (bool(done), priority)
+        existing_ids = set(existing_versions)
+
+        rows: dict[int, dict[str, Any]] = {}
+        wanted_tags: dict[int, list[str]] = {}
+        versioned: set[int] = set()
+        now = datetime.now(timezone.utc)
         for t in tasks:
-            task_id = t.get("id")
-            if task_id is None:
-                # если когда-то встретится None — получим id из sequence
-                task_id = int(s.execute(text("SELECT nextval('tasks_id_seq')")).scalar_one())
-                t["id"] = task_id
-            task_id = int(task_id)
-            incoming_ids.add(task_id)
-
-            if task_id in existing_ids:
-                # update
-                obj = s.get(Task, task_id)
-                if obj and obj.user_id == user_id:
-                    obj.title = t["title"]
-                    obj.category = t.get("category")
-                    obj.priority = t.get("priority")
-                    obj.done = bool(t.get("done", False))
-                    obj.comment = t.get("comment", "") or ""
-            else:
-                # insert
-                s.add(Task(
-                    id=task_id,
-                    user_id=user_id,
-                    title=t["title"],
-                    category=t.get("category"),
-                    priority=t.get("priority"),
-                    done=bool(t.get("done", False)),
-                    comment=t.get("comment", "") or "",
-                ))
-
-            # 3) теги: для простоты чистим и вставляем заново только для этой задачи
-            s.execute(delete(TaskTag).where(TaskTag.task_id == task_id))
-            for tag in (t.get("tags") or []):
-                tag = str(tag).strip()
-                if not tag:
-                    continue
-                s.merge(Tag(user_id=user_id, name=tag))
-                s.add(TaskTag(task_id=task_id, tag=tag))
-
-        # 4) delete только удалённые задачи
-        to_delete = existing_ids - incoming_ids
-        if to_delete:
-            s.execute(delete(Task).where(Task.user_id == user_id, Task.id.in_(to_delete)))
-
-        s.commit()
-
-
-def load_categories(user_id: int):
-    print("DEBUG: load_categories (orm)")
-    with _session() as s:
-        rows = s.execute(
+            task_id = int(t["id"])
+            # без версии задача перезаписывается безусловно (по текущей версии в базе)
+            version = t.get("version")
+            if version is not None:
+                versioned.add(task_id)
+            rows[task_id] = {
+                "id": task_id,
+                "user_id": user_id,
+                "title": t["title"],
+                "category": t.get("category"),
+                "priority": t.get("priority"),
+                "done": bool(t.get("done", False)),
+                "comment": t.get("comment", "") or "",
+                "version": int(version) if version is not None else existing_versions.get(task_id, 1),
+                "completed_at": now if t.get("done") else None,
+                "tags": _clean_tags(t.get("tags")),
+            }
+            wanted_tags[task_id] = rows[task_id]["tags"]
+        # задача из снимка, удалённая с момента чтения, не должна воскреснуть
+        vanished = sorted(versioned - existing_ids)
+        if vanished:
+            raise TaskConflict(vanished)
+
+        # 3) upsert задач; чужие id и задачи с устаревшей версией не перезаписываются
+        # и не попадают в owned_ids
+        owned_ids: set[int] = set()
+        for chunk in _chunks(list(rows.values())):
+            stmt = pg_insert(Task).values(chunk)
+            set_ = {col: stmt.excluded[col] for col in ("title", "category", "priority", "done", "comment", "tags")}
+            set_["version"] = Task.version + 1
+            # уже выполненная задача сохраняет время выполнения
+            set_["completed_at"] = case(
+                (stmt.excluded.done, func.coalesce(Task.completed_at, stmt.excluded.completed_at)), else_=None
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Task.id],
+                set_=set_,
+                where=(Task.user_id == stmt.excluded.user_id) & (Task.version == stmt.excluded.version),
+            ).returning(Task.id)
+            owned_ids.update(int(task_id) for task_id in (await s.execute(stmt)).scalars())
+        conflicts = sorted((set(rows) & existing_ids) - owned_ids)
+        if conflicts:
+            await s.rollback()
+            raise TaskConflict(conflicts)
+
+        # 4) справочник тегов
+        tag_names = sorted({tag for task_id in owned_ids for tag in wanted_tags[task_id]})
+        for chunk in _chunks([{"user_id": user_id, "name": tag} for tag in tag_names]):
+            await s.execute(pg_insert(Tag).values(chunk).on_conflict_do_nothing())
+
+        # 5) task_tags: только разница между текущим и желаемым состоянием
+        wanted_pairs = {(task_id, tag) for task_id in owned_ids for tag in wanted_tags[task_id]}
+        removed_pairs = {pair for pair in existing_pairs - wanted_pairs if pair[0] in owned_ids}
+        for chunk in _chunks(sorted(removed_pairs)):
+            await s.execute(delete(TaskTag).where(tuple_(TaskTag.task_id, TaskTag.tag).in_(chunk)))
+        for chunk in _chunks([{"task_id": task_id, "tag": tag} for task_id, tag in sorted(wanted_pairs - existing_pairs)]):
+            await s.execute(pg_insert(TaskTag).values(chunk).on_conflict_do_nothing())
+
+        # 6) delete только удалённые задачи (их теги уйдут каскадом)
+        # разница для счётчиков: (done, priority) -> сколько задач прибавилось
+        counted: dict[tuple[bool, str | None], int] = {}
+        for chunk in _chunks(sorted(existing_ids - set(rows))):
+            for done, priority in (await s.execute(
+                delete(Task).where(Task.user_id == user_id, Task.id.in_(chunk)).returning(Task.done, Task.priority)
+            )).all():
+                counted[(bool(done), priority)] = counted.get((bool(done), priority), 0) - 1
+
+        # 7) счётчики: записанные задачи минус их прежнее состояние (версия не
+        # менялась с шага 2, значит, и done/priority те же)
+        for task_id in owned_ids:
+            if task_id in existing_counted:
+                counted[existing_counted[task_id]] = counted.get(existing_counted[task_id], 0) - 1
+            key = (rows[task_id]["done"], rows[task_id]["priority"])
+            counted[key] = counted.get(key, 0) + 1
+        changes = [
+            _stats_change(literal(user_id, BigInteger), literal(done), literal(priority, Text), n)
+            for (done, priority), n in counted.items()
+            if n
+        ]
+        if changes:
+            await s.execute(_update_task_stats(*changes))
+
+        await s.commit()
+
+    for t in tasks:
+        task_id = int(t["id"])
+        if task_id in owned_ids:
+            t["version"] = rows[task_id]["version"] + (task_id in existing_ids)
+
+
+async def retry_on_conflict(operation: Callable[[], Awaitable[T]], attempts: int = _CONFLICT_ATTEMPTS) -> T:
+    """Повторяет ``operation()`` при ``TaskConflict``.
+
+    Операция должна сама перечитывать задачи: после конфликта кэш пользователя
+    уже сброшен, и повторное чтение вернёт свежие версии.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await operation()
+        except TaskConflict as exc:
+            if attempt == attempts:
+                raise
+            logger.info("Task version conflict on %s, retry %d/%d", exc.task_ids, attempt, attempts - 1)
+            # небольшой случайный сдвиг, чтобы конкурирующие записи не столкнулись снова
+            await asyncio.sleep(random.uniform(0, 0.05 * attempt))
+
+
+async def get_task(user_id: int, task_id: int) -> dict[str, Any] | None:
+    """Одна задача пользователя с тегами или None, если её нет."""
+    logger.debug("get_task (orm) %s", task_id)
+    async with _session() as s:
+        task = (await s.execute(
+            select(Task).where(Task.id == task_id, Task.user_id == user_id)
+        )).scalar_one_or_none()
+        if task is None:
+            return None
+        return _task_to_dict(task)
+
+
+@invalidates(*_TASK_CACHE_KINDS)
+async def create_task(
+    user_id: int,
+    title: str,
+    category: str | None = None,
+    priority: str | None = None,
+    tags: list[str] | None = None,
+) -> int:
+    """Добавляет задачу с тегами одной транзакцией и возвращает её id; счётчики меняются тем же запросом."""
+    logger.debug("create_task (orm)")
+    tags = _clean_tags(tags)
+    created = (
+        pg_insert(Task)
+        .values(user_id=user_id, title=title, category=category, priority=priority, done=False, comment="", tags=tags)
+        .returning(Task.id, Task.user_id, Task.done, Task.priority)
+        .cte("created")
+    )
+    counted = _update_task_stats(
+        _stats_change(created.c.user_id, created.c.done, created.c.priority, 1)
+    ).cte("counted")
+    async with _session() as s:
+        task_id = int((await s.execute(select(created.c.id).add_cte(counted))).scalar_one())
+        if tags:
+            await s.execute(
+                pg_insert(Tag).values([{"user_id": user_id, "name": tag} for tag in tags]).on_conflict_do_nothing()
+            )
+            await s.execute(pg_insert(TaskTag).values([{"task_id": task_id, "tag": tag} for tag in tags]))
+        await s.commit()
+    return task_id
+
+
+async def _raise_if_exists(s: AsyncSession, user_id: int, task_id: int, model=Task):
+    """После условной записи, не задевшей строк: задача есть — значит, версия устарела."""
+    found = (await s.execute(
+        select(model.id).where(model.id == task_id, model.user_id == user_id)
+    )).scalar_one_or_none()
+    if found is not None:
+        raise TaskConflict([task_id])
+
+
+@invalidates(*_TASK_CACHE_KINDS)
+async def update_task_fields(user_id: int, task_id: int, expected_version: int | None = None, **fields: Any) -> bool:
+    """Точечный UPDATE одной задачи. Возвращает False, если задача не найдена.
+
+    С ``expected_version`` запись проходит, только если версия не менялась,
+    иначе — ``TaskConflict``.
+    """
+    logger.debug("update_task_fields (orm) %s %s", task_id, sorted(fields))
+    unknown = set(fields) - _TASK_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown task fields: {', '.join(sorted(unknown))}")
+    if not fields:
+        return False
+    conditions = [Task.id == task_id, Task.user_id == user_id]
+    if expected_version is not None:
+        conditions.append(Task.version == expected_version)
+    values_ = dict(fields, version=Task.version + 1)
+    if "done" in fields:
+        values_["completed_at"] = func.coalesce(Task.completed_at, func.now()) if fields["done"] else None
+    # прежние done и priority нужны счётчикам; FOR UPDATE — чтобы прочитать их
+    # после конкурирующей записи, а не из снимка
+    old = select(Task.id, Task.done, Task.priority).where(*conditions).with_for_update().subquery("old")
+    updated = (
+        update(Task)
+        .where(Task.id == old.c.id)
+        .values(**values_)
+        .returning(
+            Task.user_id, Task.done, Task.priority, old.c.done.label("old_done"), old.c.priority.label("old_priority"),
+        )
+        .cte("updated")
+    )
+    counted = _update_task_stats(
+        _stats_change(updated.c.user_id, updated.c.old_done, updated.c.old_priority, -1),
+        _stats_change(updated.c.user_id, updated.c.done, updated.c.priority, 1),
+    ).cte("counted")
+    async with _session() as s:
+        rowcount = (await s.execute(select(func.count()).select_from(updated).add_cte(counted))).scalar_one()
+        if not rowcount and expected_version is not None:
+            await _raise_if_exists(s, user_id, task_id)
+        await s.commit()
+    return rowcount > 0
+
+
+async def complete_task(user_id: int, task_id: int, comment: str, expected_version: int | None = None) -> bool:
+    return await update_task_fields(user_id, task_id, expected_version, done=True, comment=comment or "")
+
+
+async def restore_task(user_id: int, task_id: int, expected_version: int | None = None) -> bool:
+    """Снимает отметку о выполнении; задача из архива возвращается в tasks."""
+    return (
+        await update_task_fields(user_id, task_id, expected_version, done=False)
+        or await unarchive_task(user_id, task_id, expected_version)
+    )
+
+
+async def load_completed_page(
+    user_id: int,
+    after: tuple[datetime, int] | None = None,
+    before: tuple[datetime, int] | None = None,
+    limit: int = TASKS_PER_PAGE,
+) -> tuple[list[dict[str, Any]], int]:
+    """Страница выполненных задач из tasks и tasks_archive и их общее число.
+
+    Задачи идут от недавно выполненных к давним; курсор — ``(completed_at, id)``
+    последней (``after``) или первой (``before``) задачи соседней страницы.
+    Из каждой таблицы по индексу читается не больше ``limit`` строк, теги
+    подтягиваются только для задач страницы; общее число — из user_task_stats.
+    """
+    logger.debug("load_completed_page (orm) after=%s before=%s", after, before)
+    keys = []
+    for model, archived in ((Task, False), (TaskArchive, True)):
+        query = select(model.id, model.completed_at, literal(archived).label("archived")).where(model.user_id == user_id)
+        if model is Task:
+            query = query.where(Task.done.is_(True))
+        key = tuple_(model.completed_at, model.id)
+        if after is not None:
+            query = query.where(key < tuple_(*after))
+        if before is not None:
+            query = query.where(key > tuple_(*before)).order_by(model.completed_at, model.id)
+        else:
+            query = query.order_by(model.completed_at.desc(), model.id.desc())
+        keys.append(select(query.limit(limit).subquery()))
+    page = union_all(*keys).subquery("page")
+    order = (page.c.completed_at, page.c.id) if before is not None else (page.c.completed_at.desc(), page.c.id.desc())
+    page_query = (
+        select(
+            page.c.id,
+            page.c.completed_at,
+            page.c.archived,
+            func.coalesce(Task.title, TaskArchive.title).label("title"),
+            func.coalesce(Task.category, TaskArchive.category).label("category"),
+            func.coalesce(Task.priority, TaskArchive.priority).label("priority"),
+            func.coalesce(Task.comment, TaskArchive.comment).label("comment"),
+            func.coalesce(Task.version, TaskArchive.version).label("version"),
+            func.coalesce(Task.tags, TaskArchive.tags).label("tags"),
+        )
+        .select_from(page)
+        .outerjoin(Task, (Task.id == page.c.id) & ~page.c.archived)
+        .outerjoin(TaskArchive, (TaskArchive.id == page.c.id) & page.c.archived)
+        .order_by(*order)
+        .limit(limit)
+    )
+    async with _session() as s:
+        rows = (await s.execute(page_query)).all()
+    total = (await load_task_stats(user_id))["done"]
+    if before is not None:
+        rows.reverse()
+    out = [
+        {
+            "id": int(row.id),
+            "title": row.title,
+            "category": row.category,
+            "priority": row.priority,
+            "done": True,
+            "comment": row.comment or "",
+            "tags": [str(tag) for tag in row.tags or []],
+            "version": int(row.version),
+            "completed_at": row.completed_at,
+            "archived": bool(row.archived),
+        }
+        for row in rows
+    ]
+    logger.debug("load_completed_page -> %s of %s tasks", len(out), total)
+    return out, total
+
+
+async def archive_completed_tasks(older_than: timedelta, batch_size: int) -> int:
+    """Переносит задачи, выполненные больше ``older_than`` назад, из tasks в tasks_archive.
+
+    Пачка из ``batch_size`` задач переносится одним запросом (DELETE ... RETURNING
+    внутри INSERT ... SELECT) в своей транзакции, так что блокировки держатся
+    недолго; строки, занятые другими транзакциями, пропускаются до следующего
+    запуска. Возвращает число перенесённых задач.
+    """
+    cutoff = datetime.now(timezone.utc) - older_than
+    archived = 0
+    while True:
+        expired = (
+            select(Task.id)
+            .where(Task.done.is_(True), Task.completed_at < cutoff)
+            .order_by(Task.completed_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        # строки task_tags уйдут каскадом; теги переезжают из tasks.tags
+        moved = (
+            delete(Task)
+            .where(Task.id.in_(expired))
+            .returning(
+                Task.id, Task.user_id, Task.title, Task.category, Task.priority, Task.comment,
+                Task.version, Task.completed_at, Task.tags,
+            )
+            .cte("moved")
+        )
+        stmt = (
+            pg_insert(TaskArchive)
+            .from_select(
+                ["id", "user_id", "title", "category", "priority", "comment", "version", "completed_at", "tags"],
+                select(
+                    moved.c.id, moved.c.user_id, moved.c.title, moved.c.category, moved.c.priority,
+                    moved.c.comment, moved.c.version, moved.c.completed_at, moved.c.tags,
+                ),
+            )
+            .returning(TaskArchive.user_id)
+        )
+        async with _session() as s:
+            user_ids = (await s.execute(stmt)).scalars().all()
+            await s.commit()
+        for user_id in set(user_ids):
+            user_cache.invalidate(int(user_id), *_TASK_CACHE_KINDS)
+        archived += len(user_ids)
+        if len(user_ids) < batch_size:
+            break
+        # между пачками отдаём цикл событий обработчикам апдейтов
+        await asyncio.sleep(0)
+    logger.debug("archive_completed_tasks -> %s tasks", archived)
+    return archived
+
+
+@invalidates(*_TASK_CACHE_KINDS)
+async def unarchive_task(user_id: int, task_id: int, expected_version: int | None = None) -> bool:
+    """Возвращает задачу из архива в tasks невыполненной, одним запросом. False — её нет в архиве."""
+    logger.debug("unarchive_task (orm) %s", task_id)
+    conditions = [TaskArchive.id == task_id, TaskArchive.user_id == user_id]
+    if expected_version is not None:
+        conditions.append(TaskArchive.version == expected_version)
+    moved = (
+        delete(TaskArchive)
+        .where(*conditions)
+        .returning(
+            TaskArchive.id, TaskArchive.user_id, TaskArchive.title, TaskArchive.category, TaskArchive.priority,
+            TaskArchive.comment, TaskArchive.version, TaskArchive.tags,
+        )
+        .cte("moved")
+    )
+    restored = (
+        pg_insert(Task)
+        .from_select(
+            ["id", "user_id", "title", "category", "priority", "done", "comment", "version", "tags"],
+            select(
+                moved.c.id, moved.c.user_id, moved.c.title, moved.c.category, moved.c.priority,
+                literal(False), moved.c.comment, moved.c.version + 1, moved.c.tags,
+            ),
+        )
+        .returning(Task.id, Task.user_id, Task.priority)
+        .cte("restored")
+    )
+    # из выполненных (архив считается в done) в активные
+    counted = _update_task_stats(
+        _stats_change(restored.c.user_id, true(), restored.c.priority, -1),
+        _stats_change(restored.c.user_id, false(), restored.c.priority, 1),
+    ).cte("counted")
+    tagged = (
+        pg_insert(TaskTag)
+        .from_select(["task_id", "tag"], select(moved.c.id, func.unnest(moved.c.tags)))
+        .cte("tagged")
+    )
+    async with _session() as s:
+        restored_id = (await s.execute(select(restored.c.id).add_cte(tagged, counted))).scalar_one_or_none()
+        if restored_id is None and expected_version is not None:
+            await _raise_if_exists(s, user_id, task_id, TaskArchive)
+        await s.commit()
+    return restored_id is not None
+
+
+@invalidates(*_TASK_CACHE_KINDS)
+async def delete_task(user_id: int, task_id: int, expected_version: int | None = None) -> bool:
+    logger.debug("delete_task (orm) %s", task_id)
+    conditions = [Task.id == task_id, Task.user_id == user_id]
+    if expected_version is not None:
+        conditions.append(Task.version == expected_version)
+    # task_tags удалятся каскадом по внешнему ключу
+    deleted = delete(Task).where(*conditions).returning(Task.user_id, Task.done, Task.priority).cte("deleted")
+    counted = _update_task_stats(
+        _stats_change(deleted.c.user_id, deleted.c.done, deleted.c.priority, -1)
+    ).cte("counted")
+    async with _session() as s:
+        rowcount = (await s.execute(select(func.count()).select_from(deleted).add_cte(counted))).scalar_one()
+        if not rowcount and expected_version is not None:
+            await _raise_if_exists(s, user_id, task_id)
+        await s.commit()
+    return rowcount > 0
+
+
+@invalidates(*_TASK_CACHE_KINDS)
+async def add_task_tags(user_id: int, task_id: int, tags: list[str], expected_version: int | None = None) -> bool:
+    """Добавляет теги к задаче, не трогая уже назначенные. False — задача не найдена.
+
+    С ``expected_version`` теги добавляются, только если версия не менялась,
+    иначе — ``TaskConflict``.
+    """
+    logger.debug("add_task_tags (orm) %s", task_id)
+    tags = _clean_tags(tags)
+    if not tags:
+        return False
+    conditions = [Task.id == task_id, Task.user_id == user_id]
+    if expected_version is not None:
+        conditions.append(Task.version == expected_version)
+    new_tags = values(column("tag", Text), name="new_tags").data([(tag,) for tag in tags])
+    async with _session() as s:
+        # вставляем пары только если задача принадлежит пользователю; в том же
+        # запросе поднимаем версию задачи, чтобы записи по старому снимку её не затёрли,
+        # и дописываем новые теги в tasks.tags
+        added = select(new_tags.c.tag).where(new_tags.c.tag != all_(Task.tags)).scalar_subquery()
+        bumped = (
+            update(Task)
+            .where(*conditions)
+            .values(version=Task.version + 1, tags=func.array_cat(Task.tags, func.array(added)))
+            .returning(Task.id)
+            .cte("bumped")
+        )
+        tagged = (
+            pg_insert(TaskTag)
+            .from_select(
+                ["task_id", "tag"],
+                select(bumped.c.id, new_tags.c.tag).join(new_tags, literal(True)),
+            )
+            .on_conflict_do_nothing()
+            .cte("tagged")
+        )
+        found = (await s.execute(select(func.count()).select_from(bumped).add_cte(tagged))).scalar_one()
+        if not found:
+            if expected_version is not None:
+                await _raise_if_exists(s, user_id, task_id)
+            return False
+        # справочник тегов пополняем, только когда версия сошлась: при конфликте
+        # в транзакции апдейта не остаётся тегов, которых ни у одной задачи нет
+        await s.execute(
+            pg_insert(Tag).values([{"user_id": user_id, "name": tag} for tag in tags]).on_conflict_do_nothing()
+        )
+        await s.commit()
+    return True
+
+
+@cached("categories")
+async def load_categories(user_id: int):
+    logger.debug("load_categories (orm)")
+    async with _session() as s:
+        rows = (await s.execute(
             select(Category.name).where(Category.user_id == user_id).order_by(Category.name)
-        ).all()
+        )).all()
         categories = [r[0] for r in rows]
-    print(f"DEBUG: load_categories -> {len(categories)} categories")
+    logger.debug("load_categories -> %s categories", len(categories))
     if not categories:
-        print("WARNING: load_categories returned empty list")
+        logger.debug("load_categories returned empty list")
     return categories
 
 
-def save_categories(user_id: int, categories: list[str]):
-    print("DEBUG: save_categories (orm)")
-    with _session() as s:
-        s.execute(delete(Category).where(Category.user_id == user_id))
+@invalidates("categories")
+async def save_categories(user_id: int, categories: list[str]):
+    logger.debug("save_categories (orm)")
+    async with _session() as s:
+        await s.execute(delete(Category).where(Category.user_id == user_id))
         for name in categories:
             name = str(name).strip()
             if name:
                 s.add(Category(user_id=user_id, name=name))
-        s.commit()
+        await s.commit()
 
 
-def load_tags(user_id: int):
-    print("DEBUG: load_tags (orm)")
-    with _session() as s:
-        rows = s.execute(
+@cached("tags")
+async def load_tags(user_id: int):
+    logger.debug("load_tags (orm)")
+    async with _session() as s:
+        rows = (await s.execute(
             select(Tag.name).where(Tag.user_id == user_id).order_by(Tag.name)
-        ).all()
+        )).all()
         tags = [r[0] for r in rows]
-    print(f"DEBUG: load_tags -> {len(tags)} tags")
+    logger.debug("load_tags -> %s tags", len(tags))
     if not tags:
-        print("WARNING: load_tags returned empty list")
+        logger.debug("load_tags returned empty list")
     return tags
 
 
-def load_active_tags(user_id: int):
-    print("DEBUG: load_active_tags (orm)")
-    with _session() as s:
-        rows = s.execute(
-            select(func.distinct(TaskTag.tag))
-            .join(Task, Task.id == TaskTag.task_id)
-            .where(Task.user_id == user_id, Task.done.is_(False))
-            .order_by(TaskTag.tag)
-        ).all()
+@cached("active_tags")
+async def load_active_tags(user_id: int):
+    logger.debug("load_active_tags (orm)")
+    async with _session() as s:
+        tag = func.unnest(Task.tags).label("tag")
+        rows = (await s.execute(
+            select(tag).where(Task.user_id == user_id, Task.done.is_(False)).distinct().order_by(tag)
+        )).all()
         tags = [r[0] for r in rows]
-    print(f"DEBUG: load_active_tags -> {len(tags)} tags")
+    logger.debug("load_active_tags -> %s tags", len(tags))
     if not tags:
-        print("WARNING: load_active_tags returned empty list")
+        logger.debug("load_active_tags returned empty list")
     return tags
 
 
-def load_settings(user_id: int):
-    print("DEBUG: load_settings (orm)")
-    with _session() as s:
-        rows = s.execute(
+async def load_facet_counts(user_id: int, filters: dict[str, Any] | None = None) -> dict[str, Any]:
+    """Число активных задач для каждого варианта фильтра — одним запросом.
+
+    Возвращает ``{"category": {имя: n}, "priority": {значение: n},
+    "tag": {тег: n}, "total": n}``. Счётчик варианта учитывает остальные
+    выбранные фильтры, но не фильтр того же вида: видно, сколько задач
+    останется после выбора. ``total`` — задачи, подходящие под все фильтры.
+    Категории, приоритеты и теги считаются в одном GROUPING SETS по задачам
+    с развёрнутым массивом тегов.
+    """
+    logger.debug("load_facet_counts (orm) %s", filters)
+    conditions = _filter_conditions(filters)
+
+    def matching(*kinds: str):
+        # count(DISTINCT id): строка задачи повторяется по разу на каждый её тег
+        where = [c for kind in kinds for c in conditions[kind]]
+        return func.count(Task.id.distinct()).filter(and_(true(), *where))
+
+    task_tag = func.unnest(Task.tags).table_valued("tag").render_derived(name="task_tag")
+    tag = task_tag.c.tag
+    stmt = (
+        select(
+            func.grouping(Task.category).label("by_category"),
+            func.grouping(Task.priority).label("by_priority"),
+            Task.category,
+            Task.priority,
+            tag,
+            matching("priority", "tags").label("category_count"),
+            matching("category", "tags").label("priority_count"),
+            matching("category", "priority").label("tag_count"),
+            matching("category", "priority", "tags").label("matching"),
+        )
+        .select_from(Task)
+        .outerjoin(task_tag, true())
+        .where(Task.user_id == user_id, Task.done.is_(False))
+        .group_by(func.grouping_sets(tuple_(Task.category), tuple_(Task.priority), tuple_(tag)))
+    )
+    facets: dict[str, Any] = {"category": {}, "priority": {}, "tag": {}, "total": 0}
+    async with _session() as s:
+        rows = (await s.execute(stmt)).all()
+    for row in rows:
+        # grouping() = 0 у столбца, по которому сгруппирован набор
+        if row.by_category == 0:
+            if row.category is not None:
+                facets["category"][row.category] = row.category_count
+        elif row.by_priority == 0:
+            # каждая задача ровно в одной группе приоритета: сумма — все подходящие
+            facets["total"] += row.matching
+            if row.priority is not None:
+                facets["priority"][row.priority] = row.priority_count
+        elif row.tag is not None:
+            facets["tag"][row.tag] = row.tag_count
+    logger.debug("load_facet_counts -> %s tasks", facets["total"])
+    return facets
+
+
+@cached("settings")
+async def load_settings(user_id: int):
+    logger.debug("load_settings (orm)")
+    async with _session() as s:
+        rows = (await s.execute(
             select(Setting.key, Setting.value).where(Setting.user_id == user_id)
-        ).all()
+        )).all()
         settings = {k: v for k, v in rows}
-    print(f"DEBUG: load_settings -> {len(settings)} entries")
+    logger.debug("load_settings -> %s entries", len(settings))
     if not settings:
-        print("WARNING: load_settings returned empty dict")
+        logger.debug("load_settings returned empty dict")
+    return settings
+
+
+async def load_all_reminder_settings() -> dict[int, dict[str, str]]:
+    """Настройки напоминаний всех пользователей одним запросом: {user_id: {key: value}}."""
+    logger.debug("load_all_reminder_settings (orm)")
+    async with _session() as s:
+        rows = (await s.execute(
+            select(User.user_id, Setting.key, Setting.value)
+            .outerjoin(
+                Setting,
+                (Setting.user_id == User.user_id)
+                & Setting.key.in_(("reminder_time", "notify_weekends")),
+            )
+        )).all()
+    settings: dict[int, dict[str, str]] = {}
+    for user_id, key, value in rows:
+        user_settings = settings.setdefault(int(user_id), {})
+        if key is not None:
+            user_settings[key] = value
+    logger.debug("load_all_reminder_settings -> %s users", len(settings))
     return settings
 
 
-def save_setting(user_id: int, key: str, value: Any):
-    print(f"DEBUG: save_setting (orm) {key}={value}")
-    with _session() as s:
-        row = s.get(Setting, {"user_id": user_id, "key": key})
+@invalidates("settings")
+async def save_setting(user_id: int, key: str, value: Any):
+    logger.debug("save_setting (orm) %s=%s", key, value)
+    async with _session() as s:
+        row = await s.get(Setting, {"user_id": user_id, "key": key})
         if row is None:
             s.add(Setting(user_id=user_id, key=key, value=str(value)))
         else:
             row.value = str(value)
-        s.commit()
+        await s.commit()
+
+
+async def save_bot_messages(messages: dict[int, list[int]], per_chat: int):
+    """Дописывает id сообщений бота по чатам и обрезает каждый чат до ``per_chat`` последних.
+
+    На пачку чатов — один INSERT и один DELETE; старше 48 часов сообщения
+    тоже выбрасываются: Telegram не даёт ботам удалять их.
+    """
+    chat_ids = list(messages)
+    async with _session() as s:
+        for chunk in _chunks([{"chat_id": c, "message_id": m} for c in chat_ids for m in messages[c]]):
+            await s.execute(pg_insert(BotMessage).values(chunk).on_conflict_do_nothing())
+        for chunk in _chunks(chat_ids, _COHORT_CHUNK):
+            ranked = select(
+                BotMessage.chat_id,
+                BotMessage.message_id,
+                BotMessage.sent_at,
+                func.row_number().over(
+                    partition_by=BotMessage.chat_id, order_by=BotMessage.message_id.desc()
+                ).label("rn"),
+            ).where(BotMessage.chat_id.in_(chunk)).subquery()
+            await s.execute(
+                delete(BotMessage).where(
+                    tuple_(BotMessage.chat_id, BotMessage.message_id).in_(
+                        select(ranked.c.chat_id, ranked.c.message_id).where(
+                            (ranked.c.rn > per_chat) | (ranked.c.sent_at < func.now() - text("interval '48 hours'"))
+                        )
+                    )
+                )
+            )
+        await s.commit()
+
+
+async def pop_bot_messages(chat_id: int) -> list[int]:
+    """Забирает (и удаляет из таблицы) сохранённые id сообщений бота в чате."""
+    async with _session() as s:
+        message_ids = (await s.execute(
+            delete(BotMessage).where(BotMessage.chat_id == chat_id).returning(BotMessage.message_id)
+        )).scalars().all()
+        await s.commit()
+    return sorted(int(message_id) for message_id in message_ids)
+
+
+async def load_state(scope: str, state_id: int) -> dict[str, Any] | None:
+    """Сохранённые user_data/chat_data одного пользователя или чата."""
+    async with _session() as s:
+        return (await s.execute(
+            select(BotState.data).where(BotState.scope == scope, BotState.id == state_id)
+        )).scalar_one_or_none()
+
+
+async def load_conversations(name: str) -> dict[str, Any]:
+    """Все активные состояния диалога ``name``: {key: state}."""
+    async with _session() as s:
+        rows = (await s.execute(
+            select(ConversationState.key, ConversationState.state).where(ConversationState.name == name)
+        )).all()
+    return {key: state for key, state in rows}
+
+
+async def save_persistence(
+    states: dict[tuple[str, int], dict[str, Any] | None],
+    conversations: dict[tuple[str, str], Any],
+):
+    """Пакетно записывает накопленные изменения persistence одной транзакцией.
+
+    ``None`` в ``states`` и в ``conversations`` означает удаление записи.
+    """
+    upserts = [{"scope": scope, "id": state_id, "data": data} for (scope, state_id), data in states.items() if data is not None]
+    removed = [key for key, data in states.items() if data is None]
+    conv_upserts = [{"name": name, "key": key, "state": state} for (name, key), state in conversations.items() if state is not None]
+    conv_removed = [key for key, state in conversations.items() if state is None]
+    async with _session() as s:
+        for chunk in _chunks(upserts):
+            stmt = pg_insert(BotState).values(chunk)
+            await s.execute(stmt.on_conflict_do_update(
+                index_elements=[BotState.scope, BotState.id],
+                set_={"data": stmt.excluded.data, "updated_at": func.now()},
+            ))
+        for chunk in _chunks(removed):
+            await s.execute(delete(BotState).where(tuple_(BotState.scope, BotState.id).in_(chunk)))
+        for chunk in _chunks(conv_upserts):
+            stmt = pg_insert(ConversationState).values(chunk)
+            await s.execute(stmt.on_conflict_do_update(
+                index_elements=[ConversationState.name, ConversationState.key],
+                set_={"state": stmt.excluded.state},
+            ))
+        for chunk in _chunks(conv_removed):
+            await s.execute(delete(ConversationState).where(
+                tuple_(ConversationState.name, ConversationState.key).in_(chunk)
+            ))
+        await s.commit()
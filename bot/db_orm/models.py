@@ -1,8 +1,15 @@
-from sqlalchemy import BigInteger, Boolean, ForeignKey, Text
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import BigInteger, Boolean, Computed, DateTime, ForeignKey, Index, Integer, Text, func, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .base import Base
 
+# конфигурация полнотекстового поиска: и для tasks.search_vector, и для запросов
+SEARCH_CONFIG = "russian"
+
 class User(Base):
     __tablename__ = "users"
     user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
@@ -11,6 +18,15 @@ class User(Base):
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        Index("ix_tasks_active_user_id", "user_id", "id", postgresql_where=text("NOT done")),
+        # /completed: выполненные задачи пользователя от новых к старым
+        Index("ix_tasks_done_user_completed", "user_id", "completed_at", "id", postgresql_where=text("done")),
+        # архивация: выполненные раньше порога по всем пользователям
+        Index("ix_tasks_done_completed_at", "completed_at", postgresql_where=text("done")),
+        Index("ix_tasks_search_vector", "search_vector", postgresql_using="gin"),
+        Index("ix_tasks_tags", "tags", postgresql_using="gin"),
+    )
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), index=True)
     title: Mapped[str] = mapped_column(Text)
@@ -18,8 +34,55 @@ class Task(Base):
     priority: Mapped[str | None] = mapped_column(Text, nullable=True)
     done: Mapped[bool] = mapped_column(Boolean, default=False)
     comment: Mapped[str] = mapped_column(Text, default="")
+    # растёт при каждом изменении задачи или её тегов; записи по снимку проверяют его
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default=text("1"))
+    # заполнено, пока задача выполнена
+    completed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+    # копия тегов из task_tags: фильтр по нескольким тегам — один предикат @>/&& без join;
+    # bot.db меняет её в тех же запросах, что и task_tags
+    tags: Mapped[list[str]] = mapped_column(ARRAY(Text), default=list, server_default=text("'{}'"))
+    # /search: название весит больше комментария; вычисляет Postgres, в ORM не загружается
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed(
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(comment, '')), 'B')",
+            persisted=True,
+        ),
+        deferred=True,
+    )
     user = relationship("User", back_populates="tasks")
-    tags = relationship("TaskTag", back_populates="task", cascade="all, delete-orphan")
+    task_tags = relationship("TaskTag", back_populates="task", cascade="all, delete-orphan")
+
+class TaskArchive(Base):
+    """Давно выполненные задачи, перенесённые из tasks; теги хранятся в самой строке."""
+    __tablename__ = "tasks_archive"
+    __table_args__ = (
+        Index("ix_tasks_archive_user_completed", "user_id", "completed_at", "id"),
+    )
+    # id сохраняется из tasks: задачу можно вернуть обратно под тем же id
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"))
+    title: Mapped[str] = mapped_column(Text)
+    category: Mapped[str | None] = mapped_column(Text, nullable=True)
+    priority: Mapped[str | None] = mapped_column(Text, nullable=True)
+    comment: Mapped[str] = mapped_column(Text, default="")
+    tags: Mapped[list[str]] = mapped_column(ARRAY(Text), server_default=text("'{}'"))
+    version: Mapped[int] = mapped_column(Integer)
+    completed_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    archived_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+class UserTaskStats(Base):
+    """Счётчики задач пользователя; bot.db меняет их в тех же транзакциях, что и задачи."""
+    __tablename__ = "user_task_stats"
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    active: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    # выполненные вместе с архивом: перенос в tasks_archive счётчики не меняет
+    done: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    # активные задачи по приоритетам
+    active_low: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    active_medium: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
+    active_high: Mapped[int] = mapped_column(Integer, default=0, server_default=text("0"))
 
 class Category(Base):
     __tablename__ = "categories"
@@ -33,12 +96,37 @@ class Tag(Base):
 
 class TaskTag(Base):
     __tablename__ = "task_tags"
+    __table_args__ = (
+        Index("ix_task_tags_tag_task_id", "tag", "task_id"),
+    )
     task_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("tasks.id", ondelete="CASCADE"), primary_key=True)
     tag: Mapped[str] = mapped_column(Text, primary_key=True)
-    task = relationship("Task", back_populates="tags")
+    task = relationship("Task", back_populates="task_tags")
 
 class Setting(Base):
     __tablename__ = "settings"
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
     key: Mapped[str] = mapped_column(Text, primary_key=True)
     value: Mapped[str] = mapped_column(Text)
+
+class BotMessage(Base):
+    """Сообщения бота, которые /start удалит из чата."""
+    __tablename__ = "bot_messages"
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    sent_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+class BotState(Base):
+    """user_data/chat_data из persistence бота: scope — "user" или "chat"."""
+    __tablename__ = "bot_state"
+    scope: Mapped[str] = mapped_column(Text, primary_key=True)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    data: Mapped[dict] = mapped_column(JSONB)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
+
+class ConversationState(Base):
+    """Состояния ConversationHandler: key — JSON-список (chat_id, user_id)."""
+    __tablename__ = "conversation_state"
+    name: Mapped[str] = mapped_column(Text, primary_key=True)
+    key: Mapped[str] = mapped_column(Text, primary_key=True)
+    state: Mapped[Any] = mapped_column(JSONB)
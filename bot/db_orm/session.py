@@ -1,5 +1,6 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = os.getenv("DATABASE_URL", "")
@@ -7,5 +8,18 @@ DATABASE_URL = os.getenv("DATABASE_URL", "")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
+# postgresql+psycopg:// обслуживает и синхронный, и asyncio-движок.
+# Синхронный движок оставлен для скриптов и бенчмарков; бот работает через async_engine.
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+
+# апдейт держит соединение от первого запроса до отправки ответа или конца обработки (см. bot.db.unit_of_work),
+# поэтому пул рассчитан на UPDATE_CONCURRENCY одновременных апдейтов плюс фоновые задачи
+async_engine = create_async_engine(
+    DATABASE_URL,
+    pool_pre_ping=True,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "50")),
+    pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "30")),
+)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
@@ -1,72 +1,113 @@
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import ApplicationBuilder, CallbackContext, CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler, filters
+from telegram.ext import Application, ApplicationBuilder, CallbackContext, CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler, filters
 
-from .config import BOT_TOKEN
+from .config import (
+    BOT_TOKEN, LOG_LEVEL, METRICS_HOST, METRICS_PORT,
+    WEBHOOK_LISTEN, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL,
+)
 from .constants import *
 from .db import (
     init_db,
-    load_tasks,
-    save_tasks,
+    load_tasks_page,
+    get_task,
+    TaskConflict,
+    retry_on_conflict,
+    create_task,
+    update_task_fields,
+    complete_task,
+    restore_task as db_restore_task,
+    delete_task as db_delete_task,
+    add_task_tags as db_add_task_tags,
     load_categories,
     save_categories,
-    load_tags,
     load_active_tags,
+    load_facet_counts,
     load_settings,
     save_setting,
     register_user,
-    get_next_task_id,
-    get_all_users,
+    load_digest_pages,
+    load_completed_page,
+    filter_tags,
+    search_tasks,
+    mark_unit_of_work_failed,
+    commit_unit_of_work,
 )
 from .keyboards import (
     build_keyboard, build_completed_keyboard, build_category_keyboard,
     build_priority_keyboard, build_filter_category_keyboard,
     build_filter_priority_keyboard, build_filter_tag_keyboard,
-    build_tag_keyboard, build_cancel_keyboard
+    build_cancel_keyboard,
+    parse_completed_page_callback, parse_task_callback, task_list_cache, task_list_key,
+)
+from .db_orm.session import async_engine
+from .metrics import (
+    InstrumentedApplication,
+    InstrumentedRequest,
+    instrument_application,
+    instrument_engine,
+    start_metrics_server,
+    stop_metrics_server,
 )
-from .utils import schedule_reminder_job, reply_or_edit, send_and_store
+from .messages import message_tracker
+from .outbox import BULK, outbox
+from .persistence import persistence
+from .updates import update_processor
+from .utils import (
+    schedule_archive_job, schedule_reminder_job, schedule_stats_repair_job, schedule_user_reminder,
+    reply_or_edit, send_and_store, reply_text, edit_message, delete_messages,
+)
+
+# ответ, когда кнопка или диалог опирались на версию задачи, которой уже нет
+TASK_CHANGED_TEXT = 'Задача изменилась, пока вы с ней работали. Откройте её и попробуйте ещё раз.'
+# ответ, когда задачи, с которой начали работать, уже нет среди активных
+TASK_GONE_TEXT = 'Задача удалена или уже выполнена.'
 
 
-async def send_daily_tasks(context: CallbackContext, user_id: int):
-    print("DEBUG: send_daily_tasks")
+async def send_daily_tasks(context: CallbackContext, user_id: int, digest: tuple[list, int] | None = None):
+    """Отправляет первую страницу активных задач.
+
+    ``digest`` — заранее загруженные ``(tasks, total)`` из load_digest_pages;
+    рассылка передаёт их пачкой на всю минутную корзину.
+    """
+    logger.debug("send_daily_tasks")
     if user_id is None:
         logger.error("user_id is required for send_daily_tasks")
         return
-    if user_id not in get_all_users():
-        logger.error("send_daily_tasks called for unregistered user %s", user_id)
-        return
-    tasks = load_tasks(user_id)
-    active_tasks = [t for t in tasks if not t.get('done')]
-    total_pages = max(1, (len(active_tasks) + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE)
+    if digest is None:
+        digest = (await load_digest_pages([user_id])).get(user_id)
+        if digest is None:
+            logger.error("send_daily_tasks called for unregistered user %s", user_id)
+            return
+    tasks_page, total = digest
+    total_pages = max(1, (total + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE)
     page = 0
-    tasks_page = active_tasks[:TASKS_PER_PAGE]
-    show_pagination = len(active_tasks) > TASKS_PER_PAGE
+    show_pagination = total > TASKS_PER_PAGE
     markup = build_keyboard(
         tasks_page,
         page=page if show_pagination else None,
         total_pages=total_pages if show_pagination else None,
     )
-    text = 'Задачи на сегодня:' if active_tasks else 'На сегодня задач нет.'
-    await send_and_store(context, user_id, text, reply_markup=markup)
+    text = f'Задачи на сегодня ({total}):' if total else 'На сегодня задач нет.'
+    # дайджест идёт низкоприоритетной полосой, чтобы не задерживать ответы пользователям
+    await send_and_store(context, user_id, text, reply_markup=markup, priority=BULK)
 
 async def start(update: Update, context: CallbackContext):
-    print('DEBUG: start')
+    logger.debug('start')
     if update.callback_query:
         await update.callback_query.answer()
     chat_id = update.effective_chat.id
-    register_user(chat_id, update.effective_user.full_name)
-    schedule_reminder_job(context.application)
+    await register_user(chat_id, update.effective_user.full_name)
+    await schedule_user_reminder(context.application, chat_id)
     # Clear any saved filters to avoid showing a filtered task list
     context.user_data['filters'] = {}
     context.user_data['tasks_page'] = 0
-    for mid in context.chat_data.get('bot_messages', set()):
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-        except Exception:
-            logger.exception("Failed to delete message %s" , mid)
-    context.chat_data['bot_messages'] = set()
+    context.user_data.pop('tasks_after', None)
+    # забираем старые сообщения до отправки меню, чтобы не удалить и его
+    stale_messages = await message_tracker.take(chat_id)
     keyboard = [
         [InlineKeyboardButton('Показать задачи', callback_data='show_tasks')],
         [InlineKeyboardButton('Добавить задачу', callback_data='add_task')],
@@ -75,423 +116,459 @@ async def start(update: Update, context: CallbackContext):
         [InlineKeyboardButton('Настройки', callback_data='settings')],
     ]
     markup = InlineKeyboardMarkup(keyboard)
-    await send_and_store(context, chat_id, 'Привет! Я помогу спланировать день.', reply_markup=markup)
+    # отправка и удаление идут в дочерних задачах, где транзакцию апдейта уже не закрыть
+    await commit_unit_of_work()
+    await asyncio.gather(
+        delete_messages(context, chat_id, stale_messages),
+        send_and_store(context, chat_id, 'Привет! Я помогу спланировать день.', reply_markup=markup),
+    )
+
+
+def _parse_page_callback(data: str):
+    """tasks_page_<page>[_a<id>|_b<id>] -> (page, after_id, before_id)."""
+    parts = data.split('_')
+    try:
+        page = int(parts[2])
+    except (IndexError, ValueError):
+        return 0, None, None
+    cursor = parts[3] if len(parts) > 3 else ''
+    try:
+        cursor_id = int(cursor[1:])
+    except ValueError:
+        # старые кнопки без курсора открывают первую страницу
+        return 0, None, None
+    if cursor[0] == 'a':
+        return page, cursor_id, None
+    if cursor[0] == 'b':
+        return page, None, cursor_id
+    return 0, None, None
+
+
+async def _render_task_list(chat_id: int, filters_data: dict, page: int, after_id, before_id):
+    """Загружает страницу и строит клавиатуру: (page, total, tasks_after, markup)."""
+    tasks_page, total = await load_tasks_page(chat_id, filters_data, after_id=after_id, before_id=before_id)
+    if before_id is not None and len(tasks_page) < TASKS_PER_PAGE:
+        # дошли до начала списка — показываем первую страницу целиком
+        page = 0
+        tasks_page, total = await load_tasks_page(chat_id, filters_data)
+    total_pages = max(1, (total + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE)
+    if not tasks_page and total:
+        # курсор оказался за концом списка (задачи удалены или выполнены)
+        page = total_pages - 1
+        tasks_page, total = await load_tasks_page(
+            chat_id, filters_data, limit=total - page * TASKS_PER_PAGE, from_end=True,
+        )
+    page = max(0, min(page, total_pages - 1))
+    logger.debug('list_tasks page %s/%s, %s active tasks', page + 1, total_pages, total)
+    show_pagination = total > TASKS_PER_PAGE
+    if not total:
+        logger.debug('list_tasks resulting list is empty')
+    markup = build_keyboard(
+        tasks_page,
+        include_add_button=True,
+        include_back_button=True,
+        page=page if show_pagination else None,
+        total_pages=total_pages if show_pagination else None,
+    )
+    tasks_after = tasks_page[0]['id'] - 1 if tasks_page and page else None
+    return page, total, tasks_after, markup
 
 
 async def list_tasks(update: Update, context: CallbackContext):
-    print('DEBUG: list_tasks')
+    logger.debug('list_tasks')
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    print(f'DEBUG: list_tasks loaded {len(tasks)} tasks')
     filters_data = context.user_data.get('filters', {})
-    category = filters_data.get('category')
-    priority = filters_data.get('priority')
-    tag = filters_data.get('tag')
-    if category:
-        tasks = [t for t in tasks if t.get('category') == category]
-    if priority:
-        tasks = [t for t in tasks if t.get('priority') == priority]
-    if tag:
-        tasks = [t for t in tasks if tag in t.get('tags', [])]
-    active_tasks = [t for t in tasks if not t.get('done')]
-    print(f'DEBUG: list_tasks after filtering -> {len(active_tasks)} active tasks')
     page = context.user_data.get('tasks_page', 0)
+    after_id = context.user_data.get('tasks_after')
+    before_id = None
     if update.message:
-        page = 0
+        page, after_id = 0, None
     elif update.callback_query:
         data = update.callback_query.data
         if data.startswith('tasks_page_'):
-            try:
-                page = int(data.split('_')[-1])
-            except ValueError:
-                page = 0
+            page, after_id, before_id = _parse_page_callback(data)
         elif data == 'show_tasks':
-            page = 0
-    total_pages = max(1, (len(active_tasks) + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE)
-    if page >= total_pages:
-        page = total_pages - 1
-    if page < 0:
-        page = 0
+            page, after_id = 0, None
+    key = task_list_key(chat_id, 'active', filters_data, (page, after_id, before_id))
+    view = task_list_cache.get(key)
+    if view is None:
+        view = await _render_task_list(chat_id, filters_data, page, after_id, before_id)
+        task_list_cache.set(key, view)
+    page, total, tasks_after, markup = view
     context.user_data['tasks_page'] = page
-    start_index = page * TASKS_PER_PAGE
-    end_index = start_index + TASKS_PER_PAGE
-    tasks_page = active_tasks[start_index:end_index]
-    show_pagination = len(active_tasks) > TASKS_PER_PAGE
-    if not active_tasks:
-        print('WARNING: list_tasks resulting list is empty')
-    markup = build_keyboard(
-        tasks_page,
-        include_add_button=True,
-        include_back_button=True,
-        page=page if show_pagination else None,
-        total_pages=total_pages if show_pagination else None,
-    )
-    text = 'Ваши задачи:' if active_tasks else 'Задач нет.'
+    context.user_data['tasks_after'] = tasks_after
+    text = 'Ваши задачи:' if total else 'Задач нет.'
     await reply_or_edit(update, context, text, reply_markup=markup)
 
 
 async def pagination_info(update: Update, context: CallbackContext):
-    print('DEBUG: pagination_info')
+    logger.debug('pagination_info')
     if update.callback_query:
         await update.callback_query.answer()
 
 
+async def _render_completed_list(chat_id: int, page: int, after, before):
+    """Страница выполненных задач (из tasks и архива) и клавиатура: (total, markup)."""
+    tasks_page, total = await load_completed_page(chat_id, after=after, before=before)
+    if (before is not None and len(tasks_page) < TASKS_PER_PAGE) or (not tasks_page and total):
+        # дошли до начала списка или курсор устарел — первая страница
+        page = 0
+        tasks_page, total = await load_completed_page(chat_id)
+    total_pages = max(1, (total + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE)
+    page = max(0, min(page, total_pages - 1))
+    markup = build_completed_keyboard(tasks_page, include_back_button=True, page=page, total_pages=total_pages)
+    return total, markup
+
+
 async def list_completed(update: Update, context: CallbackContext):
-    print('DEBUG: list_completed')
+    logger.debug('list_completed')
+    chat_id = update.effective_chat.id
+    page, after, before = 0, None, None
+    if update.callback_query and update.callback_query.data.startswith('completed_page_'):
+        page, after, before = parse_completed_page_callback(update.callback_query.data)
+    key = task_list_key(chat_id, 'completed', cursor=(page, after, before))
+    view = task_list_cache.get(key)
+    if view is None:
+        view = await _render_completed_list(chat_id, page, after, before)
+        task_list_cache.set(key, view)
+    total, markup = view
+    text = 'Выполненные задачи:' if total else 'Выполненных задач нет.'
+    await reply_or_edit(update, context, text, reply_markup=markup)
+
+
+async def _render_search(chat_id: int, query_text: str, page: int):
+    """Страница результатов поиска и клавиатура: (total, markup)."""
+    tasks_page, total = await search_tasks(chat_id, query_text, offset=page * TASKS_PER_PAGE)
+    if not tasks_page and page:
+        # результатов стало меньше, чем страниц в старом сообщении
+        page = 0
+        tasks_page, total = await search_tasks(chat_id, query_text)
+    total_pages = max(1, (total + TASKS_PER_PAGE - 1) // TASKS_PER_PAGE)
+    markup = build_keyboard(
+        tasks_page,
+        include_back_button=True,
+        page=page,
+        total_pages=total_pages,
+        # страницы листаются по OFFSET, задача на краю не нужна; запрос слишком
+        # длинный для callback_data и хранится в user_data['search_query']
+        nav_callback=lambda target, *_: f'search_page_{target}',
+        include_completed=True,
+    )
+    return total, markup
+
+
+async def search(update: Update, context: CallbackContext):
+    logger.debug('search')
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    markup = build_completed_keyboard(tasks, include_back_button=True)
-    text = 'Выполненные задачи:' if markup else 'Выполненных задач нет.'
+    if update.callback_query:
+        query_text = context.user_data.get('search_query')
+        if not query_text:
+            await update.callback_query.answer()
+            return
+        page = int(update.callback_query.data.split('_')[2])
+    else:
+        query_text = update.message.text.partition(' ')[2].strip()
+        if not query_text:
+            await reply_text(context, update.message, 'Напишите, что искать: /search купить молоко')
+            return
+        context.user_data['search_query'] = query_text
+        page = 0
+    key = task_list_key(chat_id, 'search', {'query': query_text}, page)
+    view = task_list_cache.get(key)
+    if view is None:
+        view = await _render_search(chat_id, query_text, page)
+        task_list_cache.set(key, view)
+    total, markup = view
+    text = f'Найдено задач: {total}' if total else f'По запросу «{query_text}» ничего не найдено.'
     await reply_or_edit(update, context, text, reply_markup=markup)
 
 
 async def task_selected(update: Update, context: CallbackContext):
-    print('DEBUG: task_selected')
+    logger.debug('task_selected')
     query = update.callback_query
     await query.answer()
-    task_id = int(query.data.split('_')[1])
+    task_id, version = parse_task_callback(query.data)
     context.user_data['task_id'] = task_id
+    # выполнение запишется, только если задачу не изменили, пока пользователь писал комментарий
+    context.user_data['task_version'] = version
     message = query.message
     if message:
-        try:
-            await message.edit_text('Введите комментарий к задаче:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(message, 'Введите комментарий к задаче:', reply_markup=build_cancel_keyboard())
     return COMMENT
 
 
 async def edit_task_start(update: Update, context: CallbackContext):
-    print('DEBUG: edit_task_start')
+    logger.debug('edit_task_start')
     query = update.callback_query
     await query.answer()
-    task_id = int(query.data.split('_')[1])
+    task_id, version = parse_task_callback(query.data)
     context.user_data['edit_id'] = task_id
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    title = next((t['title'] for t in tasks if t['id'] == task_id), '')
+    task = await get_task(chat_id, task_id)
+    title = task['title'] if task else ''
+    # правка применится, только если задача та же, что была на кнопке, и её не
+    # изменили, пока пользователь вводил данные
+    if version is None and task:
+        version = task['version']
+    context.user_data['edit_version'] = version
     message = query.message
     if message:
-        try:
-            await message.edit_text(f'Текущее название: {title}\nВведите новое название задачи:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(message, f'Текущее название: {title}\nВведите новое название задачи:', reply_markup=build_cancel_keyboard())
     return EDIT_TASK_TITLE
 
 
 async def edit_task_category(update: Update, context: CallbackContext):
-    print('DEBUG: edit_task_category')
+    logger.debug('edit_task_category')
     context.user_data['edit_title'] = update.message.text
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     markup = build_category_keyboard(categories)
-    try:
-        sent = await update.message.reply_text('Выберите категорию:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+    await reply_text(context, update.message, 'Выберите категорию:', reply_markup=markup)
     return EDIT_TASK_CATEGORY_CHOOSE
 
 
 async def choose_edit_category(update: Update, context: CallbackContext):
-    print('DEBUG: choose_edit_category')
+    logger.debug('choose_edit_category')
     query = update.callback_query
     await query.answer()
     data = query.data
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if data == 'new_category':
-        try:
-            await query.message.edit_text('Введите название новой категории:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(query.message, 'Введите название новой категории:', reply_markup=build_cancel_keyboard())
         return EDIT_TASK_CATEGORY_INPUT
     index = int(data.split('_')[2])
     context.user_data['edit_category'] = categories[index]
     markup = build_priority_keyboard()
-    try:
-        await query.message.edit_text('Выберите приоритет:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to edit message')
+    await edit_message(query.message, 'Выберите приоритет:', reply_markup=markup)
     return EDIT_TASK_PRIORITY
 
 
 async def edit_task_category_input(update: Update, context: CallbackContext):
-    print('DEBUG: edit_task_category_input')
+    logger.debug('edit_task_category_input')
     new_cat = update.message.text
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if new_cat not in categories:
         categories.append(new_cat)
-        save_categories(chat_id, categories)
+        await save_categories(chat_id, categories)
     context.user_data['edit_category'] = new_cat
     markup = build_priority_keyboard()
-    try:
-        sent = await update.message.reply_text('Выберите приоритет:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+    await reply_text(context, update.message, 'Выберите приоритет:', reply_markup=markup)
     return EDIT_TASK_PRIORITY
 
 
 async def choose_edit_priority(update: Update, context: CallbackContext):
-    print('DEBUG: choose_edit_priority')
+    logger.debug('choose_edit_priority')
     query = update.callback_query
     await query.answer()
     priority = query.data.split('_')[1]
     context.user_data['edit_priority'] = priority
     task_id = context.user_data.get('edit_id')
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    for task in tasks:
-        if task['id'] == task_id:
-            task['title'] = context.user_data.get('edit_title')
-            task['category'] = context.user_data.get('edit_category')
-            task['priority'] = context.user_data.get('edit_priority')
-            break
-    save_tasks(chat_id, tasks)
     try:
-        await query.message.edit_text('Задача обновлена.')
-    except Exception:
-        logger.exception('Failed to edit message')
+        await update_task_fields(
+            chat_id,
+            task_id,
+            expected_version=context.user_data.pop('edit_version', None),
+            title=context.user_data.get('edit_title'),
+            category=context.user_data.get('edit_category'),
+            priority=context.user_data.get('edit_priority'),
+        )
+    except TaskConflict:
+        await edit_message(query.message, 'Задача изменилась, пока вы её редактировали. Откройте её и попробуйте ещё раз.')
+    else:
+        await edit_message(query.message, 'Задача обновлена.')
     await list_tasks(update, context)
     return ConversationHandler.END
 
 
 async def add_tags_to_task(update: Update, context: CallbackContext):
-    print('DEBUG: add_tags_to_task')
+    logger.debug('add_tags_to_task')
     tags_text = update.message.text.strip()
     tags = [t.strip() for t in tags_text.split(',') if t.strip()] if tags_text else []
     task_id = context.user_data.get('tag_id')
+    version = context.user_data.pop('tag_version', None)
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    for task in tasks:
-        if task['id'] == task_id:
-            current_tags = task.get('tags', [])
-            for tag in tags:
-                if tag not in current_tags:
-                    current_tags.append(tag)
-            task['tags'] = current_tags
-            break
-    save_tasks(chat_id, tasks)
+
+    async def attempt():
+        nonlocal version
+        if version is None:
+            # теги только дописываются: после чужой правки их можно добавить
+            # к свежей версии, если задача ещё не удалена и не выполнена
+            task = await get_task(chat_id, task_id)
+            if task is None or task['done']:
+                return False
+            version = task['version']
+        try:
+            return await db_add_task_tags(chat_id, task_id, tags, expected_version=version)
+        except TaskConflict:
+            version = None
+            raise
+
     try:
-        sent = await update.message.reply_text('Теги добавлены.')
-    except Exception:
-        logger.exception('Failed to send reply')
+        added = await retry_on_conflict(attempt) if tags else True
+    except TaskConflict:
+        await reply_text(context, update.message, TASK_CHANGED_TEXT)
     else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+        await reply_text(context, update.message, 'Теги добавлены.' if added else TASK_GONE_TEXT)
     await list_tasks(update, context)
     return ConversationHandler.END
 
 
 async def save_comment(update: Update, context: CallbackContext):
-    print('DEBUG: save_comment')
+    logger.debug('save_comment')
     comment = update.message.text
     task_id = context.user_data.get('task_id')
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    for task in tasks:
-        if task['id'] == task_id:
-            task['done'] = True
-            task['comment'] = comment
-            break
-    done_count = sum(1 for t in tasks if t.get('done'))
-    print(f'DEBUG: save_comment marked task {task_id} done. Done count {done_count}')
-    save_tasks(chat_id, tasks)
     try:
-        sent = await update.message.reply_text('Задача сохранена.')
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+        completed = await complete_task(chat_id, task_id, comment, expected_version=context.user_data.pop('task_version', None))
+    except TaskConflict:
+        completed = None
+    if not completed:
+        await reply_text(context, update.message, TASK_CHANGED_TEXT if completed is None else TASK_GONE_TEXT)
+        await list_tasks(update, context)
+        return ConversationHandler.END
+    logger.debug('save_comment marked task %s done', task_id)
+    await reply_text(context, update.message, 'Задача сохранена.')
     await send_daily_tasks(context, chat_id)
     return ConversationHandler.END
 
 
 async def delete_task(update: Update, context: CallbackContext):
-    print('DEBUG: delete_task')
+    logger.debug('delete_task')
     query = update.callback_query
     await query.answer()
-    task_id = int(query.data.split('_')[1])
+    task_id, version = parse_task_callback(query.data)
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    tasks = [t for t in tasks if t['id'] != task_id]
-    print(f'DEBUG: delete_task remaining {len(tasks)} tasks')
-    save_tasks(chat_id, tasks)
+    try:
+        await db_delete_task(chat_id, task_id, expected_version=version)
+    except TaskConflict:
+        text = TASK_CHANGED_TEXT
+    else:
+        logger.debug('delete_task removed %s', task_id)
+        text = 'Задача удалена.'
     if query.message:
-        try:
-            await query.message.edit_text('Задача удалена.')
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(query.message, text)
     await list_tasks(update, context)
 
 
 async def restore_task(update: Update, context: CallbackContext):
-    print('DEBUG: restore_task')
+    logger.debug('restore_task')
     query = update.callback_query
     await query.answer()
-    task_id = int(query.data.split('_')[1])
+    task_id, version = parse_task_callback(query.data)
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    for task in tasks:
-        if task['id'] == task_id:
-            task['done'] = False
-            break
-    done_count = sum(1 for t in tasks if t.get('done'))
-    print(f'DEBUG: restore_task restored {task_id}. Done count {done_count}')
-    save_tasks(chat_id, tasks)
+    try:
+        await db_restore_task(chat_id, task_id, expected_version=version)
+    except TaskConflict:
+        text = TASK_CHANGED_TEXT
+    else:
+        logger.debug('restore_task restored %s', task_id)
+        text = 'Задача восстановлена.'
     if query.message:
-        try:
-            await query.message.edit_text('Задача восстановлена.')
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(query.message, text)
     await list_tasks(update, context)
 
 
 async def add_tag_start(update: Update, context: CallbackContext):
-    print('DEBUG: add_tag_start')
+    logger.debug('add_tag_start')
     query = update.callback_query
     await query.answer()
-    task_id = int(query.data.split('_')[1])
+    task_id, version = parse_task_callback(query.data)
     context.user_data['tag_id'] = task_id
-    try:
-        await query.message.edit_text('Введите теги через запятую:', reply_markup=build_cancel_keyboard())
-    except Exception:
-        logger.exception('Failed to edit message')
+    context.user_data['tag_version'] = version
+    await edit_message(query.message, 'Введите теги через запятую:', reply_markup=build_cancel_keyboard())
     return EDIT_TASK_TAGS
 
 
 async def add_task_start(update: Update, context: CallbackContext):
-    print('DEBUG: add_task_start')
+    logger.debug('add_task_start')
     if update.callback_query:
         await update.callback_query.answer()
         message = update.callback_query.message
         if message:
-            try:
-                await message.edit_text('Введите название новой задачи:', reply_markup=build_cancel_keyboard())
-            except Exception:
-                logger.exception('Failed to edit message')
+            await edit_message(message, 'Введите название новой задачи:', reply_markup=build_cancel_keyboard())
     else:
-        try:
-            sent = await update.message.reply_text('Введите название новой задачи:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to send reply')
-        else:
-            context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+        await reply_text(context, update.message, 'Введите название новой задачи:', reply_markup=build_cancel_keyboard())
     return ADD_TASK_TITLE
 
 async def add_task_category(update: Update, context: CallbackContext):
-    print('DEBUG: add_task_category')
+    logger.debug('add_task_category')
     context.user_data['new_title'] = update.message.text
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     markup = build_category_keyboard(categories)
-    try:
-        sent = await update.message.reply_text('Выберите категорию:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+    await reply_text(context, update.message, 'Выберите категорию:', reply_markup=markup)
     return ADD_TASK_CATEGORY_CHOOSE
 
 
 async def choose_task_category(update: Update, context: CallbackContext):
-    print('DEBUG: choose_task_category')
+    logger.debug('choose_task_category')
     query = update.callback_query
     await query.answer()
     data = query.data
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if data == 'new_category':
-        try:
-            await query.message.edit_text('Введите название новой категории:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(query.message, 'Введите название новой категории:', reply_markup=build_cancel_keyboard())
         return ADD_TASK_CATEGORY_INPUT
     index = int(data.split('_')[2])
     context.user_data['new_category'] = categories[index]
     markup = build_priority_keyboard()
-    try:
-        await query.message.edit_text('Выберите приоритет:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to edit message')
+    await edit_message(query.message, 'Выберите приоритет:', reply_markup=markup)
     return ADD_TASK_PRIORITY
 
 
 async def add_task_category_input(update: Update, context: CallbackContext):
-    print('DEBUG: add_task_category_input')
+    logger.debug('add_task_category_input')
     new_cat = update.message.text
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if new_cat not in categories:
         categories.append(new_cat)
-        save_categories(chat_id, categories)
+        await save_categories(chat_id, categories)
     context.user_data['new_category'] = new_cat
     markup = build_priority_keyboard()
-    try:
-        sent = await update.message.reply_text('Выберите приоритет:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+    await reply_text(context, update.message, 'Выберите приоритет:', reply_markup=markup)
     return ADD_TASK_PRIORITY
 
 
 async def choose_task_priority(update: Update, context: CallbackContext):
-    print('DEBUG: choose_task_priority')
+    logger.debug('choose_task_priority')
     query = update.callback_query
     await query.answer()
     priority = query.data.split('_')[1]
     context.user_data['new_priority'] = priority
-    try:
-        await query.message.edit_text('Введите теги через запятую (можно оставить пустым):', reply_markup=build_cancel_keyboard())
-    except Exception:
-        logger.exception('Failed to edit message')
+    await edit_message(query.message, 'Введите теги через запятую (можно оставить пустым):', reply_markup=build_cancel_keyboard())
     return ADD_TASK_TAGS
 
 
 async def add_task_tags(update: Update, context: CallbackContext):
-    print('DEBUG: add_task_tags')
+    logger.debug('add_task_tags')
     tags_text = update.message.text.strip()
     tags = [t.strip() for t in tags_text.split(',') if t.strip()] if tags_text else []
     title = context.user_data.get('new_title')
     category = context.user_data.get('new_category')
     priority = context.user_data.get('new_priority')
     chat_id = update.effective_chat.id
-    tasks = load_tasks(chat_id)
-    new_id = get_next_task_id(chat_id)
-    tasks.append({
-        'id': new_id,
-        'title': title,
-        'category': category,
-        'priority': priority,
-        'tags': tags,
-        'done': False,
-        'comment': '',
-    })
-    print(f'DEBUG: add_task_tags added task id {new_id}. Total {len(tasks)} tasks')
-    save_tasks(chat_id, tasks)
-    try:
-        sent = await update.message.reply_text('Задача добавлена.')
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+    new_id = await create_task(chat_id, title, category, priority, tags)
+    logger.debug('add_task_tags added task id %s', new_id)
+    await reply_text(context, update.message, 'Задача добавлена.')
     await list_tasks(update, context)
     return ConversationHandler.END
 
 
 async def categories_menu(update: Update, context: CallbackContext):
-    print('DEBUG: categories_menu')
+    logger.debug('categories_menu')
     if update.callback_query:
         await update.callback_query.answer()
         message = update.callback_query.message
     else:
         message = update.message
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
-    print(f'DEBUG: categories_menu -> {len(categories)} categories')
+    categories = await load_categories(chat_id)
+    logger.debug('categories_menu -> %s categories', len(categories))
     keyboard = [
         [InlineKeyboardButton(cat, callback_data=f'editcat_{i}'), InlineKeyboardButton('🗑️', callback_data=f'delcat_{i}')]
         for i, cat in enumerate(categories)
@@ -501,96 +578,89 @@ async def categories_menu(update: Update, context: CallbackContext):
     markup = InlineKeyboardMarkup(keyboard)
     if message:
         if update.callback_query:
-            try:
-                await message.edit_text('Категории:', reply_markup=markup)
-            except Exception:
-                logger.exception('Failed to edit message')
+            await edit_message(message, 'Категории:', reply_markup=markup)
         else:
-            try:
-                sent = await message.reply_text('Категории:', reply_markup=markup)
-            except Exception:
-                logger.exception('Failed to send reply')
-            else:
-                context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+            await reply_text(context, message, 'Категории:', reply_markup=markup)
     return CATEGORY_MENU
 
 
 async def category_add(update: Update, context: CallbackContext):
-    print('DEBUG: category_add')
+    logger.debug('category_add')
     if update.callback_query:
         await update.callback_query.answer()
-        try:
-            await update.callback_query.message.edit_text('Введите название новой категории:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(update.callback_query.message, 'Введите название новой категории:', reply_markup=build_cancel_keyboard())
     else:
-        try:
-            sent = await update.message.reply_text('Введите название новой категории:', reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to send reply')
-        else:
-            context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+        await reply_text(context, update.message, 'Введите название новой категории:', reply_markup=build_cancel_keyboard())
     return CATEGORY_ADD
 
 
 async def save_new_category(update: Update, context: CallbackContext):
-    print('DEBUG: save_new_category')
+    logger.debug('save_new_category')
     name = update.message.text
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if name not in categories:
         categories.append(name)
-        save_categories(chat_id, categories)
+        await save_categories(chat_id, categories)
     await categories_menu(update, context)
     return CATEGORY_MENU
 
 
 async def category_edit_start(update: Update, context: CallbackContext):
-    print('DEBUG: category_edit_start')
+    logger.debug('category_edit_start')
     query = update.callback_query
     await query.answer()
     idx = int(query.data.split('_')[1])
     context.user_data['cat_index'] = idx
-    try:
-        await query.message.edit_text('Введите новое название категории:', reply_markup=build_cancel_keyboard())
-    except Exception:
-        logger.exception('Failed to edit message')
+    await edit_message(query.message, 'Введите новое название категории:', reply_markup=build_cancel_keyboard())
     return CATEGORY_EDIT
 
 
 async def save_edited_category(update: Update, context: CallbackContext):
-    print('DEBUG: save_edited_category')
+    logger.debug('save_edited_category')
     idx = context.user_data.get('cat_index')
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if 0 <= idx < len(categories):
         categories[idx] = update.message.text
-        save_categories(chat_id, categories)
+        await save_categories(chat_id, categories)
     await categories_menu(update, context)
     return CATEGORY_MENU
 
 
 async def delete_category(update: Update, context: CallbackContext):
-    print('DEBUG: delete_category')
+    logger.debug('delete_category')
     query = update.callback_query
     await query.answer()
     idx = int(query.data.split('_')[1])
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
+    categories = await load_categories(chat_id)
     if 0 <= idx < len(categories):
         categories.pop(idx)
-        save_categories(chat_id, categories)
+        await save_categories(chat_id, categories)
     await categories_menu(update, context)
     return CATEGORY_MENU
 
 
+async def _load_facets(chat_id: int, filters_data: dict | None) -> dict:
+    """Счётчики вариантов фильтра; кэшируются, пока задачи пользователя не изменились."""
+    key = task_list_key(chat_id, 'facets', filters_data)
+    facets = task_list_cache.get(key)
+    if facets is None:
+        facets = await load_facet_counts(chat_id, filters_data)
+        task_list_cache.set(key, facets)
+    return facets
+
+
 async def filter_menu(update: Update, context: CallbackContext):
-    print('DEBUG: filter_menu')
+    logger.debug('filter_menu')
     if update.callback_query:
         await update.callback_query.answer()
         message = update.callback_query.message
     else:
         message = update.message
+    facets = await _load_facets(update.effective_chat.id, context.user_data.get('filters'))
+    text = f"Фильтр задач (подходит: {facets['total']}):"
     keyboard = [
         [InlineKeyboardButton('Категория', callback_data='filter_category')],
         [InlineKeyboardButton('Приоритет', callback_data='filter_priority')],
@@ -601,62 +671,53 @@ async def filter_menu(update: Update, context: CallbackContext):
     markup = InlineKeyboardMarkup(keyboard)
     if message:
         if update.callback_query:
-            try:
-                await message.edit_text('Фильтр задач:', reply_markup=markup)
-            except Exception:
-                logger.exception('Failed to edit message')
+            await edit_message(message, text, reply_markup=markup)
         else:
-            try:
-                sent = await message.reply_text('Фильтр задач:', reply_markup=markup)
-            except Exception:
-                logger.exception('Failed to send reply')
-            else:
-                context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+            await reply_text(context, message, text, reply_markup=markup)
     return FILTER_MENU
 
 
 async def filter_choose_category(update: Update, context: CallbackContext):
-    print('DEBUG: filter_choose_category')
+    logger.debug('filter_choose_category')
     query = update.callback_query
     await query.answer()
     chat_id = update.effective_chat.id
-    categories = load_categories(chat_id)
-    markup = build_filter_category_keyboard(categories)
-    try:
-        await query.message.edit_text('Выберите категорию:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to edit message')
+    categories = await load_categories(chat_id)
+    facets = await _load_facets(chat_id, context.user_data.get('filters'))
+    markup = build_filter_category_keyboard(categories, facets['category'])
+    await edit_message(query.message, 'Выберите категорию:', reply_markup=markup)
     return FILTER_MENU
 
 
 async def filter_choose_priority(update: Update, context: CallbackContext):
-    print('DEBUG: filter_choose_priority')
+    logger.debug('filter_choose_priority')
     query = update.callback_query
     await query.answer()
-    markup = build_filter_priority_keyboard()
-    try:
-        await query.message.edit_text('Выберите приоритет:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to edit message')
+    facets = await _load_facets(update.effective_chat.id, context.user_data.get('filters'))
+    markup = build_filter_priority_keyboard(facets['priority'])
+    await edit_message(query.message, 'Выберите приоритет:', reply_markup=markup)
     return FILTER_MENU
 
 
-async def filter_choose_tag(update: Update, context: CallbackContext):
-    print('DEBUG: filter_choose_tag')
-    query = update.callback_query
-    await query.answer()
+async def _show_tag_filter(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    tags = load_active_tags(chat_id)
-    markup = build_filter_tag_keyboard(tags)
-    try:
-        await query.message.edit_text('Выберите тег:', reply_markup=markup)
-    except Exception:
-        logger.exception('Failed to edit message')
+    tags = await load_active_tags(chat_id)
+    filters_data = context.user_data.get('filters')
+    selected, mode = filter_tags(filters_data)
+    facets = await _load_facets(chat_id, filters_data)
+    markup = build_filter_tag_keyboard(tags, selected, mode, facets['tag'])
+    await edit_message(update.callback_query.message, 'Выберите теги:', reply_markup=markup)
+
+
+async def filter_choose_tag(update: Update, context: CallbackContext):
+    logger.debug('filter_choose_tag')
+    await update.callback_query.answer()
+    await _show_tag_filter(update, context)
     return FILTER_MENU
 
 
 async def filter_set(update: Update, context: CallbackContext):
-    print('DEBUG: filter_set')
+    logger.debug('filter_set')
     query = update.callback_query
     await query.answer()
     data = query.data
@@ -667,7 +728,7 @@ async def filter_set(update: Update, context: CallbackContext):
             filters_data.pop('category', None)
         else:
             index = int(data.split('_')[1])
-            categories = load_categories(chat_id)
+            categories = await load_categories(chat_id)
             if 0 <= index < len(categories):
                 filters_data['category'] = categories[index]
     elif data.startswith('fprio_'):
@@ -676,29 +737,44 @@ async def filter_set(update: Update, context: CallbackContext):
         else:
             filters_data['priority'] = data.split('_')[1]
     elif data.startswith('ftag_'):
+        selected, mode = filter_tags(filters_data)
+        filters_data.pop('tag', None)
         if data == 'ftag_none':
-            filters_data.pop('tag', None)
-        else:
+            selected = []
+        elif data == 'ftag_mode':
+            mode = 'any' if mode == 'all' else 'all'
+        elif data != 'ftag_apply':
             index = int(data.split('_')[1])
-            tags = load_active_tags(chat_id)
+            tags = await load_active_tags(chat_id)
             if 0 <= index < len(tags):
-                filters_data['tag'] = tags[index]
+                tag = tags[index]
+                selected = [t for t in selected if t != tag] if tag in selected else selected + [tag]
+        if selected:
+            filters_data['tags'] = selected
+        else:
+            filters_data.pop('tags', None)
+        filters_data['tag_mode'] = mode
+        if data not in ('ftag_none', 'ftag_apply'):
+            # выбор тегов продолжается: список покажет кнопка «Показать»
+            await _show_tag_filter(update, context)
+            return FILTER_MENU
     elif data == 'filter_reset':
         context.user_data.pop('filters', None)
     context.user_data['tasks_page'] = 0
+    context.user_data.pop('tasks_after', None)
     await list_tasks(update, context)
     return FILTER_MENU
 
 
 async def settings_menu(update: Update, context: CallbackContext):
-    print('DEBUG: settings_menu')
+    logger.debug('settings_menu')
     if update.callback_query:
         await update.callback_query.answer()
         message = update.callback_query.message
     else:
         message = update.message
     chat_id = update.effective_chat.id
-    settings = load_settings(chat_id)
+    settings = await load_settings(chat_id)
     time_str = settings.get("reminder_time", "09:00")
     weekends = settings.get("notify_weekends", "0") == "1"
     keyboard = [
@@ -714,126 +790,129 @@ async def settings_menu(update: Update, context: CallbackContext):
     markup = InlineKeyboardMarkup(keyboard)
     if message:
         if update.callback_query:
-            try:
-                await message.edit_text("Настройки напоминаний:", reply_markup=markup)
-            except Exception:
-                logger.exception('Failed to edit message')
+            await edit_message(message, "Настройки напоминаний:", reply_markup=markup)
         else:
-            try:
-                sent = await message.reply_text("Настройки напоминаний:", reply_markup=markup)
-            except Exception:
-                logger.exception('Failed to send reply')
-            else:
-                context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+            await reply_text(context, message, "Настройки напоминаний:", reply_markup=markup)
     return SETTINGS_MENU
 
 
 async def settings_set_time(update: Update, context: CallbackContext):
-    print('DEBUG: settings_set_time')
+    logger.debug('settings_set_time')
     if update.callback_query:
         await update.callback_query.answer()
-        try:
-            await update.callback_query.message.edit_text("Введите время в формате ЧЧ:ММ", reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to edit message')
+        await edit_message(update.callback_query.message, "Введите время в формате ЧЧ:ММ", reply_markup=build_cancel_keyboard())
     else:
-        try:
-            sent = await update.message.reply_text("Введите время в формате ЧЧ:ММ", reply_markup=build_cancel_keyboard())
-        except Exception:
-            logger.exception('Failed to send reply')
-        else:
-            context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+        await reply_text(context, update.message, "Введите время в формате ЧЧ:ММ", reply_markup=build_cancel_keyboard())
     return SETTINGS_TIME
 
 
 async def settings_save_time(update: Update, context: CallbackContext):
-    print('DEBUG: settings_save_time')
+    logger.debug('settings_save_time')
     text = update.message.text.strip()
     try:
         hour, minute = map(int, text.split(":"))
         if not (0 <= hour < 24 and 0 <= minute < 60):
             raise ValueError
     except Exception:
-        try:
-            sent = await update.message.reply_text("Неверный формат времени, попробуйте ещё раз.")
-        except Exception:
-            logger.exception('Failed to send reply')
-        else:
-            context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+        await reply_text(context, update.message, "Неверный формат времени, попробуйте ещё раз.")
         return SETTINGS_TIME
     chat_id = update.effective_chat.id
-    save_setting(chat_id, "reminder_time", f"{hour:02d}:{minute:02d}")
-    try:
-        sent = await update.message.reply_text("Время напоминания обновлено.")
-    except Exception:
-        logger.exception('Failed to send reply')
-    else:
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
-    schedule_reminder_job(context.application)
+    await save_setting(chat_id, "reminder_time", f"{hour:02d}:{minute:02d}")
+    await reply_text(context, update.message, "Время напоминания обновлено.")
+    await schedule_user_reminder(context.application, chat_id)
     return await settings_menu(update, context)
 
 
 async def toggle_weekends(update: Update, context: CallbackContext):
-    print('DEBUG: toggle_weekends')
+    logger.debug('toggle_weekends')
     if update.callback_query:
         await update.callback_query.answer()
         message = update.callback_query.message
     else:
         message = update.message
     chat_id = update.effective_chat.id
-    settings = load_settings(chat_id)
+    settings = await load_settings(chat_id)
     current = settings.get("notify_weekends", "0") == "1"
-    save_setting(chat_id, "notify_weekends", "0" if current else "1")
-    schedule_reminder_job(context.application)
+    settings["notify_weekends"] = "0" if current else "1"
+    await save_setting(chat_id, "notify_weekends", settings["notify_weekends"])
+    await schedule_user_reminder(context.application, chat_id, settings)
     if message:
         if update.callback_query:
-            try:
-                await message.edit_text("Настройки обновлены.")
-            except Exception:
-                logger.exception('Failed to edit message')
+            await edit_message(message, "Настройки обновлены.")
         else:
-            try:
-                sent = await message.reply_text("Настройки обновлены.")
-            except Exception:
-                logger.exception('Failed to send reply')
-            else:
-                context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+            await reply_text(context, message, "Настройки обновлены.")
     return await settings_menu(update, context)
 
 
 async def cancel(update: Update, context: CallbackContext):
-    print('DEBUG: cancel')
+    logger.debug('cancel')
     message = update.message or (update.callback_query and update.callback_query.message)
     if update.callback_query:
         await update.callback_query.answer()
     if message:
         if update.callback_query:
-            try:
-                await message.edit_text('Действие отменено.')
-            except Exception:
-                logger.exception('Failed to edit message')
+            await edit_message(message, 'Действие отменено.')
         else:
-            try:
-                sent = await message.reply_text('Действие отменено.')
-            except Exception:
-                logger.exception('Failed to send reply')
-            else:
-                context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+            await reply_text(context, message, 'Действие отменено.')
     await start(update, context)
     return ConversationHandler.END
 
 
-def main():
-    print('DEBUG: main')
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+async def on_error(update: object, context: CallbackContext):
+    # PTB перехватывает исключения обработчиков сам: без этого транзакция апдейта
+    # была бы зафиксирована вместе с половиной изменений
+    mark_unit_of_work_failed()
+    logger.error('Exception while handling an update', exc_info=context.error)
+
+
+async def post_init(application):
+    logger.debug('post_init')
+    # JobQueue и асинхронный движок БД доступны только внутри event loop приложения
+    await outbox.start()
+    await message_tracker.start()
+    await schedule_reminder_job(application)
+    schedule_archive_job(application)
+    schedule_stats_repair_job(application)
+    if application.job_queue:
+        persistence.schedule_eviction(application)
+    await start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+
+async def post_shutdown(application):
+    logger.debug('post_shutdown')
+    await stop_metrics_server()
+    await message_tracker.stop()
+    await outbox.stop()
+
+
+def build_application(token: str = BOT_TOKEN, request=None) -> Application:
+    """Собирает приложение со всеми обработчиками, но не запускает его.
+
+    ``request`` заменяет HTTP-клиент Bot API (бенчмарки подставляют фейковый).
+    """
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .application_class(InstrumentedApplication)
+        # пул соединений под воркеров outbox и параллельные апдейты
+        .request(request or InstrumentedRequest(connection_pool_size=256))
+        # чаты обрабатываются параллельно, апдейты одного чата — по очереди
+        .concurrent_updates(update_processor)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler(['tasks', 'list'], list_tasks))
     application.add_handler(CallbackQueryHandler(list_tasks, pattern='^show_tasks$'))
-    application.add_handler(CallbackQueryHandler(list_tasks, pattern=r'^tasks_page_\d+$'))
+    application.add_handler(CallbackQueryHandler(list_tasks, pattern=r'^tasks_page_\d+(_[ab]\d+)?$'))
     application.add_handler(CallbackQueryHandler(pagination_info, pattern='^tasks_page_info$'))
 
     comment_conv = ConversationHandler(
+        name='comment',
+        persistent=True,
         entry_points=[CallbackQueryHandler(task_selected, pattern=r'^task_')],
         states={
             COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_comment)],
@@ -843,6 +922,8 @@ def main():
     application.add_handler(comment_conv)
 
     add_conv = ConversationHandler(
+        name='add',
+        persistent=True,
         entry_points=[
             CommandHandler(['add', 'new'], add_task_start),
             CallbackQueryHandler(add_task_start, pattern='^add_task$'),
@@ -859,6 +940,8 @@ def main():
     application.add_handler(add_conv)
 
     edit_conv = ConversationHandler(
+        name='edit',
+        persistent=True,
         entry_points=[CallbackQueryHandler(edit_task_start, pattern=r'^edit_')],
         states={
             EDIT_TASK_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_task_category)],
@@ -871,6 +954,8 @@ def main():
     application.add_handler(edit_conv)
 
     tag_conv = ConversationHandler(
+        name='tag',
+        persistent=True,
         entry_points=[CallbackQueryHandler(add_tag_start, pattern=r'^tag_')],
         states={
             EDIT_TASK_TAGS: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_tags_to_task)],
@@ -880,6 +965,8 @@ def main():
     application.add_handler(tag_conv)
 
     cat_conv = ConversationHandler(
+        name='categories',
+        persistent=True,
         entry_points=[CommandHandler('categories', categories_menu), CallbackQueryHandler(categories_menu, pattern='^categories$')],
         states={
             CATEGORY_MENU: [
@@ -895,6 +982,8 @@ def main():
     application.add_handler(cat_conv)
 
     filter_conv = ConversationHandler(
+        name='filter',
+        persistent=True,
         entry_points=[CommandHandler('filter', filter_menu), CallbackQueryHandler(filter_menu, pattern='^filter$')],
         states={
             FILTER_MENU: [
@@ -911,6 +1000,8 @@ def main():
     application.add_handler(filter_conv)
 
     settings_conv = ConversationHandler(
+        name='settings',
+        persistent=True,
         entry_points=[CommandHandler('settings', settings_menu), CallbackQueryHandler(settings_menu, pattern='^settings$')],
         states={
             SETTINGS_MENU: [
@@ -926,11 +1017,31 @@ def main():
     application.add_handler(CallbackQueryHandler(delete_task, pattern=r'^delete_'))
     application.add_handler(CallbackQueryHandler(restore_task, pattern=r'^restore_'))
     application.add_handler(CommandHandler('completed', list_completed))
+    application.add_handler(CommandHandler('search', search))
+    application.add_handler(CallbackQueryHandler(search, pattern=r'^search_page_\d+$'))
+    application.add_handler(CallbackQueryHandler(list_completed, pattern=r'^completed_page_\d+_[ab]\d+_\d+$'))
     application.add_handler(CallbackQueryHandler(cancel, pattern='^cancel$'))
+    application.add_error_handler(on_error)
 
-    schedule_reminder_job(application)
+    instrument_application(application)
+    return application
 
-    application.run_polling()
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s', level=LOG_LEVEL)
+    logger.debug('main')
+    application = build_application()
+    instrument_engine(async_engine.sync_engine)
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -1,77 +1,176 @@
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from .cache import LRUCache, user_cache
+from .config import KEYBOARD_CACHE_SIZE, KEYBOARD_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Готовые списки задач: ключ включает версию задач пользователя, поэтому любая
+# запись в bot.db делает старые записи недостижимыми, и их вытесняет LRU.
+task_list_cache = LRUCache(KEYBOARD_CACHE_SIZE, KEYBOARD_CACHE_TTL)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(item) for item in value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def task_list_key(user_id: int, view: str, filters: dict | None = None, cursor=None) -> tuple:
+    """Ключ task_list_cache: пользователь, вид списка, фильтры, курсор страницы и версия задач."""
+    return (user_id, view, _freeze(filters or {}), cursor, user_cache.version(user_id))
+
 
 def build_cancel_keyboard(text: str = 'Отмена') -> InlineKeyboardMarkup:
-    print('DEBUG: build_cancel_keyboard')
+    logger.debug('build_cancel_keyboard')
     return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data='cancel')]])
 
 
+def task_callback(action: str, task: dict) -> str:
+    """<action>_<id>_<version>: кнопка помнит версию задачи, которую видел пользователь."""
+    version = task.get('version')
+    return f"{action}_{task['id']}" if version is None else f"{action}_{task['id']}_{version}"
+
+
+def parse_task_callback(data: str) -> tuple[int, int | None]:
+    """<action>_<id>[_<version>] -> (id, version); у кнопок старых сообщений версии нет."""
+    _, task_id, *version = data.split('_')
+    return int(task_id), int(version[0]) if version else None
+
+
+def _tasks_page_callback(page: int, direction: str, task: dict) -> str:
+    return f"tasks_page_{page}_{direction}{task['id']}"
+
+
+def _completed_task_row(task: dict) -> list[InlineKeyboardButton]:
+    return [
+        InlineKeyboardButton(
+            f"{task['title']} ({task.get('category', '')}, {task.get('priority', '')})" +
+            (f" [{', '.join(task.get('tags', []))}]" if task.get('tags') else '') + ' ✓',
+            callback_data=task_callback('restore', task)
+        )
+    ]
+
+
 def build_keyboard(
     tasks,
     include_add_button: bool = False,
     include_back_button: bool = False,
     page: int | None = None,
     total_pages: int | None = None,
+    nav_callback: Callable[[int, str, dict], str] | None = None,
+    include_completed: bool = False,
 ) -> InlineKeyboardMarkup | None:
-    print('DEBUG: build_keyboard')
+    """Клавиатура активных задач.
+
+    ``nav_callback(page, 'a'|'b', task)`` строит callback_data кнопок листания
+    по целевой странице и задаче на краю текущей; по умолчанию — keyset-курсоры /tasks.
+    С ``include_completed`` выполненные задачи показываются кнопкой восстановления,
+    как в списке выполненных, а не пропускаются.
+    """
+    logger.debug('build_keyboard')
+    nav_callback = nav_callback or _tasks_page_callback
     keyboard = []
-    print(f'DEBUG: build_keyboard received {len(tasks)} tasks')
+    logger.debug('build_keyboard received %s tasks', len(tasks))
     for task in tasks:
         if not task.get('done'):
             keyboard.append([
                 InlineKeyboardButton(
                     f"{task['title']} ({task.get('category', '')}, {task.get('priority', '')})" +
                     (f" [{', '.join(task.get('tags', []))}]" if task.get('tags') else ''),
-                    callback_data=f"task_{task['id']}"
+                    callback_data=task_callback('task', task)
                 )
             ])
             keyboard.append([
-                InlineKeyboardButton('🏷️', callback_data=f"tag_{task['id']}"),
-                InlineKeyboardButton('✏️', callback_data=f"edit_{task['id']}"),
-                InlineKeyboardButton('🗑️', callback_data=f"delete_{task['id']}"),
+                InlineKeyboardButton('🏷️', callback_data=task_callback('tag', task)),
+                InlineKeyboardButton('✏️', callback_data=task_callback('edit', task)),
+                InlineKeyboardButton('🗑️', callback_data=task_callback('delete', task)),
             ])
+        elif include_completed:
+            keyboard.append(_completed_task_row(task))
     if page is not None and total_pages is not None and total_pages > 1:
+        # keyset-курсоры: назад — задачи до первой на странице, вперёд — после последней
         nav_row = []
-        if page > 0:
-            nav_row.append(InlineKeyboardButton('◀️', callback_data=f'tasks_page_{page - 1}'))
+        if page > 0 and tasks:
+            nav_row.append(InlineKeyboardButton('◀️', callback_data=nav_callback(page - 1, 'b', tasks[0])))
         nav_row.append(InlineKeyboardButton(f'{page + 1}/{total_pages}', callback_data='tasks_page_info'))
-        if page < total_pages - 1:
-            nav_row.append(InlineKeyboardButton('▶️', callback_data=f'tasks_page_{page + 1}'))
+        if page < total_pages - 1 and tasks:
+            nav_row.append(InlineKeyboardButton('▶️', callback_data=nav_callback(page + 1, 'a', tasks[-1])))
         keyboard.append(nav_row)
     if include_add_button:
         keyboard.append([InlineKeyboardButton('Добавить задачу', callback_data='add_task')])
     if include_back_button:
         keyboard.append([InlineKeyboardButton('Назад', callback_data='cancel')])
     if keyboard:
-        print(f'DEBUG: build_keyboard -> {len(keyboard)} rows')
+        logger.debug('build_keyboard -> %s rows', len(keyboard))
         return InlineKeyboardMarkup(keyboard)
-    print('WARNING: build_keyboard produced empty keyboard')
+    logger.debug('build_keyboard produced empty keyboard')
     return InlineKeyboardMarkup([[InlineKeyboardButton('Добавить задачу', callback_data='add_task')]]) if include_add_button else None
 
 
-def build_completed_keyboard(tasks, include_back_button: bool = False) -> InlineKeyboardMarkup | None:
-    print('DEBUG: build_completed_keyboard')
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def completed_page_callback(page: int, direction: str, task: dict) -> str:
+    """completed_page_<page>_<a|b><completed_at в мкс>_<id>: курсор по задаче на краю страницы."""
+    return f"completed_page_{page}_{direction}{(task['completed_at'] - _EPOCH) // _MICROSECOND}_{task['id']}"
+
+
+def parse_completed_page_callback(data: str):
+    """completed_page_... -> (page, after, before); курсоры — (completed_at, id)."""
+    try:
+        _, _, page, cursor, task_id = data.split('_')
+        cursor_key = (_EPOCH + int(cursor[1:]) * _MICROSECOND, int(task_id))
+        page = int(page)
+    except ValueError:
+        return 0, None, None
+    if cursor[0] == 'a':
+        return page, cursor_key, None
+    if cursor[0] == 'b':
+        return page, None, cursor_key
+    return 0, None, None
+
+
+def build_completed_keyboard(
+    tasks,
+    include_back_button: bool = False,
+    page: int | None = None,
+    total_pages: int | None = None,
+) -> InlineKeyboardMarkup | None:
+    logger.debug('build_completed_keyboard')
     keyboard = []
-    print(f'DEBUG: build_completed_keyboard received {len(tasks)} tasks')
+    logger.debug('build_completed_keyboard received %s tasks', len(tasks))
     for task in tasks:
         if task.get('done'):
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{task['title']} ({task.get('category', '')}, {task.get('priority', '')})" +
-                    (f" [{', '.join(task.get('tags', []))}]" if task.get('tags') else '') + ' ✓',
-                    callback_data=f"restore_{task['id']}"
-                )
-            ])
+            keyboard.append(_completed_task_row(task))
+    if page is not None and total_pages is not None and total_pages > 1 and tasks:
+        # от новых к старым: назад — задачи новее первой на странице, вперёд — старше последней
+        nav_row = []
+        if page > 0:
+            nav_row.append(InlineKeyboardButton('◀️', callback_data=completed_page_callback(page - 1, 'b', tasks[0])))
+        nav_row.append(InlineKeyboardButton(f'{page + 1}/{total_pages}', callback_data='tasks_page_info'))
+        if page < total_pages - 1:
+            nav_row.append(InlineKeyboardButton('▶️', callback_data=completed_page_callback(page + 1, 'a', tasks[-1])))
+        keyboard.append(nav_row)
     if include_back_button:
         keyboard.append([InlineKeyboardButton('Назад', callback_data='cancel')])
     if keyboard:
-        print(f'DEBUG: build_completed_keyboard -> {len(keyboard)} rows')
+        logger.debug('build_completed_keyboard -> %s rows', len(keyboard))
         return InlineKeyboardMarkup(keyboard)
     return None
 
 
 def build_category_keyboard(categories, include_new=True):
-    print('DEBUG: build_category_keyboard')
+    logger.debug('build_category_keyboard')
     keyboard = [[InlineKeyboardButton(cat, callback_data=f"choose_cat_{i}")]
                 for i, cat in enumerate(categories)]
     if include_new:
@@ -81,7 +180,7 @@ def build_category_keyboard(categories, include_new=True):
 
 
 def build_priority_keyboard():
-    print('DEBUG: build_priority_keyboard')
+    logger.debug('build_priority_keyboard')
     keyboard = [
         [InlineKeyboardButton('низкий', callback_data='priority_низкий')],
         [InlineKeyboardButton('средний', callback_data='priority_средний')],
@@ -91,38 +190,53 @@ def build_priority_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
-def build_filter_category_keyboard(categories):
-    print('DEBUG: build_filter_category_keyboard')
-    keyboard = [[InlineKeyboardButton(cat, callback_data=f"fcat_{i}")]
+def _with_count(label: str, counts: dict | None, key=None) -> str:
+    """Подпись варианта фильтра с числом активных задач: «Дом (3)»."""
+    if counts is None:
+        return label
+    return f"{label} ({counts.get(label if key is None else key, 0)})"
+
+
+def build_filter_category_keyboard(categories, counts: dict | None = None):
+    logger.debug('build_filter_category_keyboard')
+    keyboard = [[InlineKeyboardButton(_with_count(cat, counts), callback_data=f"fcat_{i}")]
                 for i, cat in enumerate(categories)]
     keyboard.append([InlineKeyboardButton('Любая', callback_data='fcat_none')])
     keyboard.append([InlineKeyboardButton('Назад', callback_data='filter')])
     return InlineKeyboardMarkup(keyboard)
 
 
-def build_filter_priority_keyboard():
-    print('DEBUG: build_filter_priority_keyboard')
+def build_filter_priority_keyboard(counts: dict | None = None):
+    logger.debug('build_filter_priority_keyboard')
     keyboard = [
-        [InlineKeyboardButton('низкий', callback_data='fprio_низкий')],
-        [InlineKeyboardButton('средний', callback_data='fprio_средний')],
-        [InlineKeyboardButton('высокий', callback_data='fprio_высокий')],
+        [InlineKeyboardButton(_with_count('низкий', counts), callback_data='fprio_низкий')],
+        [InlineKeyboardButton(_with_count('средний', counts), callback_data='fprio_средний')],
+        [InlineKeyboardButton(_with_count('высокий', counts), callback_data='fprio_высокий')],
         [InlineKeyboardButton('Любой', callback_data='fprio_none')],
         [InlineKeyboardButton('Назад', callback_data='filter')],
     ]
     return InlineKeyboardMarkup(keyboard)
 
 
-def build_filter_tag_keyboard(tags):
-    print('DEBUG: build_filter_tag_keyboard')
-    keyboard = [[InlineKeyboardButton(tag, callback_data=f"ftag_{i}")]
+def build_filter_tag_keyboard(tags, selected=(), mode: str = 'all', counts: dict | None = None):
+    """Теги переключаются по нажатию; ``mode`` — "all" (все выбранные) или "any" (любой из них)."""
+    logger.debug('build_filter_tag_keyboard')
+    keyboard = [[InlineKeyboardButton(_with_count(f"✅ {tag}" if tag in selected else tag, counts, tag),
+                                      callback_data=f"ftag_{i}")]
                 for i, tag in enumerate(tags)]
-    keyboard.append([InlineKeyboardButton('Любой', callback_data='ftag_none')])
+    keyboard.append([InlineKeyboardButton(
+        'Режим: все выбранные' if mode == 'all' else 'Режим: любой из выбранных', callback_data='ftag_mode'
+    )])
+    keyboard.append([
+        InlineKeyboardButton('Показать', callback_data='ftag_apply'),
+        InlineKeyboardButton('Любой', callback_data='ftag_none'),
+    ])
     keyboard.append([InlineKeyboardButton('Назад', callback_data='filter')])
     return InlineKeyboardMarkup(keyboard)
 
 
 def build_tag_keyboard(tags, include_new=True):
-    print('DEBUG: build_tag_keyboard')
+    logger.debug('build_tag_keyboard')
     keyboard = [[InlineKeyboardButton(tag, callback_data=f"choose_tag_{i}")]
                 for i, tag in enumerate(tags)]
     if include_new:
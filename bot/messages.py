@@ -0,0 +1,127 @@
+"""Учёт сообщений бота по чатам."""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+from .cache import LRUCache
+from .config import MESSAGE_FLUSH_INTERVAL, TRACKED_MESSAGES_PER_CHAT
+from .db import pop_bot_messages, save_bot_messages
+
+logger = logging.getLogger(__name__)
+
+# сколько последних сообщений помнить в одном чате и сколько чатов держать
+HASHES_PER_CHAT = 20
+HASH_CHATS_MAX = 10_000
+HASH_TTL = 24 * 60 * 60
+
+
+def content_hash(text: str, reply_markup=None) -> str:
+    payload = text + "\0" + (reply_markup.to_json() if reply_markup is not None else "")
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class MessageHashStore:
+    """Хэши текста и клавиатуры последних сообщений бота: повторная правка тем же содержимым не нужна.
+
+    ``saved`` считает вызовы Bot API, которые не пришлось делать.
+    """
+
+    def __init__(self, per_chat: int = HASHES_PER_CHAT, max_chats: int = HASH_CHATS_MAX, ttl: float = HASH_TTL):
+        self.per_chat = per_chat
+        self._chats = LRUCache(max_chats, ttl)
+        self.saved = 0
+
+    def _chat(self, chat_id: int, create: bool = False) -> OrderedDict | None:
+        hashes = self._chats.get(chat_id)
+        if hashes is None and create:
+            hashes = OrderedDict()
+            self._chats.set(chat_id, hashes)
+        return hashes
+
+    def remember(self, chat_id: int, message_id: int, text: str, reply_markup=None):
+        hashes = self._chat(chat_id, create=True)
+        hashes[message_id] = content_hash(text, reply_markup)
+        hashes.move_to_end(message_id)
+        while len(hashes) > self.per_chat:
+            hashes.popitem(last=False)
+
+    def is_unchanged(self, chat_id: int, message_id: int, text: str, reply_markup=None) -> bool:
+        hashes = self._chat(chat_id)
+        if hashes is None or hashes.get(message_id) != content_hash(text, reply_markup):
+            return False
+        self.saved += 1
+        return True
+
+    def forget(self, chat_id: int, message_id: int):
+        hashes = self._chat(chat_id)
+        if hashes is not None:
+            hashes.pop(message_id, None)
+
+
+message_hashes = MessageHashStore()
+
+
+class MessageTracker:
+    """Id сообщений бота, которые /start удаляет из чата.
+
+    Новые id копятся в памяти (не больше ``per_chat`` на чат) и раз в
+    ``flush_interval`` секунд одним запросом дописываются в таблицу
+    ``bot_messages``, где тоже хранится не больше ``per_chat`` на чат. Так
+    список переживает перезапуск, а отправка сообщения не ждёт базу.
+    """
+
+    def __init__(self, per_chat: int = TRACKED_MESSAGES_PER_CHAT, flush_interval: float = MESSAGE_FLUSH_INTERVAL):
+        self.per_chat = per_chat
+        self.flush_interval = flush_interval
+        self._pending: dict[int, list[int]] = {}
+        self._task: asyncio.Task | None = None
+
+    def remember(self, chat_id: int, message_id: int):
+        pending = self._pending.setdefault(chat_id, [])
+        pending.append(message_id)
+        if len(pending) > self.per_chat:
+            del pending[0]
+
+    def pending(self) -> int:
+        return sum(len(ids) for ids in self._pending.values())
+
+    async def take(self, chat_id: int) -> list[int]:
+        """Забирает все отслеживаемые сообщения чата: из памяти и из базы."""
+        pending = self._pending.pop(chat_id, [])
+        stored = await pop_bot_messages(chat_id)
+        return sorted(set(stored) | set(pending))[-self.per_chat:]
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await save_bot_messages(batch, self.per_chat)
+        except Exception:
+            logger.exception("Failed to persist bot messages for %d chats", len(batch))
+            # вернём в буфер до следующей попытки, сохраняя ограничение на чат
+            for chat_id, message_ids in batch.items():
+                merged = message_ids + self._pending.get(chat_id, [])
+                self._pending[chat_id] = merged[-self.per_chat:]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+
+message_tracker = MessageTracker()
@@ -0,0 +1,351 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Что собирается:
+
+- ``bot_update_seconds`` / ``bot_handler_seconds`` — время обработки апдейта и
+  каждого обработчика (обёртки ставит ``instrument_application``);
+- ``bot_db_queries_per_update``, ``bot_db_query_seconds`` — число и длительность
+  SQL-запросов, по событиям движка SQLAlchemy;
+- ``bot_api_seconds``, ``bot_api_errors_total`` — вызовы Bot API (``InstrumentedRequest``);
+- ``bot_job_lag_seconds`` — насколько позже расписания стартуют задачи JobQueue;
+- показатели очереди отправки и кэшей, которые снимаются в момент запроса.
+
+``start_metrics_server`` отдаёт всё это по ``GET /metrics``.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+from sqlalchemy import event
+from telegram.ext import Application, ConversationHandler
+from telegram.request import HTTPXRequest
+
+from .cache import user_cache
+from .db import uow_stats
+from .db_orm.session import async_engine
+from .keyboards import task_list_cache
+from .messages import message_hashes, message_tracker
+from .outbox import outbox
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            # счётчики по корзинам (+Inf последней), сумма, количество
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Значение снимается функцией ``collect`` в момент выдачи метрик: ``{labels: value}``."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, collect: Callable[[], dict], labelnames: Iterable[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        return self.header() + [
+            f"{self.name}{_labels(self.labelnames, labels)} {value}" for labels, value in self.collect().items()
+        ]
+
+
+class CounterFunc(Gauge):
+    """Счётчик, который ведёт сам объект (очередь, кэш): значение так же снимается ``collect``."""
+
+    kind = "counter"
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    lines: list[str] = []
+    for metric in REGISTRY:
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            logger.exception("Failed to render metric %s", metric.name)
+    return "\n".join(lines) + "\n"
+
+
+update_seconds = Histogram("bot_update_seconds", "Time to process one update")
+handler_seconds = Histogram("bot_handler_seconds", "Handler callback latency", ["handler"])
+handler_errors = Counter("bot_handler_errors_total", "Handler callbacks that raised", ["handler"])
+db_queries_per_update = Histogram(
+    "bot_db_queries_per_update", "SQL statements executed while processing one update", buckets=COUNT_BUCKETS
+)
+db_query_seconds = Histogram("bot_db_query_seconds", "SQL statement duration")
+api_seconds = Histogram("bot_api_seconds", "Bot API call latency", ["method"])
+api_errors = Counter("bot_api_errors_total", "Failed Bot API calls", ["method", "code"])
+job_lag_seconds = Histogram("bot_job_lag_seconds", "Delay between scheduled and actual JobQueue run", ["job"])
+
+Gauge("bot_outbox_depth", "Queued Bot API calls", lambda: {(): outbox.stats()["depth"]})
+CounterFunc("bot_outbox_calls_total", "Bot API calls handled by the outbox", lambda: {
+    (result,): outbox.stats()[result] for result in ("sent", "failed", "retry_after")
+}, ["result"])
+Gauge("bot_outbox_lane_wait_seconds", "Average and max queue wait per lane", lambda: {
+    (lane, stat): values[stat]
+    for lane, values in outbox.stats()["lanes"].items()
+    for stat in ("wait_avg", "wait_max")
+}, ["lane", "stat"])
+Gauge("bot_cache", "Cache hits, misses and size", lambda: {
+    (name, stat): value
+    for name, cache in (("user", user_cache), ("task_list", task_list_cache))
+    for stat, value in cache.stats().items()
+}, ["cache", "stat"])
+CounterFunc("bot_edits_skipped_total", "Message edits skipped because content did not change", lambda: {
+    (): message_hashes.saved
+})
+Gauge("bot_tracked_messages_pending", "Bot message ids not yet written to bot_messages", lambda: {
+    (): message_tracker.pending()
+})
+Gauge("bot_db_pool", "Async engine connection pool: size, connections in use and overflow", lambda: {
+    ("size",): async_engine.pool.size(),
+    ("checked_out",): async_engine.pool.checkedout(),
+    ("overflow",): async_engine.pool.overflow(),
+}, ["stat"])
+CounterFunc("bot_db_units_of_work_total", "Per-update transactions committed and rolled back", lambda: {
+    (result,): count for result, count in uow_stats.items()
+}, ["result"])
+
+
+# --- SQL ---
+
+_update_queries: contextvars.ContextVar[list | None] = contextvars.ContextVar("update_queries", default=None)
+
+
+def instrument_engine(engine):
+    """Подписывается на события движка: длительность каждого запроса и счётчик запросов текущего апдейта."""
+
+    # время старта живёт на контексте выполнения: если запрос упал, after_cursor_execute
+    # не придёт, и контекст просто уйдёт вместе с запросом
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        if started is not None:
+            db_query_seconds.observe(time.perf_counter() - started)
+        counter = _update_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+
+# --- обработчики и апдейты ---
+
+def _wrap_callback(handler):
+    callback = handler.callback
+    if getattr(callback, "_instrumented", False):
+        return
+    name = getattr(callback, "__name__", type(handler).__name__)
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+    timed._instrumented = True
+    handler.callback = timed
+
+
+def _walk_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _walk_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _walk_handlers(state_handlers)
+            yield from _walk_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+
+def instrument_application(application: Application):
+    """Оборачивает обработчики замером времени и подписывается на запуски JobQueue."""
+    for group in application.handlers.values():
+        for handler in _walk_handlers(group):
+            _wrap_callback(handler)
+    if application.job_queue:
+        _listen_job_lag(application)
+
+
+async def observe_update(coroutine):
+    """Выполняет обработку апдейта, замеряя время и число SQL-запросов."""
+    counter = [0]
+    token = _update_queries.set(counter)
+    started = time.perf_counter()
+    try:
+        return await coroutine
+    finally:
+        update_seconds.observe(time.perf_counter() - started)
+        db_queries_per_update.observe(counter[0])
+        _update_queries.reset(token)
+
+
+class InstrumentedApplication(Application):
+    async def process_update(self, update: object) -> None:
+        await observe_update(super().process_update(update))
+
+
+# --- JobQueue ---
+
+def _listen_job_lag(application: Application):
+    from apscheduler.events import EVENT_JOB_SUBMITTED
+
+    scheduler = application.job_queue.scheduler
+
+    def on_submitted(job_event):
+        job = scheduler.get_job(job_event.job_id)
+        name = job.name if job is not None else "unknown"
+        now = time.time()
+        for scheduled in job_event.scheduled_run_times:
+            job_lag_seconds.observe(max(0.0, now - scheduled.timestamp()), name)
+
+    scheduler.add_listener(on_submitted, EVENT_JOB_SUBMITTED)
+
+
+# --- Bot API ---
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет время и ошибки каждого метода Bot API."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as exc:
+            api_errors.inc(api_method, type(exc).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, api_method)
+        if code >= 400:
+            api_errors.inc(api_method, str(code))
+        return code, payload
+
+
+# --- HTTP ---
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_server: asyncio.AbstractServer | None = None
+
+
+async def start_metrics_server(host: str, port: int):
+    global _server
+    if _server is not None or not port:
+        return
+    _server = await asyncio.start_server(_serve, host, port)
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+
+
+async def stop_metrics_server():
+    global _server
+    if _server is None:
+        return
+    _server.close()
+    await _server.wait_closed()
+    _server = None
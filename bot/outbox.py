@@ -0,0 +1,286 @@
+"""Очередь исходящих вызовов Bot API.
+
+Все отправки, правки и удаления сообщений проходят через ``outbox``:
+
+- общий token bucket на бота и отдельный на каждый чат;
+- две полосы приоритета: ответы пользователю идут раньше рассылки дайджестов;
+- чат, исчерпавший свой бакет, откладывается целиком и возвращается в очередь по
+  таймеру: воркер не спит на одном чате, а порядок сообщений в чате сохраняется;
+- при ``RetryAfter`` очередь ставится на паузу на указанное Telegram время и
+  вызов повторяется, при сетевых ошибках — повтор с экспоненциальной задержкой;
+  новые сообщения повторяются, только если запрос не ушёл в Telegram, иначе
+  таймаут мог бы отправить сообщение дважды;
+- очередь ограничена по размеру: при переполнении отправитель ждёт;
+- ``stats()`` отдаёт глубину очереди и время ожидания по полосам.
+
+Если воркеры не запущены (скрипты, бенчмарки), вызовы выполняются сразу.
+"""
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Awaitable, Callable
+
+import httpx
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from .config import (
+    OUTBOX_CHAT_BURST,
+    OUTBOX_CHAT_RATE,
+    OUTBOX_GLOBAL_RATE,
+    OUTBOX_MAX_RETRIES,
+    OUTBOX_MAXSIZE,
+    OUTBOX_WORKERS,
+)
+from .cache import LRUCache
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+BULK = 1
+LANES = {INTERACTIVE: "interactive", BULK: "bulk"}
+# бакеты неактивных чатов выбрасываются: сброс бакета лишь возвращает чату запас токенов
+_CHAT_BUCKETS_MAX = 10_000
+_CHAT_BUCKET_IDLE = 600
+# ошибки httpx до отправки запроса: соединение не установлено или пул занят
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+@dataclass
+class _LaneStats:
+    depth: int = 0
+    processed: int = 0
+    wait_sum: float = 0.0
+    wait_max: float = 0.0
+
+
+@dataclass(order=True)
+class _Call:
+    priority: int
+    seq: int
+    chat_id: int | None = field(compare=False)
+    factory: Callable[[], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    idempotent: bool = field(default=True, compare=False)
+
+
+def _retry_after_seconds(exc: RetryAfter) -> float:
+    delay = exc.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+
+def _retryable(item: _Call, exc: NetworkError) -> bool:
+    # таймаут чтения у send_message не значит, что сообщение не дошло
+    return item.idempotent or isinstance(exc.__cause__, _NOT_SENT)
+
+
+class Outbox:
+    def __init__(
+        self,
+        global_rate: float = OUTBOX_GLOBAL_RATE,
+        chat_rate: float = OUTBOX_CHAT_RATE,
+        chat_burst: float = OUTBOX_CHAT_BURST,
+        maxsize: int = OUTBOX_MAXSIZE,
+        workers: int = OUTBOX_WORKERS,
+        max_retries: int = OUTBOX_MAX_RETRIES,
+    ):
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.maxsize = maxsize
+        self.worker_count = workers
+        self.max_retries = max_retries
+        self._chat_buckets = LRUCache(_CHAT_BUCKETS_MAX, _CHAT_BUCKET_IDLE)
+        self._queue: asyncio.PriorityQueue[_Call] | None = None
+        self._slots: asyncio.Semaphore | None = None
+        # чаты, ждущие токена: их вызовы по порядку, пока не сработает таймер
+        self._deferred: dict[int, list[_Call]] = {}
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self.lanes = {lane: _LaneStats() for lane in LANES}
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+
+    # --- жизненный цикл ---
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self):
+        if self.running:
+            return
+        # размер ограничивает семафор: отложенные вызовы держат своё место и
+        # возвращаются в очередь без ожидания
+        self._queue = asyncio.PriorityQueue()
+        self._slots = asyncio.Semaphore(self.maxsize)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        """Дожидается отправки уже поставленных вызовов и останавливает воркеров."""
+        if not self.running:
+            return
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    # --- постановка в очередь ---
+
+    async def call(
+        self,
+        chat_id: int | None,
+        factory: Callable[[], Awaitable[Any]],
+        priority: int = INTERACTIVE,
+        idempotent: bool = True,
+    ):
+        """Выполняет ``factory()`` с учётом лимитов и возвращает его результат.
+
+        ``idempotent=False`` — повтор после отправки запроса может задвоить результат.
+        """
+        if not self.running:
+            return await factory()
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        item = _Call(priority, next(self._seq), chat_id, factory, loop.create_future(), loop.time(), idempotent)
+        self.lanes[priority].depth += 1
+        self._queue.put_nowait(item)
+        return await item.future
+
+    async def send_message(self, bot, chat_id: int, text: str, reply_markup=None, priority: int = INTERACTIVE):
+        return await self.call(
+            chat_id,
+            lambda: bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup),
+            priority,
+            idempotent=False,
+        )
+
+    async def reply_text(self, message, text: str, reply_markup=None, priority: int = INTERACTIVE):
+        return await self.call(
+            message.chat_id, lambda: message.reply_text(text, reply_markup=reply_markup), priority, idempotent=False
+        )
+
+    async def edit_text(self, message, text: str, reply_markup=None, priority: int = INTERACTIVE):
+        return await self.call(message.chat_id, lambda: message.edit_text(text, reply_markup=reply_markup), priority)
+
+    async def delete_message(self, bot, chat_id: int, message_id: int, priority: int = INTERACTIVE):
+        return await self.call(chat_id, lambda: bot.delete_message(chat_id=chat_id, message_id=message_id), priority)
+
+    async def delete_messages(self, bot, chat_id: int, message_ids: list[int], priority: int = INTERACTIVE):
+        return await self.call(chat_id, lambda: bot.delete_messages(chat_id=chat_id, message_ids=message_ids), priority)
+
+    # --- обработка ---
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        # set продлевает TTL: бакет живёт, пока в чат пишут
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _defer(self, item: _Call) -> bool:
+        """Забирает токен чата; если его нет, откладывает вызов и возвращает True."""
+        if item.chat_id is None:
+            return False
+        deferred = self._deferred.get(item.chat_id)
+        if deferred is not None:
+            # чат уже ждёт: встаём за его вызовами, чтобы не обогнать их
+            deferred.append(item)
+            return True
+        wait = self._chat_bucket(item.chat_id).try_acquire()
+        if not wait:
+            return False
+        self._deferred[item.chat_id] = [item]
+        asyncio.get_running_loop().call_later(wait, self._requeue, item.chat_id)
+        return True
+
+    def _requeue(self, chat_id: int):
+        for item in self._deferred.pop(chat_id, ()):
+            self._queue.put_nowait(item)
+            # get() этого вызова закрывается только теперь, чтобы join() его дождался
+            self._queue.task_done()
+
+    async def _wait_limits(self, chat_id: int | None, retry: bool):
+        loop = asyncio.get_running_loop()
+        while (pause := self._paused_until - loop.time()) > 0:
+            await asyncio.sleep(pause)
+        if retry and chat_id is not None:
+            # токен первой попытки взял _defer; повторы редки, их можно подождать
+            await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    async def _execute(self, item: _Call):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self._wait_limits(item.chat_id, retry=attempt > 0)
+            try:
+                return await item.factory()
+            except RetryAfter as exc:
+                if attempt == self.max_retries:
+                    raise
+                delay = _retry_after_seconds(exc)
+                self.retry_after += 1
+                logger.warning("Flood limit hit, pausing outbox for %.1fs", delay)
+                self._paused_until = max(self._paused_until, loop.time() + delay)
+            except BadRequest:
+                # BadRequest наследует NetworkError, но повтор его не исправит
+                raise
+            except NetworkError as exc:
+                if attempt == self.max_retries or not _retryable(item, exc):
+                    raise
+                await asyncio.sleep(min(30.0, 0.5 * 2 ** attempt))
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if self._defer(item):
+                continue
+            lane = self.lanes[item.priority]
+            lane.depth -= 1
+            waited = loop.time() - item.enqueued_at
+            lane.processed += 1
+            lane.wait_sum += waited
+            lane.wait_max = max(lane.wait_max, waited)
+            try:
+                result = await self._execute(item)
+            except Exception as exc:
+                self.failed += 1
+                if not item.future.done():
+                    item.future.set_exception(exc)
+            else:
+                self.sent += 1
+                if not item.future.done():
+                    item.future.set_result(result)
+            finally:
+                self._slots.release()
+                self._queue.task_done()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "depth": sum(lane.depth for lane in self.lanes.values()),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "lanes": {
+                name: {
+                    "depth": self.lanes[lane].depth,
+                    "processed": self.lanes[lane].processed,
+                    "wait_avg": self.lanes[lane].wait_sum / self.lanes[lane].processed if self.lanes[lane].processed else 0.0,
+                    "wait_max": self.lanes[lane].wait_max,
+                }
+                for lane, name in LANES.items()
+            },
+        }
+
+
+outbox = Outbox()
@@ -0,0 +1,228 @@
+"""Хранение user_data, chat_data и состояний диалогов в Postgres.
+
+- PTB раз в ``PERSISTENCE_FLUSH_INTERVAL`` секунд передаёт изменившиеся
+  данные; они копятся в буфере и пишутся одной транзакцией пакетными
+  upsert-ами. Записи, не изменившиеся с прошлой записи, пропускаются.
+- При старте user_data и chat_data не загружаются: данные пользователя или
+  чата читаются из базы при первом его апдейте (``refresh_*``).
+- Пользователи и чаты без апдейтов дольше ``PERSISTENCE_IDLE_TTL`` секунд
+  выгружаются из памяти; в базе их данные остаются.
+
+Состояния диалогов PTB читает целиком при старте, но их немного: завершённый
+диалог удаляет свою запись.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any
+
+from telegram.ext import Application, BasePersistence, CallbackContext, PersistenceInput
+
+from .config import PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_IDLE_TTL
+from .db import load_conversations, load_state, save_persistence
+from .metrics import Gauge
+
+logger = logging.getLogger(__name__)
+
+USER = "user"
+CHAT = "chat"
+# изменения, переданные PTB одной пачкой, собираются столько секунд перед записью
+_FLUSH_DELAY = 0.05
+
+
+def _encode(data: dict) -> str:
+    return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+
+class PostgresPersistence(BasePersistence):
+    def __init__(self, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL, idle_ttl: float = PERSISTENCE_IDLE_TTL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self.idle_ttl = idle_ttl
+        self._dirty: dict[tuple[str, int], dict | None] = {}
+        self._dirty_conversations: dict[tuple[str, str], Any] = {}
+        # последнее записанное в базу содержимое: неизменившиеся данные не пишем повторно
+        self._written: dict[tuple[str, int], str] = {}
+        self._loaded: set[tuple[str, int]] = set()
+        self._last_seen: dict[tuple[str, int], float] = {}
+        self._evicting: set[tuple[str, int]] = set()
+        # данные, заново открытые после выгрузки до того, как PTB передал drop_*_data
+        self._revived: dict[tuple[str, int], dict] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+
+    # --- чтение ---
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict[tuple, object]:
+        return {tuple(json.loads(key)): state for key, state in (await load_conversations(name)).items()}
+
+    async def _refresh(self, scope: str, state_id: int, data: dict):
+        key = (scope, state_id)
+        self._last_seen[key] = time.monotonic()
+        if key in self._evicting:
+            # апдейт пришёл раньше, чем PTB передал drop_*_data после выгрузки:
+            # его изменения PTB отбросит вместе с drop, их запишет _drop
+            self._revived[key] = data
+        if key in self._loaded:
+            return
+        # в загруженные попадаем только после успешного чтения: иначе следующая
+        # запись затёрла бы сохранённые данные почти пустыми
+        stored = await load_state(scope, state_id)
+        self._loaded.add(key)
+        if stored:
+            self._written[key] = _encode(stored)
+            # то, что успели записать в память до загрузки, новее сохранённого
+            data.update({k: v for k, v in stored.items() if k not in data})
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        await self._refresh(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        await self._refresh(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- запись ---
+
+    def _mark(self, scope: str, state_id: int, data: dict | None):
+        key = (scope, state_id)
+        if data:
+            encoded = _encode(data)
+            if self._written.get(key) == encoded:
+                self._dirty.pop(key, None)
+                return
+            self._dirty[key] = json.loads(encoded)
+        elif key in self._written:
+            self._dirty[key] = None
+        else:
+            return
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._mark(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._mark(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None):
+        self._dirty_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int):
+        self._drop(USER, user_id)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._drop(CHAT, chat_id)
+
+    def _drop(self, scope: str, state_id: int):
+        key = (scope, state_id)
+        if key in self._evicting:
+            # выгрузка из памяти (см. _evict_idle), а не удаление данных
+            self._evicting.discard(key)
+            revived = self._revived.pop(key, None)
+            if revived is not None:
+                self._mark(scope, state_id, revived)
+            return
+        self._revived.pop(key, None)
+        self._loaded.discard(key)
+        self._last_seen.pop(key, None)
+        self._written.pop(key, None)
+        self._dirty[key] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_soon())
+
+    async def _flush_soon(self):
+        # PTB вызывает update_* для всех изменившихся записей разом: дождёмся всей пачки
+        await asyncio.sleep(_FLUSH_DELAY)
+        await self._write()
+
+    async def _write(self):
+        async with self._flush_lock:
+            if not self._dirty and not self._dirty_conversations:
+                return
+            states, self._dirty = self._dirty, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            try:
+                await save_persistence(states, conversations)
+            except Exception:
+                logger.exception("Failed to persist %d states and %d conversations", len(states), len(conversations))
+                # более новые изменения, пришедшие во время записи, важнее
+                self._dirty = {**states, **self._dirty}
+                self._dirty_conversations = {**conversations, **self._dirty_conversations}
+                return
+            for key, data in states.items():
+                if data is None:
+                    self._written.pop(key, None)
+                else:
+                    self._written[key] = _encode(data)
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._write()
+
+    # --- выгрузка неактивных ---
+
+    def schedule_eviction(self, application: Application):
+        application.job_queue.run_repeating(
+            self._evict_idle, interval=max(60.0, self.idle_ttl / 4), name="persistence_eviction"
+        )
+
+    async def _evict_idle(self, context: CallbackContext):
+        application = context.application
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [key for key, seen in self._last_seen.items() if seen < cutoff and key not in self._dirty]
+        for key in idle:
+            scope, state_id = key
+            # следующий апдейт должен заново прочитать данные из базы, даже если
+            # PTB ещё не успел передать нам drop_*_data
+            self._loaded.discard(key)
+            self._last_seen.pop(key, None)
+            self._written.pop(key, None)
+            self._evicting.add(key)
+            if scope == USER:
+                application.drop_user_data(state_id)
+            else:
+                application.drop_chat_data(state_id)
+        if idle:
+            logger.info("Evicted %d idle users/chats from memory", len(idle))
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "loaded": len(self._loaded),
+            "dirty": len(self._dirty) + len(self._dirty_conversations),
+        }
+
+
+persistence = PostgresPersistence()
+
+Gauge("bot_persistence_entries", "Users/chats loaded in memory and changes waiting to be written", lambda: {
+    (stat,): value for stat, value in persistence.stats().items()
+}, ["stat"])
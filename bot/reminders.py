@@ -0,0 +1,184 @@
+"""Рассылка ежедневных напоминаний одной минутной задачей JobQueue.
+
+Вместо отдельной задачи run_daily на каждого пользователя диспетчер держит
+индекс «(день недели, ЧЧ:ММ) -> пользователи». Раз в минуту он берёт корзину
+текущей минуты и раздаёт её пулу отправителей с ограничением одновременных
+отправок и общей скорости. Крупные корзины (все с «09:00») растягиваются на
+большую часть минуты, чтобы не бить залпом по Postgres и Telegram API.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Iterable
+
+from telegram.ext import Application, CallbackContext
+
+from .config import (
+    REMINDER_CONCURRENCY,
+    REMINDER_RATE,
+    REMINDER_SPREAD_SECONDS,
+    REMINDER_SPREAD_THRESHOLD,
+)
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = (0, 1, 2, 3, 4)
+ALL_DAYS = (0, 1, 2, 3, 4, 5, 6)
+# сколько пропущенных минут догонять, если тик запоздал
+MAX_CATCHUP_MINUTES = 5
+
+# данные для корзины загружаются пачками такого размера прямо перед отправкой
+PREFETCH_CHUNK = 500
+
+Slot = tuple[int, str]
+SendFunc = Callable[[CallbackContext, int, Any], Awaitable[None]]
+PrepareFunc = Callable[[list[int]], Awaitable[dict[int, Any]]]
+
+
+def reminder_slots(settings: dict) -> list[Slot]:
+    time_str = settings.get("reminder_time", "09:00")
+    hour, minute = map(int, time_str.split(":"))
+    notify_weekends = settings.get("notify_weekends", "0") == "1"
+    days = ALL_DAYS if notify_weekends else WEEKDAYS
+    return [(day, f"{hour:02d}:{minute:02d}") for day in days]
+
+
+class ReminderDispatcher:
+    def __init__(
+        self,
+        concurrency: int = REMINDER_CONCURRENCY,
+        rate: float = REMINDER_RATE,
+        spread_threshold: int = REMINDER_SPREAD_THRESHOLD,
+        spread_seconds: float = REMINDER_SPREAD_SECONDS,
+        send: SendFunc | None = None,
+        prepare: PrepareFunc | None = None,
+    ):
+        self.concurrency = concurrency
+        self.rate = TokenBucket(rate)
+        self.spread_threshold = spread_threshold
+        self.spread_seconds = spread_seconds
+        self._buckets: dict[Slot, set[int]] = {}
+        self._user_slots: dict[int, list[Slot]] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._send = send
+        self._prepare = prepare
+        self._tz = timezone.utc
+        self._last_tick: datetime | None = None
+
+    # --- индекс ---
+
+    def set_user(self, user_id: int, settings: dict):
+        self.remove_user(user_id)
+        slots = reminder_slots(settings)
+        for slot in slots:
+            self._buckets.setdefault(slot, set()).add(user_id)
+        self._user_slots[user_id] = slots
+
+    def remove_user(self, user_id: int):
+        for slot in self._user_slots.pop(user_id, ()):
+            bucket = self._buckets.get(slot)
+            if bucket is not None:
+                bucket.discard(user_id)
+                if not bucket:
+                    del self._buckets[slot]
+
+    def load(self, all_settings: dict[int, dict]):
+        self._buckets.clear()
+        self._user_slots.clear()
+        for user_id, settings in all_settings.items():
+            self.set_user(user_id, settings)
+
+    def due(self, weekday: int, hhmm: str) -> list[int]:
+        return sorted(self._buckets.get((weekday, hhmm), ()))
+
+    def __len__(self) -> int:
+        return len(self._user_slots)
+
+    # --- расписание ---
+
+    def start(self, application: Application, send: SendFunc, prepare: PrepareFunc | None = None):
+        """Запускает минутный тик.
+
+        ``prepare(user_ids)`` пакетно загружает данные для части корзины и
+        возвращает ``{user_id: payload}``; ``send(context, user_id, payload)``
+        отправляет напоминание одному пользователю. Пользователи, которых нет в
+        ответе ``prepare``, пропускаются.
+        """
+        self._send = send
+        self._prepare = prepare
+        defaults = application.bot.defaults
+        # run_daily трактовал наивное время так же: Defaults.tzinfo или UTC
+        self._tz = defaults.tzinfo if defaults and defaults.tzinfo else timezone.utc
+        for job in application.job_queue.get_jobs_by_name("reminder_dispatcher"):
+            job.schedule_removal()
+        now = datetime.now(self._tz)
+        self._last_tick = now.replace(second=0, microsecond=0)
+        next_minute = self._last_tick + timedelta(minutes=1)
+        application.job_queue.run_repeating(
+            self._tick,
+            interval=60,
+            first=(next_minute - now).total_seconds() + 0.5,
+            name="reminder_dispatcher",
+        )
+
+    async def _tick(self, context: CallbackContext):
+        now = datetime.now(self._tz).replace(second=0, microsecond=0)
+        last = self._last_tick or now - timedelta(minutes=1)
+        minute = max(last + timedelta(minutes=1), now - timedelta(minutes=MAX_CATCHUP_MINUTES - 1))
+        self._last_tick = now
+        while minute <= now:
+            user_ids = self.due(minute.weekday(), minute.strftime("%H:%M"))
+            if user_ids:
+                logger.info("Dispatching %d reminders for %s", len(user_ids), minute.strftime("%a %H:%M"))
+                # не ждём окончания: большая корзина может отправляться дольше минуты,
+                # а следующий тик не должен пропускаться
+                context.application.create_task(self.dispatch(context, user_ids))
+            minute += timedelta(minutes=1)
+
+    async def dispatch(self, context: CallbackContext, user_ids: Iterable[int]):
+        """Отправляет напоминания корзине пользователей с ограничением конкурентности и скорости."""
+        user_ids = list(user_ids)
+        spread = self.spread_seconds if len(user_ids) > self.spread_threshold else 0.0
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        queue: asyncio.Queue[tuple[int, Any] | None] = asyncio.Queue(maxsize=self.concurrency)
+
+        async def worker():
+            while (item := await queue.get()) is not None:
+                user_id, payload = item
+                async with self._semaphore:
+                    await self.rate.acquire()
+                    try:
+                        await self._send(context, user_id, payload)
+                    except Exception:
+                        logger.exception("Failed to send reminder to %s", user_id)
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(self.concurrency, len(user_ids)))]
+        for chunk_start in range(0, len(user_ids), PREFETCH_CHUNK):
+            chunk = user_ids[chunk_start:chunk_start + PREFETCH_CHUNK]
+            if self._prepare is not None:
+                try:
+                    payloads = await self._prepare(chunk)
+                except Exception:
+                    logger.exception("Failed to prefetch reminders for %d users", len(chunk))
+                    continue
+            else:
+                payloads = dict.fromkeys(chunk)
+            for index, user_id in enumerate(chunk, chunk_start):
+                if user_id not in payloads:
+                    logger.error("Skipping reminder for unregistered user %s", user_id)
+                    continue
+                if spread:
+                    delay = started + index * spread / len(user_ids) - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await queue.put((user_id, payloads[user_id]))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+
+reminder_dispatcher = ReminderDispatcher()
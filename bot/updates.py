@@ -0,0 +1,113 @@
+"""Параллельная обработка апдейтов с сохранением порядка внутри чата.
+
+Апдейты разных чатов обрабатываются одновременно (не больше
+``UPDATE_CONCURRENCY`` сразу), а апдейты одного чата — строго по очереди, в
+порядке поступления. Обработчики читают и меняют ``context.user_data`` и задачи
+пользователя в несколько шагов, поэтому два апдейта одного чата не должны
+пересекаться. Бот работает в личных чатах, так что чат совпадает с пользователем.
+
+Слот общего лимита занимается только после того, как подошла очередь чата:
+чат, засыпающий бота сообщениями, не отнимает слоты у остальных.
+
+Каждый апдейт обрабатывается внутри ``bot.db.unit_of_work()``: одна сессия и
+транзакция на запросы обработчика, откат при ошибке. Перед отправкой
+сообщения транзакция фиксируется (см. ``commit_unit_of_work``), чтобы не
+держать блокировки, пока ответ ждёт лимитов Telegram.
+"""
+from __future__ import annotations
+
+import asyncio
+import heapq
+from typing import Any, Awaitable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from .config import UPDATE_CONCURRENCY
+from .db import unit_of_work
+from .metrics import Gauge, Histogram
+
+# сколько самых загруженных чатов показывать в метриках
+TOP_CHATS = 5
+
+chat_queue_wait_seconds = Histogram(
+    "bot_chat_queue_wait_seconds", "Time an update waits for earlier updates of the same chat"
+)
+
+
+class _ChatLane:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+def _chat_id(update: object) -> int | None:
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        super().__init__(max_concurrent_updates)
+        # очередь чата живёт, пока в ней есть апдейты
+        self._lanes: dict[int, _ChatLane] = {}
+        self.processed = 0
+        self.wait_max = 0.0
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = _chat_id(update)
+        if chat_id is None:
+            await super().process_update(update, coroutine)
+            return
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = _ChatLane()
+        lane.pending += 1
+        loop = asyncio.get_running_loop()
+        queued_at = loop.time()
+        try:
+            # asyncio.Lock отдаёт блокировку ожидающим в порядке очереди
+            async with lane.lock:
+                waited = loop.time() - queued_at
+                chat_queue_wait_seconds.observe(waited)
+                self.wait_max = max(self.wait_max, waited)
+                await super().process_update(update, coroutine)
+        finally:
+            lane.pending -= 1
+            if not lane.pending:
+                del self._lanes[chat_id]
+            self.processed += 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # все запросы к базе за апдейт — одна сессия; транзакция закрывается перед отправками
+        async with unit_of_work():
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        busiest = heapq.nlargest(TOP_CHATS, self._lanes.items(), key=lambda item: item[1].pending)
+        return {
+            "chats": len(self._lanes),
+            "queued": sum(lane.pending for lane in self._lanes.values()),
+            "processed": self.processed,
+            "wait_max": self.wait_max,
+            "busiest": {chat_id: lane.pending for chat_id, lane in busiest},
+        }
+
+
+update_processor = PerChatUpdateProcessor()
+
+Gauge("bot_chat_queues", "Chats with updates in progress or waiting, and queued updates in total", lambda: {
+    (stat,): update_processor.stats()[stat] for stat in ("chats", "queued")
+}, ["stat"])
+Gauge("bot_chat_queue_depth", "Updates queued in the busiest chats", lambda: {
+    (chat_id,): depth for chat_id, depth in update_processor.stats()["busiest"].items()
+}, ["chat"])
@@ -1,68 +1,174 @@
-from datetime import time
-from functools import partial
+import asyncio
+from datetime import timedelta
+
 from telegram import Update
+from telegram.error import BadRequest
 import logging
 from telegram.ext import Application
 
 logger = logging.getLogger(__name__)
 
-from .db import load_settings, get_all_users
+from .config import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE
+from .db import (
+    archive_completed_tasks, commit_unit_of_work, load_all_reminder_settings, load_digest_pages, load_settings,
+    repair_task_stats,
+)
+from .messages import message_hashes, message_tracker
+from .outbox import INTERACTIVE, outbox
+from .reminders import reminder_dispatcher
 
 
-def schedule_reminder_job(application: Application):
-    print("DEBUG: schedule_reminder_job")
+async def schedule_reminder_job(application: Application):
+    """Заполняет индекс напоминаний при старте (настройки читаются одним запросом) и запускает минутный тик."""
+    logger.debug("schedule_reminder_job")
     from .handlers import send_daily_tasks  # local import to avoid circular
     if not application.job_queue:
         return
-    for user_id in get_all_users():
-        for job in application.job_queue.get_jobs_by_name(f"daily_{user_id}"):
-            job.schedule_removal()
-        settings = load_settings(user_id)
-        time_str = settings.get("reminder_time", "09:00")
-        hour, minute = map(int, time_str.split(":"))
-        notify_weekends = settings.get("notify_weekends", "0") == "1"
-        days = (0, 1, 2, 3, 4, 5, 6) if notify_weekends else (0, 1, 2, 3, 4)
-        application.job_queue.run_daily(
-            partial(send_daily_tasks, user_id=user_id),
-            time(hour=hour, minute=minute),
-            days=days,
-            name=f"daily_{user_id}",
-        )
-
-
-async def send_and_store(context, chat_id: int, text: str, reply_markup=None):
-    print('DEBUG: send_and_store')
+    reminder_dispatcher.load(await load_all_reminder_settings())
+    reminder_dispatcher.start(application, send_daily_tasks, prepare=load_digest_pages)
+
+
+async def schedule_user_reminder(application: Application, user_id: int, settings: dict | None = None):
+    """Перепланирует напоминание одного пользователя после /start или смены настроек."""
+    logger.debug("schedule_user_reminder")
+    if not application.job_queue:
+        return
+    if settings is None:
+        settings = await load_settings(user_id)
+    reminder_dispatcher.set_user(user_id, settings)
+
+
+# как часто, сек, переносить давно выполненные задачи в архив
+ARCHIVE_INTERVAL = 3600
+
+
+async def archive_completed(context):
+    archived = await archive_completed_tasks(timedelta(days=ARCHIVE_AFTER_DAYS), ARCHIVE_BATCH_SIZE)
+    if archived:
+        logger.info("Archived %d completed tasks", archived)
+
+
+def schedule_archive_job(application: Application):
+    """Раз в час переносит задачи, выполненные больше ARCHIVE_AFTER_DAYS дней назад, в tasks_archive."""
+    if not application.job_queue:
+        return
+    application.job_queue.run_repeating(archive_completed, interval=ARCHIVE_INTERVAL, first=60, name="archive_completed")
+
+
+# как часто, сек, сверять user_task_stats с задачами
+STATS_REPAIR_INTERVAL = 24 * 3600
+
+
+async def repair_stats(context):
+    repaired = await repair_task_stats()
+    if repaired:
+        # счётчики меняются в тех же транзакциях, что и задачи: расхождение — повод искать ошибку
+        logger.warning("Repaired task counters of %d users", repaired)
+
+
+def schedule_stats_repair_job(application: Application):
+    """Раз в сутки пересчитывает user_task_stats и исправляет разошедшиеся строки."""
+    if not application.job_queue:
+        return
+    application.job_queue.run_repeating(
+        repair_stats, interval=STATS_REPAIR_INTERVAL, first=STATS_REPAIR_INTERVAL, name="repair_task_stats"
+    )
+
+
+# ограничение Bot API deleteMessages на один вызов
+DELETE_BATCH = 100
+
+
+def remember_message(chat_id: int, message_id: int):
+    """Запоминает id сообщения бота, чтобы /start мог его удалить."""
+    message_tracker.remember(chat_id, message_id)
+
+
+async def send_and_store(context, chat_id: int, text: str, reply_markup=None, priority: int = INTERACTIVE):
+    logger.debug('send_and_store')
+    # транзакция апдейта не должна ждать Telegram: фиксируем её до отправки
+    await commit_unit_of_work()
     try:
-        sent = await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        sent = await outbox.send_message(context.bot, chat_id, text, reply_markup=reply_markup, priority=priority)
     except Exception:
         logger.exception("Failed to send message to %s: %s", chat_id, text)
         return None
-    if hasattr(context, 'chat_data'):
-        context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
+    remember_message(chat_id, sent.message_id)
+    message_hashes.remember(chat_id, sent.message_id, text, reply_markup)
+    return sent
+
+
+async def reply_text(context, message, text: str, reply_markup=None):
+    """Ответ в чат сообщения через очередь отправки; id ответа запоминается."""
+    await commit_unit_of_work()
+    try:
+        sent = await outbox.reply_text(message, text, reply_markup=reply_markup)
+    except Exception:
+        logger.exception("Failed to send reply: %s", text)
+        return None
+    remember_message(sent.chat_id, sent.message_id)
+    message_hashes.remember(sent.chat_id, sent.message_id, text, reply_markup)
     return sent
 
 
+async def edit_message(message, text: str, reply_markup=None):
+    """Правит сообщение, если текст или клавиатура действительно изменились."""
+    if message_hashes.is_unchanged(message.chat_id, message.message_id, text, reply_markup):
+        return message
+    await commit_unit_of_work()
+    try:
+        edited = await outbox.edit_text(message, text, reply_markup=reply_markup)
+    except BadRequest as exc:
+        if "message is not modified" not in str(exc).lower():
+            logger.exception("Failed to edit message: %s", text)
+            return None
+        edited = message
+    except Exception:
+        logger.exception("Failed to edit message: %s", text)
+        return None
+    message_hashes.remember(message.chat_id, message.message_id, text, reply_markup)
+    return edited
+
+
+async def delete_message(context, chat_id: int, message_id: int) -> bool:
+    await commit_unit_of_work()
+    try:
+        await outbox.delete_message(context.bot, chat_id, message_id)
+    except Exception:
+        logger.exception("Failed to delete message %s", message_id)
+        return False
+    message_hashes.forget(chat_id, message_id)
+    return True
+
+
+async def delete_messages(context, chat_id: int, message_ids: list[int]):
+    """Удаляет сообщения пачками deleteMessages по DELETE_BATCH; пачки идут параллельно."""
+    await commit_unit_of_work()
+
+    async def delete_batch(batch: list[int]):
+        try:
+            await outbox.delete_messages(context.bot, chat_id, batch)
+        except Exception:
+            logger.exception("Failed to delete %d messages in %s", len(batch), chat_id)
+            return
+        for message_id in batch:
+            message_hashes.forget(chat_id, message_id)
+
+    await asyncio.gather(*(
+        delete_batch(message_ids[start:start + DELETE_BATCH]) for start in range(0, len(message_ids), DELETE_BATCH)
+    ))
+
+
 async def reply_or_edit(update: Update, context, text: str, reply_markup=None):
     """Send or edit message depending on update type."""
     message = update.message or (update.callback_query and update.callback_query.message)
     if update.callback_query:
+        await commit_unit_of_work()
         try:
             await update.callback_query.answer()
         except Exception:
             logger.exception("Failed to answer callback query")
         if message:
-            try:
-                await message.edit_text(text, reply_markup=reply_markup)
-            except Exception:
-                logger.exception("Failed to edit message: %s", text)
-    else:
-        if message:
-            try:
-                sent = await message.reply_text(text, reply_markup=reply_markup)
-            except Exception:
-                logger.exception("Failed to send reply: %s", text)
-            else:
-                if hasattr(context, 'chat_data'):
-                    context.chat_data.setdefault('bot_messages', set()).add(sent.message_id)
-
-
+            await edit_message(message, text, reply_markup=reply_markup)
+    elif message:
+        await reply_text(context, message, text, reply_markup=reply_markup)
@@ -0,0 +1,54 @@
+"""Тесты гоняют обработчики против настоящего Postgres из ``TEST_DATABASE_URL``.
+
+Без этой переменной тесты, которым нужна база (фикстура ``database`` или
+``requires_database()`` в модуле), пропускаются, а остальные идут как обычно.
+База должна быть отдельной: тесты создают схему и синтетических пользователей
+из ``bench.common``.
+"""
+import asyncio
+import os
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+# bot.config и bot.db_orm.session читают DATABASE_URL при импорте; без тестовой
+# базы модули бота импортируются с адресом, к которому никто не подключается
+os.environ["DATABASE_URL"] = TEST_DATABASE_URL or "postgresql+psycopg://unused@127.0.0.1:1/unused"
+
+
+def requires_database():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set", allow_module_level=True)
+
+
+@pytest.fixture(scope="session")
+def loop():
+    """Один event loop на сессию: соединения асинхронного движка к нему привязаны."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def database(loop):
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from bench.common import cleanup
+    from bot.db_orm.models import Base
+    from bot.db_orm.session import async_engine, engine
+
+    Base.metadata.create_all(engine)
+    yield
+    loop.run_until_complete(cleanup())
+    loop.run_until_complete(async_engine.dispose())
+
+
+@pytest.fixture
+def query_log(database):
+    from bot.db_orm.session import async_engine
+    from tests.harness import QueryLog
+
+    log = QueryLog(async_engine.sync_engine)
+    yield log
+    log.close()
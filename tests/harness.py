@@ -0,0 +1,119 @@
+"""Подделки Telegram-объектов и счётчик SQL-запросов для тестов обработчиков.
+
+Обработчики обращаются к ``Update``/``CallbackContext`` только через атрибуты,
+поэтому хватает простых объектов с теми же полями; Bot API не вызывается.
+"""
+from __future__ import annotations
+
+import itertools
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from sqlalchemy import event
+
+_message_ids = itertools.count(1)
+
+
+class QueryLog:
+    """Записывает SQL, который движок отправляет в базу внутри ``recording()``."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements: list[str] = []
+        self._active = False
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self._active:
+            self.statements.append(" ".join(statement.split()))
+
+    @contextmanager
+    def recording(self):
+        self.statements = []
+        self._active = True
+        try:
+            yield self
+        finally:
+            self._active = False
+
+    def __len__(self) -> int:
+        return len(self.statements)
+
+    def report(self) -> str:
+        return "\n".join(f"{n}. {statement[:200]}" for n, statement in enumerate(self.statements, 1))
+
+    def close(self):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+class FakeMessage:
+    def __init__(self, chat_id: int, text: str = "", message_id: int | None = None):
+        self.chat_id = chat_id
+        self.message_id = message_id or next(_message_ids)
+        self.text = text
+        self.replies: list[str] = []
+
+    async def reply_text(self, text, reply_markup=None, **kwargs):
+        self.replies.append(text)
+        return FakeMessage(self.chat_id, text)
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        self.text = text
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, chat_id: int, data: str):
+        self.data = data
+        self.message = FakeMessage(chat_id)
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+
+class FakeBot:
+    defaults = None
+
+    def __init__(self):
+        self.sent: list[tuple[int, str]] = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.sent.append((chat_id, text))
+        return FakeMessage(chat_id, text)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        return True
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        return True
+
+
+class FakeJobQueue:
+    def get_jobs_by_name(self, name):
+        return []
+
+    def run_repeating(self, callback, interval, first=None, name=None, **kwargs):
+        return SimpleNamespace(name=name, callback=callback)
+
+
+def make_context(bot: FakeBot | None = None, user_data: dict | None = None):
+    bot = bot or FakeBot()
+    application = SimpleNamespace(bot=bot, job_queue=FakeJobQueue(), create_task=None)
+    return SimpleNamespace(bot=bot, application=application, user_data=dict(user_data or {}), chat_data={})
+
+
+def _update(chat_id: int, message=None, callback_query=None):
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=chat_id),
+        effective_user=SimpleNamespace(id=chat_id, full_name=f"bench {chat_id}"),
+        message=message,
+        callback_query=callback_query,
+    )
+
+
+def text_update(chat_id: int, text: str):
+    return _update(chat_id, message=FakeMessage(chat_id, text))
+
+
+def callback_update(chat_id: int, data: str):
+    return _update(chat_id, callback_query=FakeCallbackQuery(chat_id, data))
@@ -0,0 +1,101 @@
+"""Архив выполненных задач: перенос пачками и /completed поверх tasks и tasks_archive."""
+from datetime import datetime, timedelta, timezone
+
+from tests.conftest import requires_database
+
+requires_database()
+
+from sqlalchemy import func, select, update  # noqa: E402
+
+from bench.common import seed  # noqa: E402
+from bot import db  # noqa: E402
+from bot.cache import user_cache  # noqa: E402
+from bot.db_orm.models import Task, TaskArchive  # noqa: E402
+from bot.db_orm.session import AsyncSessionLocal  # noqa: E402
+
+TASKS = 30
+DONE_RATIO = 0.5
+OLD = 10
+
+
+async def _prepare() -> int:
+    [user_id] = await seed(1, TASKS, done_ratio=DONE_RATIO)
+    async with AsyncSessionLocal() as s:
+        done_ids = (await s.execute(
+            select(Task.id).where(Task.user_id == user_id, Task.done.is_(True)).order_by(Task.id)
+        )).scalars().all()
+        # первые OLD выполненных задач — давние, остальные выполнены только что
+        for n, task_id in enumerate(done_ids[:OLD]):
+            await s.execute(
+                update(Task).where(Task.id == task_id)
+                .values(completed_at=datetime.now(timezone.utc) - timedelta(days=60 + n))
+            )
+        await s.commit()
+    user_cache.clear()
+    return user_id
+
+
+async def _count(model, user_id: int) -> int:
+    async with AsyncSessionLocal() as s:
+        return int((await s.execute(
+            select(func.count()).select_from(model).where(model.user_id == user_id)
+        )).scalar_one())
+
+
+def test_archive_moves_old_tasks_in_batches(loop, database):
+    user_id = loop.run_until_complete(_prepare())
+    hot_before = loop.run_until_complete(_count(Task, user_id))
+    loop.run_until_complete(db.load_tasks(user_id))
+
+    archived = loop.run_until_complete(db.archive_completed_tasks(timedelta(days=30), batch_size=3))
+
+    assert archived == OLD
+    assert loop.run_until_complete(_count(TaskArchive, user_id)) == OLD
+    assert loop.run_until_complete(_count(Task, user_id)) == hot_before - OLD
+    # кэш пользователя сброшен: load_tasks не возвращает перенесённые задачи
+    assert len(loop.run_until_complete(db.load_tasks(user_id))) == hot_before - OLD
+
+
+def test_completed_pages_cover_both_tables(loop, database):
+    user_id = loop.run_until_complete(_prepare())
+    loop.run_until_complete(db.archive_completed_tasks(timedelta(days=30), batch_size=100))
+    done_total = int(TASKS * DONE_RATIO)
+
+    seen, after = [], None
+    while True:
+        page, total = loop.run_until_complete(db.load_completed_page(user_id, after=after, limit=4))
+        assert total == done_total
+        if not page:
+            break
+        seen.extend(page)
+        after = (page[-1]["completed_at"], page[-1]["id"])
+    assert len(seen) == done_total
+    assert len({t["id"] for t in seen}) == done_total
+    keys = [(t["completed_at"], t["id"]) for t in seen]
+    assert keys == sorted(keys, reverse=True)
+    assert sum(t["archived"] for t in seen) == OLD
+    assert all(t["tags"] for t in seen)
+
+    # назад от второй страницы — снова первая
+    first, _ = loop.run_until_complete(db.load_completed_page(user_id, limit=4))
+    second, _ = loop.run_until_complete(
+        db.load_completed_page(user_id, after=(first[-1]["completed_at"], first[-1]["id"]), limit=4)
+    )
+    back, _ = loop.run_until_complete(
+        db.load_completed_page(user_id, before=(second[0]["completed_at"], second[0]["id"]), limit=4)
+    )
+    assert [t["id"] for t in back] == [t["id"] for t in first]
+
+
+def test_restore_brings_task_back_from_archive(loop, database):
+    user_id = loop.run_until_complete(_prepare())
+    loop.run_until_complete(db.archive_completed_tasks(timedelta(days=30), batch_size=100))
+    archived, _ = loop.run_until_complete(db.load_completed_page(user_id, limit=TASKS))
+    task = next(t for t in archived if t["archived"])
+
+    assert loop.run_until_complete(db.restore_task(user_id, task["id"]))
+
+    restored = loop.run_until_complete(db.get_task(user_id, task["id"]))
+    assert restored is not None and not restored["done"]
+    assert sorted(restored["tags"]) == sorted(task["tags"])
+    assert loop.run_until_complete(_count(TaskArchive, user_id)) == OLD - 1
@@ -0,0 +1,100 @@
+"""LRU, TTL и сбросы кэша чтений; база не нужна."""
+import asyncio
+
+from bot.cache import _MISSING, LRUCache, UserCache, cached, invalidates, user_cache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2, "hit_ratio": 0.75}
+
+
+def test_lru_expires_after_ttl():
+    clock = FakeClock()
+    cache = LRUCache(10, ttl=5, clock=clock)
+    cache.set("a", 1)
+    clock.now = 4.9
+    assert cache.get("a") == 1
+    clock.now = 5.0
+    assert cache.get("a", "missing") == "missing"
+    assert len(cache) == 0
+
+
+def test_invalidate_drops_kinds_and_changes_version():
+    cache = UserCache(maxsize=10, ttl=60)
+    cache.set(1, "tasks", [1])
+    cache.set(1, "settings", {"a": "b"})
+    version = cache.version(1)
+    cache.invalidate(1, "tasks")
+    assert cache.get(1, "tasks") is _MISSING
+    assert cache.get(1, "settings") == {"a": "b"}
+    assert cache.version(1) != version
+
+
+def test_values_are_copies():
+    cache = UserCache(maxsize=10, ttl=60)
+    tasks = [{"id": 1}]
+    cache.set(1, "tasks", tasks)
+    tasks.append({"id": 2})
+    cache.get(1, "tasks")[0]["id"] = 5
+    assert cache.get(1, "tasks") == [{"id": 1}]
+
+
+def test_versions_are_bounded_and_never_reused():
+    cache = UserCache(maxsize=3, ttl=60)
+    seen = set()
+    for user_id in range(100):
+        seen.add(cache.version(user_id))
+        cache.invalidate(user_id, "tasks")
+        seen.add(cache.version(user_id))
+    assert len(cache._generations) == 3
+    # вытесненный пользователь получает новый номер, а не 0 или прежний
+    assert cache.version(0) not in seen
+
+
+def test_read_racing_a_write_is_not_cached(loop):
+    user_cache.clear()
+    user_id = 42
+    state = {"value": "old"}
+    reading = asyncio.Event()
+    release = asyncio.Event()
+    calls = []
+
+    @cached("settings")
+    async def load(user_id: int):
+        calls.append(user_id)
+        value = state["value"]
+        reading.set()
+        await release.wait()
+        return value
+
+    @invalidates("settings")
+    async def save(user_id: int, value: str):
+        state["value"] = value
+
+    async def scenario():
+        read = asyncio.ensure_future(load(user_id))
+        await reading.wait()
+        # запись закончилась, пока чтение ещё несёт старое значение
+        await save(user_id, "new")
+        release.set()
+        assert await read == "old"
+        assert await load(user_id) == "new"
+        assert await load(user_id) == "new"
+
+    loop.run_until_complete(scenario())
+    assert len(calls) == 2
@@ -0,0 +1,101 @@
+"""Хэши отправленных сообщений и учёт сообщений бота для /start."""
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from bot import utils
+from bot.db import pop_bot_messages
+from bot.messages import MessageHashStore, MessageTracker, message_hashes
+
+
+class FakeMessage:
+    chat_id = 7
+    message_id = 100
+
+    def __init__(self):
+        self.edits = []
+
+    async def edit_text(self, text, reply_markup=None):
+        self.edits.append(text)
+        return self
+
+
+def _markup(label: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=label)]])
+
+
+def test_hash_store_compares_text_and_keyboard():
+    store = MessageHashStore()
+    store.remember(1, 10, "Задачи", _markup("a"))
+    assert store.is_unchanged(1, 10, "Задачи", _markup("a"))
+    assert not store.is_unchanged(1, 10, "Задачи", _markup("b"))
+    assert not store.is_unchanged(1, 10, "Задачи")
+    assert not store.is_unchanged(1, 11, "Задачи", _markup("a"))
+    assert not store.is_unchanged(2, 10, "Задачи", _markup("a"))
+    store.forget(1, 10)
+    assert not store.is_unchanged(1, 10, "Задачи", _markup("a"))
+    assert store.saved == 1
+
+
+def test_hash_store_keeps_last_messages_per_chat():
+    store = MessageHashStore(per_chat=20)
+    for message_id in range(25):
+        store.remember(1, message_id, f"текст {message_id}")
+    # запомненное заново сообщение становится свежим и не вытесняется
+    store.remember(1, 5, "текст 5")
+    store.remember(1, 25, "текст 25")
+    kept = [message_id for message_id in range(26) if store.is_unchanged(1, message_id, f"текст {message_id}")]
+    assert kept == [5] + list(range(7, 26))
+
+
+def test_edit_with_same_content_skips_bot_api(loop):
+    message = FakeMessage()
+    saved = message_hashes.saved
+    loop.run_until_complete(utils.edit_message(message, "Задачи", _markup("a")))
+    loop.run_until_complete(utils.edit_message(message, "Задачи", _markup("a")))
+    loop.run_until_complete(utils.edit_message(message, "Задачи", _markup("b")))
+    assert message.edits == ["Задачи", "Задачи"]
+    assert message_hashes.saved == saved + 1
+
+
+def test_tracker_caps_pending_per_chat():
+    tracker = MessageTracker(per_chat=3)
+    for message_id in range(5):
+        tracker.remember(1, message_id)
+    tracker.remember(2, 10)
+    assert tracker._pending == {1: [2, 3, 4], 2: [10]}
+    assert tracker.pending() == 4
+
+
+def test_take_merges_memory_and_table(loop, database):
+    chat_id = -900_001
+    tracker = MessageTracker(per_chat=4)
+
+    async def scenario():
+        await pop_bot_messages(chat_id)
+        for message_id in (1, 2, 3):
+            tracker.remember(chat_id, message_id)
+        await tracker.flush()
+        assert tracker.pending() == 0
+        # 3 уже в таблице и снова в памяти: дубль схлопывается
+        for message_id in (3, 4, 5):
+            tracker.remember(chat_id, message_id)
+        taken = await tracker.take(chat_id)
+        return taken, await pop_bot_messages(chat_id), tracker.pending()
+
+    taken, left, pending = loop.run_until_complete(scenario())
+    assert taken == [2, 3, 4, 5]
+    assert (left, pending) == ([], 0)
+
+
+def test_flush_trims_table_per_chat(loop, database):
+    chat_id = -900_002
+    tracker = MessageTracker(per_chat=3)
+
+    async def scenario():
+        await pop_bot_messages(chat_id)
+        for batch in ((1, 2), (3, 4), (5,)):
+            for message_id in batch:
+                tracker.remember(chat_id, message_id)
+            await tracker.flush()
+        return await pop_bot_messages(chat_id)
+
+    assert loop.run_until_complete(scenario()) == [3, 4, 5]
@@ -0,0 +1,34 @@
+"""Замер SQL-запросов и формат выдачи метрик."""
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+
+from bot import metrics
+from bot.db_orm.session import engine as shared_engine
+
+
+def _observed() -> int:
+    return sum(series[2] for series in metrics.db_query_seconds._values.values())
+
+
+def test_failed_statement_does_not_skew_timings(database):
+    engine = create_engine(shared_engine.url)
+    metrics.instrument_engine(engine)
+    try:
+        with engine.connect() as conn:
+            before = _observed()
+            with pytest.raises(DBAPIError):
+                conn.execute(text("SELECT 1/0"))
+            conn.rollback()
+            conn.execute(text("SELECT 1"))
+            assert _observed() == before + 1
+            assert "query_started" not in conn.connection.info
+    finally:
+        engine.dispose()
+
+
+def test_monotonic_values_are_counters():
+    rendered = metrics.render()
+    for name in ("bot_outbox_calls_total", "bot_edits_skipped_total", "bot_db_units_of_work_total"):
+        assert f"# TYPE {name} counter" in rendered
+    assert 'bot_outbox_calls_total{result="sent"}' in rendered
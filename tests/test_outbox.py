@@ -0,0 +1,223 @@
+"""Очередь исходящих вызовов: полосы, бакеты, повторы; база и Telegram не нужны."""
+import asyncio
+
+import httpx
+import pytest
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+from bot.outbox import BULK, INTERACTIVE, Outbox
+
+
+def _run(scenario):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+
+def _outbox(**kwargs) -> Outbox:
+    params = {"global_rate": 1000, "chat_rate": 1000, "chat_burst": 1000, "maxsize": 100, "workers": 1}
+    params.update(kwargs)
+    return Outbox(**params)
+
+
+def _failing(*errors, result="ok"):
+    """Фабрика, которая сначала бросает ``errors`` по очереди, потом отдаёт ``result``."""
+    calls = []
+
+    async def factory():
+        calls.append(asyncio.get_running_loop().time())
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return factory, calls
+
+
+def _network_error(cause: Exception, error=NetworkError) -> NetworkError:
+    # так HTTPXRequest заворачивает ошибки httpx
+    exc = error("httpx error")
+    exc.__cause__ = cause
+    return exc
+
+
+def test_retry_after_pauses_the_queue_and_retries():
+    async def scenario():
+        outbox = _outbox(workers=2)
+        await outbox.start()
+        flood, flood_calls = _failing(RetryAfter(0.2))
+        other, other_calls = _failing()
+        first = asyncio.ensure_future(outbox.call(1, flood))
+        await asyncio.sleep(0.05)
+        # вызов другого чата тоже ждёт конца паузы
+        assert await outbox.call(2, other) == "ok"
+        assert await first == "ok"
+        await outbox.stop()
+        return outbox, flood_calls, other_calls
+
+    outbox, flood_calls, other_calls = _run(scenario)
+    assert len(flood_calls) == 2
+    assert flood_calls[1] - flood_calls[0] >= 0.19
+    assert other_calls[0] - flood_calls[0] >= 0.19
+    assert outbox.retry_after == 1
+    assert (outbox.sent, outbox.failed) == (2, 0)
+
+
+def test_interactive_lane_goes_first():
+    async def scenario():
+        outbox = _outbox()
+        await outbox.start()
+        release = asyncio.Event()
+        order = []
+
+        def record(name):
+            async def factory():
+                order.append(name)
+            return factory
+
+        async def blocker():
+            await release.wait()
+
+        busy = asyncio.ensure_future(outbox.call(None, blocker))
+        await asyncio.sleep(0)
+        calls = [
+            asyncio.ensure_future(outbox.call(None, record("digest 1"), BULK)),
+            asyncio.ensure_future(outbox.call(None, record("digest 2"), BULK)),
+            asyncio.ensure_future(outbox.call(None, record("reply"), INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        assert outbox.stats()["lanes"]["bulk"]["depth"] == 2
+        release.set()
+        await asyncio.gather(busy, *calls)
+        await outbox.stop()
+        return order
+
+    assert _run(scenario) == ["reply", "digest 1", "digest 2"]
+
+
+def test_full_queue_makes_the_sender_wait():
+    async def scenario():
+        outbox = _outbox(maxsize=2)
+        await outbox.start()
+        release = asyncio.Event()
+
+        async def blocker():
+            await release.wait()
+
+        calls = [asyncio.ensure_future(outbox.call(None, blocker)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        third = asyncio.ensure_future(outbox.call(None, blocker))
+        await asyncio.sleep(0.01)
+        # третий вызов ещё не в очереди: места заняты первыми двумя
+        assert outbox.stats()["depth"] == 1
+        assert not third.done()
+        release.set()
+        await asyncio.gather(*calls, third)
+        await outbox.stop()
+        return outbox
+
+    assert _run(scenario).sent == 3
+
+
+def test_busy_chat_does_not_stall_others_and_keeps_order():
+    async def scenario():
+        # один воркер и один токен на чат: второй вызов чата 1 ждёт 0.2 с
+        outbox = _outbox(chat_rate=5, chat_burst=1)
+        await outbox.start()
+        done = []
+
+        def record(name):
+            async def factory():
+                done.append((name, asyncio.get_running_loop().time()))
+            return factory
+
+        started = asyncio.get_running_loop().time()
+        calls = [
+            asyncio.ensure_future(outbox.call(chat_id, record(name)))
+            for chat_id, name in ((1, "a1"), (1, "a2"), (1, "a3"), (2, "b1"))
+        ]
+        await asyncio.gather(*calls)
+        await outbox.stop()
+        return started, done
+
+    started, done = _run(scenario)
+    assert [name for name, _ in done] == ["a1", "b1", "a2", "a3"]
+    at = dict(done)
+    assert at["b1"] - started < 0.1
+    assert at["a2"] - started >= 0.19
+    assert at["a3"] - at["a2"] >= 0.19
+
+
+def test_stop_waits_for_deferred_calls():
+    async def scenario():
+        outbox = _outbox(chat_rate=10, chat_burst=1)
+        await outbox.start()
+        factory, calls = _failing()
+        for _ in range(3):
+            asyncio.ensure_future(outbox.call(1, factory))
+        await asyncio.sleep(0)
+        await outbox.stop()
+        return calls
+
+    assert len(_run(scenario)) == 3
+
+
+@pytest.mark.parametrize("error, attempts", [
+    (_network_error(httpx.ReadTimeout("read"), TimedOut), 1),
+    (_network_error(httpx.RemoteProtocolError("disconnected")), 1),
+    (_network_error(httpx.ConnectError("refused")), 2),
+    (_network_error(httpx.PoolTimeout("pool"), TimedOut), 2),
+])
+def test_send_is_retried_only_if_the_request_was_not_sent(error, attempts, monkeypatch):
+    monkeypatch.setattr("bot.outbox.asyncio.sleep", _no_sleep)
+    factory, calls = _failing(error)
+
+    class Bot:
+        async def send_message(self, **kwargs):
+            return await factory()
+
+    async def scenario():
+        outbox = _outbox()
+        await outbox.start()
+        try:
+            return await outbox.send_message(Bot(), 1, "hi")
+        finally:
+            await outbox.stop()
+
+    if attempts == 1:
+        with pytest.raises(NetworkError):
+            _run(scenario)
+    else:
+        assert _run(scenario) == "ok"
+    assert len(calls) == attempts
+
+
+def test_edit_is_retried_after_timeout(monkeypatch):
+    monkeypatch.setattr("bot.outbox.asyncio.sleep", _no_sleep)
+    factory, calls = _failing(_network_error(httpx.ReadTimeout("read"), TimedOut))
+
+    class Message:
+        chat_id = 1
+
+        async def edit_text(self, text, reply_markup=None):
+            return await factory()
+
+    async def scenario():
+        outbox = _outbox()
+        await outbox.start()
+        try:
+            return await outbox.edit_text(Message(), "hi")
+        finally:
+            await outbox.stop()
+
+    assert _run(scenario) == "ok"
+    assert len(calls) == 2
+
+
+_real_sleep = asyncio.sleep
+
+
+async def _no_sleep(delay, *args, **kwargs):
+    # экспоненциальная задержка между повторами тестам не нужна
+    await _real_sleep(0)
@@ -0,0 +1,231 @@
+"""Ленивая загрузка, пакетная запись и выгрузка user_data/chat_data."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from bot import persistence as persistence_module
+from bot.persistence import CHAT, USER, PostgresPersistence
+
+
+class FakeStore:
+    """Подменяет load_state/save_persistence: считает чтения и запоминает пачки записей."""
+
+    def __init__(self, stored: dict | None = None):
+        self.stored = dict(stored or {})
+        self.loads: list[tuple[str, int]] = []
+        self.saves: list[tuple[dict, dict]] = []
+        self.fail = False
+        self.fail_loads = 0
+
+    async def load_state(self, scope: str, state_id: int):
+        self.loads.append((scope, state_id))
+        if self.fail_loads:
+            self.fail_loads -= 1
+            raise RuntimeError("database is down")
+        return self.stored.get((scope, state_id))
+
+    async def save_persistence(self, states, conversations):
+        if self.fail:
+            raise RuntimeError("database is down")
+        self.saves.append((dict(states), dict(conversations)))
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(persistence_module, "load_state", store.load_state)
+    monkeypatch.setattr(persistence_module, "save_persistence", store.save_persistence)
+    return store
+
+
+def _run(scenario):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+
+def test_refresh_loads_once_and_keeps_newer_keys(store):
+    store.stored[(USER, 1)] = {"filters": {"tag": "дом"}, "tasks_page": 3}
+
+    async def scenario():
+        persistence = PostgresPersistence()
+        # до первого апдейта обработчик уже успел записать страницу
+        user_data = {"tasks_page": 0}
+        await persistence.refresh_user_data(1, user_data)
+        await persistence.refresh_user_data(1, user_data)
+        chat_data = {}
+        await persistence.refresh_chat_data(1, chat_data)
+        return persistence, user_data, chat_data
+
+    persistence, user_data, chat_data = _run(scenario)
+    assert store.loads == [(USER, 1), (CHAT, 1)]
+    assert user_data == {"filters": {"tag": "дом"}, "tasks_page": 0}
+    assert chat_data == {}
+    assert persistence.stats() == {"loaded": 2, "dirty": 0}
+
+
+def test_failed_load_is_retried_before_writing(store):
+    store.stored[(USER, 1)] = {"filters": {"tag": "дом"}, "tasks_page": 3}
+    store.fail_loads = 1
+
+    async def scenario():
+        persistence = PostgresPersistence()
+        user_data = {}
+        with pytest.raises(RuntimeError):
+            await persistence.refresh_user_data(1, user_data)
+        # следующий апдейт читает данные заново и пишет их поверх сохранённых целиком
+        await persistence.refresh_user_data(1, user_data)
+        user_data["tasks_page"] = 0
+        await persistence.update_user_data(1, user_data)
+        await persistence.flush()
+
+    _run(scenario)
+    assert store.loads == [(USER, 1), (USER, 1)]
+    assert store.saves == [({(USER, 1): {"filters": {"tag": "дом"}, "tasks_page": 0}}, {})]
+
+
+def test_changes_are_coalesced_into_one_write(store):
+    async def scenario():
+        persistence = PostgresPersistence()
+        await persistence.update_user_data(1, {"tasks_page": 1})
+        await persistence.update_user_data(1, {"tasks_page": 2})
+        await persistence.update_user_data(2, {"tasks_page": 5})
+        await persistence.update_conversation("add_task", (1, 1), 3)
+        await persistence.flush()
+        # то же содержимое, что уже записано, повторно не пишется
+        await persistence.update_user_data(1, {"tasks_page": 2})
+        # пустые данные без записи в базе удалять нечего
+        await persistence.update_chat_data(3, {})
+        await persistence.flush()
+        return persistence
+
+    persistence = _run(scenario)
+    assert store.saves == [(
+        {(USER, 1): {"tasks_page": 2}, (USER, 2): {"tasks_page": 5}},
+        {("add_task", "[1, 1]"): 3},
+    )]
+    assert persistence.stats()["dirty"] == 0
+
+
+def test_failed_write_keeps_changes_for_next_flush(store):
+    async def scenario():
+        persistence = PostgresPersistence()
+        store.fail = True
+        await persistence.update_user_data(1, {"tasks_page": 1})
+        await persistence.update_user_data(2, {"tasks_page": 1})
+        await persistence.flush()
+        assert persistence.stats()["dirty"] == 2
+        store.fail = False
+        await persistence.update_user_data(1, {"tasks_page": 2})
+        await persistence.flush()
+
+    _run(scenario)
+    assert store.saves == [({(USER, 1): {"tasks_page": 2}, (USER, 2): {"tasks_page": 1}}, {})]
+
+
+def test_eviction_unloads_without_deleting(store):
+    store.stored[(USER, 1)] = {"tasks_page": 4}
+    dropped = []
+    application = SimpleNamespace(
+        drop_user_data=lambda user_id: dropped.append((USER, user_id)),
+        drop_chat_data=lambda chat_id: dropped.append((CHAT, chat_id)),
+    )
+
+    async def scenario():
+        persistence = PostgresPersistence(idle_ttl=0)
+        await persistence.refresh_user_data(1, {})
+        await persistence.refresh_chat_data(2, {})
+        await persistence._evict_idle(SimpleNamespace(application=application))
+        assert persistence.stats()["loaded"] == 0
+        # PTB передаёт выгрузку как drop_*_data: это не удаление, писать нечего
+        await persistence.drop_user_data(1)
+        await persistence.drop_chat_data(2)
+        assert persistence.stats()["dirty"] == 0
+        # следующий апдейт читает данные из базы заново
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        # а настоящий drop удаляет запись
+        await persistence.drop_user_data(1)
+        await persistence.flush()
+        return user_data
+
+    user_data = _run(scenario)
+    assert sorted(dropped) == [(CHAT, 2), (USER, 1)]
+    assert user_data == {"tasks_page": 4}
+    assert store.loads == [(USER, 1), (CHAT, 2), (USER, 1)]
+    assert store.saves == [({(USER, 1): None}, {})]
+
+
+def test_update_between_eviction_and_drop_is_written(store):
+    store.stored[(USER, 1)] = {"filters": {"tag": "дом"}}
+    application = SimpleNamespace(drop_user_data=lambda user_id: None, drop_chat_data=lambda chat_id: None)
+
+    async def scenario():
+        persistence = PostgresPersistence(idle_ttl=0)
+        await persistence.refresh_user_data(1, {})
+        await persistence._evict_idle(SimpleNamespace(application=application))
+        # апдейт пришёл до очередного прохода persistence в PTB
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        user_data["tasks_page"] = 2
+        # PTB вычёркивает id из обновлённых и передаёт только drop_user_data
+        await persistence.drop_user_data(1)
+        await persistence.flush()
+        return persistence
+
+    persistence = _run(scenario)
+    assert store.saves == [({(USER, 1): {"filters": {"tag": "дом"}, "tasks_page": 2}}, {})]
+    assert persistence.stats() == {"loaded": 1, "dirty": 0}
+
+
+def test_dirty_entries_are_not_evicted(store):
+    dropped = []
+    application = SimpleNamespace(drop_user_data=dropped.append, drop_chat_data=dropped.append)
+
+    async def scenario():
+        persistence = PostgresPersistence(idle_ttl=0)
+        await persistence.refresh_user_data(1, {})
+        store.fail = True
+        await persistence.update_user_data(1, {"tasks_page": 1})
+        await persistence.flush()
+        await persistence._evict_idle(SimpleNamespace(application=application))
+
+    _run(scenario)
+    assert dropped == []
+
+
+def test_round_trip_through_database(loop, database):
+    user_id = -910_001
+
+    async def scenario():
+        writer = PostgresPersistence()
+        await writer.update_user_data(user_id, {"filters": {"tags": ["дом"]}, "tasks_page": 2})
+        await writer.update_chat_data(user_id, {"note": "чат"})
+        await writer.update_conversation("round_trip", (user_id, user_id), 7)
+        await writer.flush()
+
+        reader = PostgresPersistence()
+        user_data, chat_data = {}, {}
+        await reader.refresh_user_data(user_id, user_data)
+        await reader.refresh_chat_data(user_id, chat_data)
+        conversations = await reader.get_conversations("round_trip")
+
+        await reader.drop_user_data(user_id)
+        await reader.drop_chat_data(user_id)
+        await reader.update_conversation("round_trip", (user_id, user_id), None)
+        await reader.flush()
+
+        after = PostgresPersistence()
+        emptied = {}
+        await after.refresh_user_data(user_id, emptied)
+        return user_data, chat_data, conversations, emptied, await after.get_conversations("round_trip")
+
+    user_data, chat_data, conversations, emptied, conversations_after = loop.run_until_complete(scenario())
+    assert user_data == {"filters": {"tags": ["дом"]}, "tasks_page": 2}
+    assert chat_data == {"note": "чат"}
+    assert conversations == {(user_id, user_id): 7}
+    assert emptied == {}
+    assert conversations_after == {}
@@ -0,0 +1,213 @@
+"""Бюджет SQL-запросов на обработчик.
+
+Каждый сценарий прогоняется на пользователе с небольшим и с большим списком
+задач при холодных кэшах. Тест падает, если обработчик выдал больше запросов,
+чем указано в бюджете, или если число запросов растёт вместе с числом задач
+(N+1). Бюджеты — верхняя граница: при оптимизации их стоит уменьшать.
+"""
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable
+
+import pytest
+
+from tests.conftest import requires_database
+
+requires_database()
+
+from sqlalchemy import select  # noqa: E402
+
+from bench.common import seed  # noqa: E402
+from bot import db, handlers  # noqa: E402
+from bot.cache import user_cache  # noqa: E402
+from bot.constants import TASKS_PER_PAGE  # noqa: E402
+from bot.db_orm.models import Task  # noqa: E402
+from bot.db_orm.session import AsyncSessionLocal  # noqa: E402
+from bot.keyboards import task_list_cache  # noqa: E402
+from bot.utils import schedule_reminder_job  # noqa: E402
+from tests.harness import callback_update, make_context, text_update  # noqa: E402
+
+SMALL = 25
+LARGE = 400
+DONE_RATIO = 0.2
+
+
+async def _prepare(size: int) -> SimpleNamespace:
+    [user_id] = await seed(1, size, done_ratio=DONE_RATIO)
+    await db.save_categories(user_id, ["Работа", "Дом"])
+    async with AsyncSessionLocal() as s:
+        rows = (await s.execute(
+            select(Task.id, Task.done, Task.version).where(Task.user_id == user_id).order_by(Task.id)
+        )).all()
+    active = [int(task_id) for task_id, done, _ in rows if not done]
+    done = [int(task_id) for task_id, done, _ in rows if done]
+    versions = {int(task_id): int(version) for task_id, _, version in rows}
+    return SimpleNamespace(user=user_id, active=active, done=done, versions=versions)
+
+
+def _reset_caches():
+    user_cache.clear()
+    task_list_cache.clear()
+
+
+@dataclass
+class Scenario:
+    name: str
+    budget: int
+    # ids -> (handler, update, user_data)
+    build: Callable
+
+
+def _handler(handler, update_factory, user_data=None):
+    return lambda ids: (handler, update_factory(ids), user_data(ids) if user_data else {})
+
+
+SCENARIOS = [
+    Scenario("start", 4, _handler(handlers.start, lambda ids: text_update(ids.user, "/start"))),
+    Scenario("cancel", 4, _handler(handlers.cancel, lambda ids: callback_update(ids.user, "cancel"))),
+    Scenario("list_tasks", 2, _handler(handlers.list_tasks, lambda ids: callback_update(ids.user, "show_tasks"))),
+    Scenario("list_tasks_next_page", 2, _handler(
+        handlers.list_tasks,
+        lambda ids: callback_update(ids.user, f"tasks_page_1_a{ids.active[TASKS_PER_PAGE - 1]}"),
+    )),
+    Scenario("list_tasks_tag_filter", 2, _handler(
+        handlers.list_tasks,
+        lambda ids: callback_update(ids.user, "show_tasks"),
+        lambda ids: {"filters": {"tag": "tag1"}},
+    )),
+    Scenario("list_tasks_all_tags_filter", 2, _handler(
+        handlers.list_tasks,
+        lambda ids: callback_update(ids.user, "show_tasks"),
+        lambda ids: {"filters": {"tags": ["tag1", "tag2"], "tag_mode": "all"}},
+    )),
+    Scenario("list_tasks_any_tag_filter", 2, _handler(
+        handlers.list_tasks,
+        lambda ids: callback_update(ids.user, "show_tasks"),
+        lambda ids: {"filters": {"tags": ["tag1", "tag5"], "tag_mode": "any"}},
+    )),
+    # регистр как в названиях задач: в кластере с локалью C Postgres не приводит кириллицу к нижнему регистру
+    Scenario("search", 1, _handler(handlers.search, lambda ids: text_update(ids.user, "/search Задача 1"))),
+    Scenario("search_next_page", 1, _handler(
+        handlers.search,
+        lambda ids: callback_update(ids.user, "search_page_1"),
+        lambda ids: {"search_query": "Задача"},
+    )),
+    Scenario("list_completed", 2, _handler(handlers.list_completed, lambda ids: text_update(ids.user, "/completed"))),
+    Scenario("edit_task_start", 1, _handler(
+        handlers.edit_task_start, lambda ids: callback_update(ids.user, f"edit_{ids.active[0]}_{ids.versions[ids.active[0]]}"),
+    )),
+    Scenario("choose_edit_priority", 4, _handler(
+        handlers.choose_edit_priority,
+        lambda ids: callback_update(ids.user, "priority_высокий"),
+        lambda ids: {"edit_id": ids.active[0], "edit_title": "Новое название", "edit_category": "Дом"},
+    )),
+    Scenario("add_tags_to_task", 5, _handler(
+        handlers.add_tags_to_task,
+        lambda ids: text_update(ids.user, "срочно, дом"),
+        lambda ids: {"tag_id": ids.active[0], "tag_version": ids.versions[ids.active[0]]},
+    )),
+    Scenario("save_comment", 4, _handler(
+        handlers.save_comment,
+        lambda ids: text_update(ids.user, "готово"),
+        lambda ids: {"task_id": ids.active[0], "task_version": ids.versions[ids.active[0]]},
+    )),
+    Scenario("delete_task", 4, _handler(
+        handlers.delete_task, lambda ids: callback_update(ids.user, f"delete_{ids.active[0]}_{ids.versions[ids.active[0]]}"),
+    )),
+    Scenario("restore_task", 4, _handler(
+        handlers.restore_task, lambda ids: callback_update(ids.user, f"restore_{ids.done[0]}_{ids.versions[ids.done[0]]}"),
+    )),
+    Scenario("add_task", 6, _handler(
+        handlers.add_task_tags,
+        lambda ids: text_update(ids.user, "срочно, дом"),
+        lambda ids: {"new_title": "Новая задача", "new_category": "Дом", "new_priority": "высокий"},
+    )),
+    Scenario("send_daily_tasks", 2, lambda ids: (
+        lambda update, context: handlers.send_daily_tasks(context, ids.user),
+        None,
+        {},
+    )),
+    Scenario("categories_menu", 1, _handler(
+        handlers.categories_menu, lambda ids: callback_update(ids.user, "categories"),
+    )),
+    Scenario("save_new_category", 4, _handler(
+        handlers.save_new_category, lambda ids: text_update(ids.user, "Спорт"),
+    )),
+    Scenario("delete_category", 4, _handler(
+        handlers.delete_category, lambda ids: callback_update(ids.user, "delcat_0"),
+    )),
+    Scenario("filter_menu", 1, _handler(
+        handlers.filter_menu, lambda ids: callback_update(ids.user, "filter"),
+        lambda ids: {"filters": {"category": "Работа", "tags": ["tag1"], "tag_mode": "all"}},
+    )),
+    Scenario("filter_choose_priority", 1, _handler(
+        handlers.filter_choose_priority, lambda ids: callback_update(ids.user, "filter_priority"),
+    )),
+    Scenario("filter_choose_tag", 2, _handler(
+        handlers.filter_choose_tag, lambda ids: callback_update(ids.user, "filter_tag"),
+    )),
+    Scenario("filter_toggle_tag", 2, _handler(
+        handlers.filter_set, lambda ids: callback_update(ids.user, "ftag_0"),
+    )),
+    Scenario("filter_apply_tags", 4, _handler(
+        handlers.filter_set,
+        lambda ids: callback_update(ids.user, "ftag_apply"),
+        lambda ids: {"filters": {"tags": ["tag1", "tag2"], "tag_mode": "any"}},
+    )),
+    Scenario("settings_menu", 1, _handler(
+        handlers.settings_menu, lambda ids: callback_update(ids.user, "settings"),
+    )),
+    Scenario("toggle_weekends", 4, _handler(
+        handlers.toggle_weekends, lambda ids: callback_update(ids.user, "toggle_weekends"),
+    )),
+    Scenario("settings_save_time", 3, _handler(
+        handlers.settings_save_time, lambda ids: text_update(ids.user, "08:30"),
+    )),
+]
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS, ids=lambda scenario: scenario.name)
+def test_handler_query_budget(loop, query_log, scenario):
+    counts = {}
+    for size in (SMALL, LARGE):
+        ids = loop.run_until_complete(_prepare(size))
+        handler, update, user_data = scenario.build(ids)
+        context = make_context(user_data=user_data)
+        _reset_caches()
+        with query_log.recording():
+            loop.run_until_complete(handler(update, context))
+        counts[size] = len(query_log)
+        assert counts[size] <= scenario.budget, (
+            f"{scenario.name}: {counts[size]} queries with {size} tasks, budget {scenario.budget}\n{query_log.report()}"
+        )
+    assert counts[LARGE] == counts[SMALL], (
+        f"{scenario.name}: query count grows with tasks ({counts[SMALL]} -> {counts[LARGE]})\n{query_log.report()}"
+    )
+
+
+def test_save_tasks_query_budget(loop, query_log):
+    counts = {}
+    for size in (SMALL, LARGE):
+        ids = loop.run_until_complete(_prepare(size))
+        _reset_caches()
+        tasks = loop.run_until_complete(db.load_tasks(ids.user))
+        tasks[0]["title"] += " (изменено)"
+        tasks[1]["tags"] = ["новый"]
+        del tasks[2]
+        tasks.append({"title": "Новая", "category": "Дом", "priority": "низкий", "tags": ["новый"]})
+        with query_log.recording():
+            loop.run_until_complete(db.save_tasks(ids.user, tasks))
+        counts[size] = len(query_log)
+        # nextval, текущее состояние, upsert задач, теги, -task_tags, +task_tags, удаление задач, счётчики
+        assert counts[size] <= 8, query_log.report()
+    assert counts[LARGE] == counts[SMALL], query_log.report()
+
+
+@pytest.mark.parametrize("users", [3, 60])
+def test_reminder_bootstrap_is_one_query(loop, query_log, users):
+    loop.run_until_complete(seed(users, 5))
+    context = make_context()
+    _reset_caches()
+    with query_log.recording():
+        loop.run_until_complete(schedule_reminder_job(context.application))
+    assert len(query_log) == 1, query_log.report()
@@ -0,0 +1,138 @@
+"""Индекс и тик ReminderDispatcher; база и Telegram не нужны."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from bot import reminders
+from bot.reminders import MAX_CATCHUP_MINUTES, ReminderDispatcher
+
+# понедельник
+NOW = datetime(2026, 10, 12, 9, 30, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def frozen_now(monkeypatch):
+    class FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return NOW
+
+    monkeypatch.setattr(reminders, "datetime", FrozenDatetime)
+
+
+def _tick(dispatcher: ReminderDispatcher) -> list[list[int]]:
+    """Один тик; возвращает корзины, которые он отдал dispatch, по порядку."""
+    started: list[list[int]] = []
+    spawned = []
+
+    async def dispatch(context, user_ids):
+        started.append(user_ids)
+
+    dispatcher.dispatch = dispatch
+    context = SimpleNamespace(application=SimpleNamespace(create_task=spawned.append))
+
+    async def run():
+        await dispatcher._tick(context)
+        await asyncio.gather(*spawned)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+    return started
+
+
+def test_set_user_moves_between_buckets():
+    dispatcher = ReminderDispatcher()
+    dispatcher.set_user(1, {"reminder_time": "09:00", "notify_weekends": "0"})
+    dispatcher.set_user(2, {"reminder_time": "09:00", "notify_weekends": "1"})
+    assert dispatcher.due(0, "09:00") == [1, 2]
+
+    dispatcher.set_user(1, {"reminder_time": "7:05", "notify_weekends": "0"})
+    assert dispatcher.due(0, "09:00") == [2]
+    assert dispatcher.due(0, "07:05") == [1]
+
+    dispatcher.remove_user(2)
+    assert dispatcher.due(0, "09:00") == []
+    # пустые корзины не остаются в индексе
+    assert all(bucket for bucket in dispatcher._buckets.values())
+    assert (0, "09:00") not in dispatcher._buckets
+    assert len(dispatcher) == 1
+
+
+def test_weekends_only_when_enabled():
+    dispatcher = ReminderDispatcher()
+    dispatcher.load({
+        1: {"reminder_time": "09:00", "notify_weekends": "0"},
+        2: {"reminder_time": "09:00", "notify_weekends": "1"},
+    })
+    assert [dispatcher.due(day, "09:00") for day in range(7)] == [[1, 2]] * 5 + [[2]] * 2
+
+
+def test_tick_catches_up_missed_minutes(frozen_now):
+    dispatcher = ReminderDispatcher()
+    for user_id, minutes_ago in ((1, 0), (2, 1), (3, 2), (4, 3)):
+        hhmm = (NOW - timedelta(minutes=minutes_ago)).strftime("%H:%M")
+        dispatcher.set_user(user_id, {"reminder_time": hhmm, "notify_weekends": "1"})
+    # прошлый тик был три минуты назад: минуты -2, -1 и текущая ещё не разосланы
+    dispatcher._last_tick = NOW - timedelta(minutes=3)
+    assert _tick(dispatcher) == [[3], [2], [1]]
+    assert dispatcher._last_tick == NOW
+
+
+def test_tick_catch_up_is_bounded(frozen_now):
+    dispatcher = ReminderDispatcher()
+    for minutes_ago in range(10):
+        hhmm = (NOW - timedelta(minutes=minutes_ago)).strftime("%H:%M")
+        dispatcher.set_user(minutes_ago, {"reminder_time": hhmm, "notify_weekends": "1"})
+    dispatcher._last_tick = NOW - timedelta(hours=1)
+    assert _tick(dispatcher) == [[n] for n in reversed(range(MAX_CATCHUP_MINUTES))]
+
+
+def _dispatch(dispatcher: ReminderDispatcher, user_ids, prepare=None):
+    sent: list[tuple[int, object, float]] = []
+
+    async def send(context, user_id, payload):
+        sent.append((user_id, payload, asyncio.get_running_loop().time()))
+
+    async def run():
+        dispatcher._send = send
+        dispatcher._prepare = prepare
+        started = asyncio.get_running_loop().time()
+        await dispatcher.dispatch(None, user_ids)
+        return started
+
+    loop = asyncio.new_event_loop()
+    try:
+        started = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    return started, sent
+
+
+def test_large_bucket_is_spread_across_the_window():
+    dispatcher = ReminderDispatcher(concurrency=4, rate=1000, spread_threshold=3, spread_seconds=0.4)
+    started, sent = _dispatch(dispatcher, [1, 2, 3, 4])
+    assert [user_id for user_id, _, _ in sent] == [1, 2, 3, 4]
+    offsets = [at - started for _, _, at in sent]
+    # i-й пользователь уходит не раньше i * 0.4 / 4 секунды от начала
+    for index, offset in enumerate(offsets):
+        assert offset >= index * 0.1 - 0.01
+
+
+def test_small_bucket_is_not_spread():
+    dispatcher = ReminderDispatcher(concurrency=4, rate=1000, spread_threshold=3, spread_seconds=10)
+    started, sent = _dispatch(dispatcher, [1, 2, 3])
+    assert max(at for _, _, at in sent) - started < 1
+
+
+def test_users_missing_from_prepare_are_skipped():
+    async def prepare(user_ids):
+        return {user_id: f"digest {user_id}" for user_id in user_ids if user_id != 2}
+
+    dispatcher = ReminderDispatcher(concurrency=2, rate=1000)
+    _, sent = _dispatch(dispatcher, [1, 2, 3], prepare)
+    assert sorted((user_id, payload) for user_id, payload, _ in sent) == [(1, "digest 1"), (3, "digest 3")]
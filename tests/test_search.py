@@ -0,0 +1,51 @@
+"""/search: активные и выполненные задачи, архив не ищется."""
+from datetime import timedelta
+
+from tests.conftest import requires_database
+
+requires_database()
+
+from sqlalchemy import update  # noqa: E402
+
+from bench.common import seed  # noqa: E402
+from bot import db  # noqa: E402
+from bot.db_orm.models import Task  # noqa: E402
+from bot.db_orm.session import AsyncSessionLocal  # noqa: E402
+from bot.keyboards import build_keyboard  # noqa: E402
+
+
+def _prepare(loop) -> dict[str, int]:
+    [user_id] = loop.run_until_complete(seed(1, 0))
+
+    async def create():
+        ids = {
+            "active": await db.create_task(user_id, "купить молоко"),
+            "done": await db.create_task(user_id, "позвонить маме"),
+            "archived": await db.create_task(user_id, "заказать воду"),
+        }
+        await db.complete_task(user_id, ids["done"], "молоко тоже купила")
+        await db.complete_task(user_id, ids["archived"], "молоко и вода")
+        async with AsyncSessionLocal() as s:
+            await s.execute(update(Task).where(Task.id == ids["archived"]).values(
+                completed_at=Task.completed_at - timedelta(days=90)
+            ))
+            await s.commit()
+        await db.archive_completed_tasks(timedelta(days=30), 100)
+        return ids
+
+    ids = loop.run_until_complete(create())
+    ids["user"] = user_id
+    return ids
+
+
+def test_search_finds_completed_tasks_by_comment(loop, database):
+    ids = _prepare(loop)
+    tasks, total = loop.run_until_complete(db.search_tasks(ids["user"], "молоко"))
+    # активная задача первой, хотя у выполненной совпадение тоже есть; архив не ищется
+    assert [task["id"] for task in tasks] == [ids["active"], ids["done"]]
+    assert total == 2
+
+    markup = build_keyboard(tasks, include_completed=True)
+    callbacks = [button.callback_data for row in markup.inline_keyboard for button in row]
+    assert f"restore_{ids['done']}_{tasks[1]['version']}" in callbacks
+    assert f"delete_{ids['active']}_{tasks[0]['version']}" in callbacks
@@ -0,0 +1,140 @@
+"""Записи по устаревшей версии задачи: конфликт вместо перезаписи, повтор там, где он безопасен."""
+import asyncio
+
+from tests.conftest import requires_database
+
+requires_database()
+
+from bench.common import seed  # noqa: E402
+from bot import db, handlers  # noqa: E402
+from bot.cache import user_cache  # noqa: E402
+from tests.harness import callback_update, make_context, text_update  # noqa: E402
+
+
+def _prepare(loop) -> tuple[int, dict]:
+    [user_id] = loop.run_until_complete(seed(1, 5, done_ratio=0))
+    user_cache.clear()
+    task = loop.run_until_complete(db.load_tasks(user_id))[0]
+    return user_id, task
+
+
+def _edit_elsewhere(loop, user_id: int, task: dict):
+    """Правка из другого окна: версия на кнопках у пользователя устаревает."""
+    loop.run_until_complete(db.update_task_fields(user_id, task["id"], title="Изменена в другом окне"))
+
+
+def test_overlapping_writers_conflict_and_retry(loop, database):
+    user_id, task = _prepare(loop)
+    task_id = task["id"]
+    a_read = asyncio.Event()
+    b_wrote = asyncio.Event()
+    seen_versions = []
+
+    async def writer_a():
+        async with db.unit_of_work():
+            async def attempt():
+                current = await db.get_task(user_id, task_id)
+                seen_versions.append(current["version"])
+                if len(seen_versions) == 1:
+                    # первая попытка прочитала версию, и тут вклинивается второй писатель
+                    a_read.set()
+                    await b_wrote.wait()
+                return await db.add_task_tags(user_id, task_id, ["от A"], expected_version=current["version"])
+
+            return await db.retry_on_conflict(attempt)
+
+    async def writer_b():
+        await a_read.wait()
+        async with db.unit_of_work():
+            await db.update_task_fields(user_id, task_id, expected_version=task["version"], title="от B")
+        b_wrote.set()
+
+    async def race():
+        return await asyncio.gather(writer_a(), writer_b())
+
+    added, _ = loop.run_until_complete(race())
+    assert added is True
+    assert seen_versions == [task["version"], task["version"] + 1]
+    current = loop.run_until_complete(db.get_task(user_id, task_id))
+    assert current["title"] == "от B"
+    assert "от A" in current["tags"]
+    assert current["version"] == task["version"] + 2
+
+
+def test_stale_delete_button_keeps_task(loop, database):
+    user_id, task = _prepare(loop)
+    _edit_elsewhere(loop, user_id, task)
+    update = callback_update(user_id, f"delete_{task['id']}_{task['version']}")
+    loop.run_until_complete(handlers.delete_task(update, make_context()))
+    assert loop.run_until_complete(db.get_task(user_id, task["id"])) is not None
+
+    # кнопка со свежей версией удаляет
+    fresh = loop.run_until_complete(db.get_task(user_id, task["id"]))
+    update = callback_update(user_id, f"delete_{task['id']}_{fresh['version']}")
+    loop.run_until_complete(handlers.delete_task(update, make_context()))
+    assert loop.run_until_complete(db.get_task(user_id, task["id"])) is None
+
+
+def test_stale_comment_does_not_complete_task(loop, database):
+    user_id, task = _prepare(loop)
+    _edit_elsewhere(loop, user_id, task)
+    context = make_context(user_data={"task_id": task["id"], "task_version": task["version"]})
+    update = text_update(user_id, "готово")
+    loop.run_until_complete(handlers.save_comment(update, context))
+    assert loop.run_until_complete(db.get_task(user_id, task["id"]))["done"] is False
+    assert update.message.replies[0] == handlers.TASK_CHANGED_TEXT
+
+
+def test_comment_on_deleted_task_is_not_saved(loop, database):
+    user_id, task = _prepare(loop)
+    loop.run_until_complete(db.delete_task(user_id, task["id"]))
+    context = make_context(user_data={"task_id": task["id"]})
+    update = text_update(user_id, "готово")
+    loop.run_until_complete(handlers.save_comment(update, context))
+    assert update.message.replies[0] == handlers.TASK_GONE_TEXT
+    # дайджест после «сохранено» не отправляется
+    assert context.bot.sent == []
+
+
+def test_stale_restore_button_keeps_task_done(loop, database):
+    user_id, task = _prepare(loop)
+    loop.run_until_complete(db.complete_task(user_id, task["id"], "готово"))
+    done = loop.run_until_complete(db.get_task(user_id, task["id"]))
+    _edit_elsewhere(loop, user_id, task)
+    update = callback_update(user_id, f"restore_{task['id']}_{done['version']}")
+    loop.run_until_complete(handlers.restore_task(update, make_context()))
+    assert loop.run_until_complete(db.get_task(user_id, task["id"]))["done"] is True
+
+
+def test_tags_are_added_after_concurrent_edit(loop, database):
+    user_id, task = _prepare(loop)
+    _edit_elsewhere(loop, user_id, task)
+    context = make_context(user_data={"tag_id": task["id"], "tag_version": task["version"]})
+    loop.run_until_complete(handlers.add_tags_to_task(text_update(user_id, "срочно"), context))
+    current = loop.run_until_complete(db.get_task(user_id, task["id"]))
+    assert current["title"] == "Изменена в другом окне"
+    assert "срочно" in current["tags"]
+
+
+def test_tags_are_not_added_to_completed_task(loop, database):
+    user_id, task = _prepare(loop)
+    loop.run_until_complete(db.complete_task(user_id, task["id"], "готово"))
+    context = make_context(user_data={"tag_id": task["id"], "tag_version": task["version"]})
+    loop.run_until_complete(handlers.add_tags_to_task(text_update(user_id, "срочно"), context))
+    assert "срочно" not in loop.run_until_complete(db.get_task(user_id, task["id"]))["tags"]
+
+
+def test_conflicting_tags_leave_no_orphan_names(loop, database):
+    user_id, task = _prepare(loop)
+    _edit_elsewhere(loop, user_id, task)
+
+    async def update():
+        async with db.unit_of_work():
+            try:
+                await db.add_task_tags(user_id, task["id"], ["сирота"], expected_version=task["version"])
+            except db.TaskConflict:
+                pass
+
+    loop.run_until_complete(update())
+    user_cache.clear()
+    assert "сирота" not in loop.run_until_complete(db.load_tags(user_id))
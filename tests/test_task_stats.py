@@ -0,0 +1,74 @@
+"""user_task_stats меняется вместе с задачами; repair_task_stats чинит расхождения."""
+from datetime import timedelta
+
+from tests.conftest import requires_database
+
+requires_database()
+
+from sqlalchemy import update  # noqa: E402
+
+from bench.common import seed  # noqa: E402
+from bot import db  # noqa: E402
+from bot.cache import user_cache  # noqa: E402
+from bot.db_orm.models import Task, UserTaskStats  # noqa: E402
+from bot.db_orm.session import AsyncSessionLocal  # noqa: E402
+
+
+def _stats(loop, user_id: int) -> dict[str, int]:
+    user_cache.clear()
+    return loop.run_until_complete(db.load_task_stats(user_id))
+
+
+def test_counters_follow_mutations(loop, database):
+    [user_id] = loop.run_until_complete(seed(1, 30, done_ratio=0.2))
+    assert _stats(loop, user_id) == {
+        "active": 24, "done": 6, "active_low": 8, "active_medium": 8, "active_high": 8,
+    }
+
+    async def mutate():
+        task_id = await db.create_task(user_id, "Новая", priority="высокий")
+        await db.update_task_fields(user_id, task_id, priority="низкий", title="Переименована")
+        await db.complete_task(user_id, task_id, "готово")
+        await db.restore_task(user_id, task_id)
+        tasks = await db.load_tasks(user_id)
+        await db.delete_task(user_id, tasks[0]["id"])
+        tasks = await db.load_tasks(user_id)
+        tasks[0]["done"] = True
+        tasks[1]["priority"] = "высокий"
+        del tasks[2]
+        tasks.append({"title": "Из снимка", "priority": "средний"})
+        await db.save_tasks(user_id, tasks)
+        # архив считается в done: перенос ничего не меняет, возврат делает задачу активной
+        async with AsyncSessionLocal() as s:
+            await s.execute(update(Task).where(Task.user_id == user_id, Task.done.is_(True)).values(
+                completed_at=Task.completed_at - timedelta(days=90)
+            ))
+            await s.commit()
+        await db.archive_completed_tasks(timedelta(days=30), 100)
+        await db.restore_task(user_id, tasks[0]["id"])
+
+    loop.run_until_complete(mutate())
+    before = _stats(loop, user_id)
+    # пересчёт с нуля совпадает с тем, что накопили записи
+    assert loop.run_until_complete(db.repair_task_stats([user_id])) == 0
+    assert _stats(loop, user_id) == before
+
+
+def test_repair_fixes_drift(loop, database):
+    [user_id] = loop.run_until_complete(seed(1, 10))
+    expected = _stats(loop, user_id)
+
+    async def corrupt():
+        async with AsyncSessionLocal() as s:
+            await s.execute(
+                update(UserTaskStats).where(UserTaskStats.user_id == user_id).values(active=UserTaskStats.active + 5)
+            )
+            await s.commit()
+
+    loop.run_until_complete(corrupt())
+    assert _stats(loop, user_id)["active"] == expected["active"] + 5
+    version = user_cache.version(user_id)
+    assert loop.run_until_complete(db.repair_task_stats([user_id])) == 1
+    # списки задач в task_list_cache привязаны к версии и должны перестроиться
+    assert user_cache.version(user_id) != version
+    assert _stats(loop, user_id) == expected
@@ -0,0 +1,87 @@
+"""tasks.tags совпадает с task_tags после любой записи и фильтрует по нескольким тегам."""
+from tests.conftest import requires_database
+
+requires_database()
+
+from sqlalchemy import select  # noqa: E402
+
+from bench.common import seed  # noqa: E402
+from bot import db  # noqa: E402
+from bot.cache import user_cache  # noqa: E402
+from bot.db_orm.models import Task, TaskTag  # noqa: E402
+from bot.db_orm.session import AsyncSessionLocal  # noqa: E402
+
+
+async def _drift(user_id: int) -> dict[int, tuple[list[str], list[str]]]:
+    """Задачи, у которых массив tasks.tags расходится с task_tags: {id: (массив, task_tags)}."""
+    async with AsyncSessionLocal() as s:
+        arrays = dict((await s.execute(select(Task.id, Task.tags).where(Task.user_id == user_id))).all())
+        pairs = (await s.execute(
+            select(TaskTag.task_id, TaskTag.tag).join(Task, Task.id == TaskTag.task_id).where(Task.user_id == user_id)
+        )).all()
+    linked: dict[int, list[str]] = {task_id: [] for task_id in arrays}
+    for task_id, tag in pairs:
+        linked[task_id].append(tag)
+    return {
+        task_id: (sorted(tags), sorted(linked[task_id]))
+        for task_id, tags in arrays.items()
+        if sorted(tags) != sorted(linked[task_id])
+    }
+
+
+def test_array_follows_task_tags(loop, database):
+    [user_id] = loop.run_until_complete(seed(1, 10))
+    user_cache.clear()
+
+    task_id = loop.run_until_complete(db.create_task(user_id, "Новая", tags=["дом", "срочно"]))
+    loop.run_until_complete(db.add_task_tags(user_id, task_id, ["срочно", "магазин"]))
+    assert loop.run_until_complete(db.get_task(user_id, task_id))["tags"] == ["дом", "срочно", "магазин"]
+
+    tasks = loop.run_until_complete(db.load_tasks(user_id))
+    tasks[0]["tags"] = ["новый"]
+    tasks[1]["tags"] = []
+    loop.run_until_complete(db.save_tasks(user_id, tasks))
+
+    assert loop.run_until_complete(_drift(user_id)) == {}
+
+
+def test_multi_tag_filter(loop, database):
+    [user_id] = loop.run_until_complete(seed(1, 40))
+    user_cache.clear()
+    tasks = loop.run_until_complete(db.load_tasks(user_id))
+
+    for mode, expected in (
+        ("all", [t for t in tasks if {"tag1", "tag2"} <= set(t["tags"])]),
+        ("any", [t for t in tasks if {"tag1", "tag2"} & set(t["tags"])]),
+    ):
+        page, total = loop.run_until_complete(
+            db.load_tasks_page(user_id, {"tags": ["tag1", "tag2"], "tag_mode": mode}, limit=100)
+        )
+        assert total == len(expected) > 0
+        assert [t["id"] for t in page] == [t["id"] for t in expected]
+
+
+def test_facet_counts(loop, database):
+    [user_id] = loop.run_until_complete(seed(1, 40))
+    user_cache.clear()
+    tasks = [t for t in loop.run_until_complete(db.load_tasks(user_id)) if not t["done"]]
+    filters = {"priority": tasks[0]["priority"], "tags": ["tag1"], "tag_mode": "all"}
+
+    def matches(task, skip=None):
+        return (
+            (skip == "priority" or task["priority"] == filters["priority"])
+            and (skip == "tags" or "tag1" in task["tags"])
+        )
+
+    facets = loop.run_until_complete(db.load_facet_counts(user_id, filters))
+    assert facets["total"] == loop.run_until_complete(db.load_tasks_page(user_id, filters))[1] > 0
+    assert facets["category"] == {
+        c: sum(1 for t in tasks if t["category"] == c and matches(t)) for c in {t["category"] for t in tasks} if c
+    }
+    assert facets["priority"] == {
+        p: sum(1 for t in tasks if t["priority"] == p and matches(t, "priority"))
+        for p in {t["priority"] for t in tasks} if p
+    }
+    assert facets["tag"] == {
+        tag: sum(1 for t in tasks if tag in t["tags"] and matches(t, "tags")) for t0 in tasks for tag in t0["tags"]
+    }
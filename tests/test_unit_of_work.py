@@ -0,0 +1,142 @@
+"""Единица работы: одна транзакция на апдейт, откат целиком при ошибке."""
+import pytest
+
+from tests.conftest import requires_database
+
+requires_database()
+
+from sqlalchemy import delete, select  # noqa: E402
+
+from bench.common import seed  # noqa: E402
+from bot import db, handlers, utils  # noqa: E402
+from bot.cache import user_cache  # noqa: E402
+from bot.db_orm.models import BotMessage, Setting, Task  # noqa: E402
+from bot.db_orm.session import AsyncSessionLocal  # noqa: E402
+from tests.harness import FakeBot, callback_update, make_context  # noqa: E402
+
+
+class Boom(Exception):
+    pass
+
+
+def _prepare(loop) -> int:
+    [user_id] = loop.run_until_complete(seed(1, 5))
+    loop.run_until_complete(db.save_categories(user_id, ["Работа"]))
+    user_cache.clear()
+    return user_id
+
+
+def test_commits_at_end(loop, database):
+    user_id = _prepare(loop)
+
+    async def update():
+        async with db.unit_of_work():
+            await db.save_categories(user_id, ["Работа", "Дом"])
+            # внутри транзакции видны собственные изменения
+            assert sorted(await db.load_categories(user_id)) == ["Дом", "Работа"]
+
+    loop.run_until_complete(update())
+    user_cache.clear()
+    assert sorted(loop.run_until_complete(db.load_categories(user_id))) == ["Дом", "Работа"]
+
+
+@pytest.mark.parametrize("failure", ["raise", "mark"])
+def test_rolls_back_and_drops_cache(loop, database, failure):
+    user_id = _prepare(loop)
+
+    async def update():
+        async with db.unit_of_work():
+            await db.save_categories(user_id, ["Дом"])
+            # кэш заполняется данными, которые не будут зафиксированы
+            assert await db.load_categories(user_id) == ["Дом"]
+            if failure == "raise":
+                raise Boom
+            db.mark_unit_of_work_failed()
+
+    if failure == "raise":
+        with pytest.raises(Boom):
+            loop.run_until_complete(update())
+    else:
+        loop.run_until_complete(update())
+    assert loop.run_until_complete(db.load_categories(user_id)) == ["Работа"]
+
+
+def test_task_conflict_keeps_earlier_writes(loop, database):
+    user_id = _prepare(loop)
+
+    async def update():
+        async with db.unit_of_work():
+            await db.save_categories(user_id, ["Дом"])
+            tasks = await db.load_tasks(user_id)
+            tasks[0]["version"] -= 1
+            with pytest.raises(db.TaskConflict):
+                await db.save_tasks(user_id, tasks)
+
+    loop.run_until_complete(update())
+    user_cache.clear()
+    assert loop.run_until_complete(db.load_categories(user_id)) == ["Дом"]
+
+
+def test_message_is_sent_after_commit(loop, database):
+    user_id = _prepare(loop)
+    task_id = loop.run_until_complete(db.load_tasks(user_id))[0]["id"]
+    observed = []
+
+    class CheckingBot(FakeBot):
+        async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+            async with AsyncSessionLocal() as s:
+                # строка не заблокирована транзакцией апдейта, а её изменение уже видно снаружи
+                observed.append((await s.execute(
+                    select(Task.title).where(Task.id == task_id).with_for_update(nowait=True)
+                )).scalar_one())
+                await s.rollback()
+            return await super().send_message(chat_id, text, reply_markup, **kwargs)
+
+    async def update():
+        async with db.unit_of_work():
+            await db.update_task_fields(user_id, task_id, title="До отправки")
+            assert await utils.send_and_store(make_context(CheckingBot()), user_id, "Задача обновлена.")
+            await db.save_categories(user_id, ["После отправки"])
+            raise Boom
+
+    with pytest.raises(Boom):
+        loop.run_until_complete(update())
+    assert observed == ["До отправки"]
+    user_cache.clear()
+    # откатывается только то, что сделано после отправки
+    assert loop.run_until_complete(db.get_task(user_id, task_id))["title"] == "До отправки"
+    assert loop.run_until_complete(db.load_categories(user_id)) == ["Работа"]
+
+
+def test_start_commits_before_bot_api(loop, database):
+    user_id = _prepare(loop)
+    observed = []
+
+    async def prepare():
+        async with AsyncSessionLocal() as s:
+            # register_user допишет недостающую настройку
+            await s.execute(delete(Setting).where(Setting.user_id == user_id, Setting.key == "notify_weekends"))
+            await s.commit()
+        await db.save_bot_messages({user_id: [1, 2, 3]}, 10)
+
+    class CheckingBot(FakeBot):
+        async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+            async with AsyncSessionLocal() as s:
+                # удалённые /start строки bot_messages и новые настройки уже зафиксированы и не заблокированы
+                settings = (await s.execute(
+                    select(Setting.key).where(Setting.user_id == user_id).with_for_update(nowait=True)
+                )).scalars().all()
+                messages = (await s.execute(
+                    select(BotMessage.message_id).where(BotMessage.chat_id == user_id).with_for_update(nowait=True)
+                )).scalars().all()
+                observed.append((sorted(settings), messages))
+                await s.rollback()
+            return await super().send_message(chat_id, text, reply_markup, **kwargs)
+
+    async def update():
+        async with db.unit_of_work():
+            await handlers.start(callback_update(user_id, "start"), make_context(CheckingBot()))
+
+    loop.run_until_complete(prepare())
+    loop.run_until_complete(update())
+    assert observed == [(["notify_weekends", "reminder_time"], [])]
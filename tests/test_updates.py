@@ -0,0 +1,103 @@
+"""Порядок апдейтов внутри чата и параллельность между чатами."""
+import asyncio
+import contextlib
+from datetime import datetime, timezone
+
+import pytest
+from telegram import Chat, Message, Update
+
+from bot import updates
+from bot.updates import PerChatUpdateProcessor
+
+
+@pytest.fixture(autouse=True)
+def no_unit_of_work(monkeypatch):
+    # транзакция тут не нужна: проверяется только очередность
+    monkeypatch.setattr(updates, "unit_of_work", contextlib.nullcontext)
+
+
+def _update(chat_id: int, update_id: int) -> Update:
+    chat = Chat(chat_id, Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(timezone.utc), chat, text="x"))
+
+
+def _run(scenario):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(scenario())
+    finally:
+        loop.close()
+
+
+def test_updates_of_one_chat_run_in_order_without_overlap():
+    log = []
+
+    async def handle(name: str, delay: float):
+        log.append(("start", name))
+        await asyncio.sleep(delay)
+        log.append(("end", name))
+
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=8)
+        # первый апдейт самый долгий: без очереди чата он закончился бы последним
+        await asyncio.gather(*(
+            processor.process_update(_update(1, n), handle(f"u{n}", delay))
+            for n, delay in enumerate((0.05, 0.01, 0))
+        ))
+        return processor
+
+    processor = _run(scenario)
+    assert log == [
+        ("start", "u0"), ("end", "u0"), ("start", "u1"), ("end", "u1"), ("start", "u2"), ("end", "u2"),
+    ]
+    assert processor._lanes == {}
+    assert processor.stats()["processed"] == 3
+
+
+def test_busy_chat_does_not_hold_other_chats():
+    async def scenario():
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        done = []
+
+        async def blocked():
+            await release.wait()
+            done.append("chat 1")
+
+        async def quick(name: str):
+            done.append(name)
+
+        first = asyncio.ensure_future(processor.process_update(_update(1, 1), blocked()))
+        # второй апдейт чата 1 ждёт очереди чата и не занимает слот общего лимита
+        second = asyncio.ensure_future(processor.process_update(_update(1, 2), quick("chat 1 again")))
+        await asyncio.sleep(0)
+        await asyncio.wait_for(processor.process_update(_update(2, 3), quick("chat 2")), timeout=1)
+        stats = processor.stats()
+        release.set()
+        await asyncio.gather(first, second)
+        return done, stats
+
+    done, stats = _run(scenario)
+    assert done == ["chat 2", "chat 1", "chat 1 again"]
+    assert (stats["chats"], stats["queued"], stats["busiest"]) == (1, 2, {1: 2})
+
+
+def test_failed_update_releases_the_chat():
+    async def scenario():
+        processor = PerChatUpdateProcessor()
+
+        async def fail():
+            raise RuntimeError("boom")
+
+        async def ok():
+            return None
+
+        with pytest.raises(RuntimeError):
+            await processor.process_update(_update(1, 1), fail())
+        assert processor._lanes == {}
+        await asyncio.wait_for(processor.process_update(_update(1, 2), ok()), timeout=1)
+        return processor
+
+    processor = _run(scenario)
+    assert processor._lanes == {}
+    assert processor.processed == 2